@@ -5,6 +5,28 @@ DEFAULT_LOGGER_PATH = '/var/log/sensor.log'
 DEFAULT_LOGGER_LEVEL_CONSOLE = 'DEBUG'
 DEFAULT_LOGGER_LEVEL_FILE = 'INFO'
 DEFAULT_DB_PATH = '/var/spool/sensor.sqlite'
+DEFAULT_DB_SYNCHRONOUS = 'NORMAL'
+DEFAULT_DB_BUSY_TIMEOUT_MS = 5000
+DEFAULT_SPOOLER_BATCH_SIZE = 64
+DEFAULT_SPOOLER_BATCH_MAX_WAIT_SEC = 1.0
+DEFAULT_SPOOLER_EVICTION_POLICY = 'drop_oldest'
+DEFAULT_SPOOLER_EVICTION_BATCH_SIZE = 1000
+DEFAULT_SPOOLER_THIN_FACTOR = 2
+DEFAULT_SPOOLER_PARTITION = 'none'
+DEFAULT_SPOOLER_BACKEND = 'sqlite'
+DEFAULT_SPOOLER_SEGMENT_SIZE_BYTES = 4 * 1024 * 1024
+DEFAULT_SPOOLER_RETRY_MAX_ATTEMPTS = 10
+DEFAULT_SPOOLER_RETRY_BACKOFF_SEC = 60
+DEFAULT_SPOOLER_RETRY_MAX_BACKOFF_SEC = 24 * 60 * 60
+DEFAULT_SPOOLER_COMPRESSION = 'none'
+DEFAULT_SPOOLER_BLOCK_SIZE = 512
+DEFAULT_SPOOLER_FLUSH_MAX_OBS = 1000
+DEFAULT_SPOOLER_COMPACTION_BATCH_SIZE = 10000
+DEFAULT_SPOOLER_ARCHIVE_FORMAT = 'ndjson'
+DEFAULT_SPOOLER_ARCHIVE_COMPRESSION = 'gzip'
+DEFAULT_SPOOLER_ROLLUP_15MIN_RETENTION_DAYS = 7.0
+DEFAULT_SPOOLER_ROLLUP_HOURLY_RETENTION_DAYS = 90.0
+DEFAULT_SPOOLER_ROLLUP_UPLOAD = 'none'
 
 ENV_YAML_PATH = 'LEARN_YAML_PATH'
 
@@ -38,6 +60,80 @@ CFG_LOGGING_LEVELS = {'CRITICAL': logging.CRITICAL,
 
 CFG_SPOOLER = 'spooler'
 CFG_SPOOLER_DB_PATH = 'db_path'
+CFG_SPOOLER_SYNCHRONOUS = 'synchronous'
+CFG_SPOOLER_BUSY_TIMEOUT_MS = 'busy_timeout_ms'
+CFG_SPOOLER_BATCH_SIZE = 'batch_size'
+CFG_SPOOLER_BATCH_MAX_WAIT_SEC = 'batch_max_wait_seconds'
+CFG_SPOOLER_MAX_BYTES = 'max_bytes'
+CFG_SPOOLER_MAX_ROWS = 'max_rows'
+CFG_SPOOLER_MAX_AGE_HOURS = 'max_age_hours'
+CFG_SPOOLER_EVICTION_POLICY = 'eviction_policy'
+CFG_SPOOLER_EVICTION_BATCH_SIZE = 'eviction_batch_size'
+CFG_SPOOLER_THIN_FACTOR = 'thin_factor'
+
+CFG_SPOOLER_EVICTION_POLICY_DROP_OLDEST = 'drop_oldest'
+CFG_SPOOLER_EVICTION_POLICY_THIN = 'thin'
+CFG_SPOOLER_EVICTION_POLICY_DROP_ERRORS_FIRST = 'drop_errors_first'
+CFG_SPOOLER_EVICTION_POLICIES = (CFG_SPOOLER_EVICTION_POLICY_DROP_OLDEST,
+                                 CFG_SPOOLER_EVICTION_POLICY_THIN,
+                                 CFG_SPOOLER_EVICTION_POLICY_DROP_ERRORS_FIRST)
+
+CFG_SPOOLER_PARTITION = 'partition'
+CFG_SPOOLER_PARTITION_NONE = 'none'
+CFG_SPOOLER_PARTITION_HOUR = 'hour'
+CFG_SPOOLER_PARTITION_DAY = 'day'
+CFG_SPOOLER_PARTITIONS = (CFG_SPOOLER_PARTITION_NONE,
+                          CFG_SPOOLER_PARTITION_HOUR,
+                          CFG_SPOOLER_PARTITION_DAY)
+
+CFG_SPOOLER_BACKEND = 'backend'
+CFG_SPOOLER_BACKEND_SQLITE = 'sqlite'
+CFG_SPOOLER_BACKEND_SEGMENT_LOG = 'segment_log'
+CFG_SPOOLER_BACKENDS = (CFG_SPOOLER_BACKEND_SQLITE,
+                        CFG_SPOOLER_BACKEND_SEGMENT_LOG)
+CFG_SPOOLER_SEGMENT_SIZE_BYTES = 'segment_size_bytes'
+
+CFG_SPOOLER_RETRY_MAX_ATTEMPTS = 'retry_max_attempts'
+CFG_SPOOLER_RETRY_BACKOFF_SEC = 'retry_backoff_seconds'
+CFG_SPOOLER_RETRY_MAX_BACKOFF_SEC = 'retry_max_backoff_seconds'
+
+CFG_SPOOLER_COMPRESSION = 'compression'
+CFG_SPOOLER_COMPRESSION_NONE = 'none'
+CFG_SPOOLER_COMPRESSION_GORILLA = 'gorilla'
+CFG_SPOOLER_COMPRESSIONS = (CFG_SPOOLER_COMPRESSION_NONE,
+                            CFG_SPOOLER_COMPRESSION_GORILLA)
+CFG_SPOOLER_BLOCK_SIZE = 'block_size'
+
+CFG_SPOOLER_FLUSH_INTERVAL_SEC = 'flush_interval_seconds'
+CFG_SPOOLER_FLUSH_MAX_OBS = 'flush_max_observations'
+
+CFG_SPOOLER_COMPACTION_BATCH_SIZE = 'compaction_batch_size'
+
+CFG_SPOOLER_ARCHIVE_PATH = 'archive_path'
+CFG_SPOOLER_ARCHIVE_FORMAT = 'archive_format'
+CFG_SPOOLER_ARCHIVE_FORMAT_NDJSON = 'ndjson'
+CFG_SPOOLER_ARCHIVE_FORMAT_CSV = 'csv'
+CFG_SPOOLER_ARCHIVE_FORMATS = (CFG_SPOOLER_ARCHIVE_FORMAT_NDJSON,
+                               CFG_SPOOLER_ARCHIVE_FORMAT_CSV)
+CFG_SPOOLER_ARCHIVE_COMPRESSION = 'archive_compression'
+CFG_SPOOLER_ARCHIVE_COMPRESSION_GZIP = 'gzip'
+CFG_SPOOLER_ARCHIVE_COMPRESSION_ZSTD = 'zstd'
+CFG_SPOOLER_ARCHIVE_COMPRESSIONS = (CFG_SPOOLER_ARCHIVE_COMPRESSION_GZIP,
+                                    CFG_SPOOLER_ARCHIVE_COMPRESSION_ZSTD)
+CFG_SPOOLER_ARCHIVE_MAX_BYTES = 'archive_max_bytes'
+
+CFG_SPOOLER_ROLLUP_PATH = 'rollup_path'
+CFG_SPOOLER_ROLLUP_15MIN_RETENTION_DAYS = 'rollup_15min_retention_days'
+CFG_SPOOLER_ROLLUP_HOURLY_RETENTION_DAYS = 'rollup_hourly_retention_days'
+CFG_SPOOLER_ROLLUP_UPLOAD = 'rollup_upload'
+CFG_SPOOLER_ROLLUP_TIER_15MIN = '15min'
+CFG_SPOOLER_ROLLUP_TIER_HOURLY = 'hourly'
+CFG_SPOOLER_ROLLUP_UPLOAD_NONE = 'none'
+CFG_SPOOLER_ROLLUP_UPLOADS = (CFG_SPOOLER_ROLLUP_UPLOAD_NONE,
+                              CFG_SPOOLER_ROLLUP_TIER_15MIN,
+                              CFG_SPOOLER_ROLLUP_TIER_HOURLY)
+
+CFG_SPOOLER_SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
 
 CFG_THING = 'thing'
 
@@ -74,3 +170,21 @@ CFG_TRANSPORT_HTTPS_JWT_KEY = 'jwt_key'
 CFG_TRANSPORT_HTTPS_TRANSMIT_INTERVAL_SEC = 'transmit_interval_seconds'
 CFG_TRANSPORT_HTTPS_VERIFY_SSL = 'verify_ssl'
 CFG_TRANSPORT_HTTPS_JWT_TTL = 'jwt_token_ttl_minutes'
+CFG_TRANSPORT_HTTPS_COMPRESSION = 'compression'
+CFG_TRANSPORT_HTTPS_COMPRESSION_NONE = 'none'
+CFG_TRANSPORT_HTTPS_COMPRESSION_GZIP = 'gzip'
+CFG_TRANSPORT_HTTPS_COMPRESSION_DEFLATE = 'deflate'
+CFG_TRANSPORT_HTTPS_COMPRESSIONS = (CFG_TRANSPORT_HTTPS_COMPRESSION_NONE,
+                                    CFG_TRANSPORT_HTTPS_COMPRESSION_GZIP,
+                                    CFG_TRANSPORT_HTTPS_COMPRESSION_DEFLATE)
+CFG_TRANSPORT_HTTPS_COMPRESSION_MIN_BYTES = 'compression_min_bytes'
+CFG_TRANSPORT_HTTPS_COMPRESSION_LEVEL = 'compression_level'
+CFG_TRANSPORT_HTTPS_MAX_BODY_BYTES = 'max_body_bytes'
+CFG_TRANSPORT_HTTPS_BATCH_SIZE = 'batch_size'
+CFG_TRANSPORT_HTTPS_MIN_BATCH_SIZE = 'min_batch_size'
+CFG_TRANSPORT_HTTPS_MAX_BATCH_SIZE = 'max_batch_size'
+CFG_TRANSPORT_HTTPS_TIMEOUT_SEC = 'timeout_seconds'
+CFG_TRANSPORT_HTTPS_TARGET_POST_SEC = 'target_post_seconds'
+CFG_TRANSPORT_DRAIN = 'drain'
+CFG_TRANSPORT_DRAIN_MAX_RATE = 'drain_max_observations_per_second'
+CFG_TRANSPORT_HTTPS_POST_WORKERS = 'post_workers'
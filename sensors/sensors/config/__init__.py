@@ -1,5 +1,6 @@
 import os
 import io
+import importlib.util
 from collections import ChainMap
 
 from .util import *
@@ -86,6 +87,178 @@ class Config:
 
             return get_sensor_instance(sensor_type, *op_objects, **properties)
 
+        @classmethod
+        def read_spooler_configuration(cls, spooler_cfg, c):
+            db_path = get_config_element(CFG_SPOOLER_DB_PATH, spooler_cfg, CFG_SPOOLER, optional=True)
+            if db_path is None:
+                db_path = DEFAULT_DB_PATH
+            db_path_dir = os.path.dirname(db_path)
+            if not os.path.exists(db_path_dir):
+                raise raise_config_error("Spooler path directory {0} does not exist.".format(db_path_dir))
+            c[CFG_SPOOLER_DB_PATH] = db_path
+
+            synchronous = get_config_element_typed(CFG_SPOOLER_SYNCHRONOUS, spooler_cfg, CFG_SPOOLER, str,
+                                                   default=DEFAULT_DB_SYNCHRONOUS).upper()
+            if synchronous not in CFG_SPOOLER_SYNCHRONOUS_LEVELS:
+                raise_config_error("Spooler synchronous level {0} is not known.".format(synchronous))
+            c[CFG_SPOOLER_SYNCHRONOUS] = synchronous
+            c[CFG_SPOOLER_BUSY_TIMEOUT_MS] = get_config_element_typed(CFG_SPOOLER_BUSY_TIMEOUT_MS, spooler_cfg,
+                                                                      CFG_SPOOLER, int,
+                                                                      default=DEFAULT_DB_BUSY_TIMEOUT_MS)
+
+            batch_size = get_config_element_typed(CFG_SPOOLER_BATCH_SIZE, spooler_cfg, CFG_SPOOLER, int,
+                                                  default=DEFAULT_SPOOLER_BATCH_SIZE)
+            if batch_size < 1:
+                raise_config_error("Spooler batch size {0} must be at least 1.".format(batch_size))
+            c[CFG_SPOOLER_BATCH_SIZE] = batch_size
+            c[CFG_SPOOLER_BATCH_MAX_WAIT_SEC] = get_config_element_typed(CFG_SPOOLER_BATCH_MAX_WAIT_SEC, spooler_cfg,
+                                                                         CFG_SPOOLER, float,
+                                                                         default=DEFAULT_SPOOLER_BATCH_MAX_WAIT_SEC)
+
+            # Spool budget, any of which may be left unset
+            for (element_name, typ) in ((CFG_SPOOLER_MAX_BYTES, int),
+                                        (CFG_SPOOLER_MAX_ROWS, int),
+                                        (CFG_SPOOLER_MAX_AGE_HOURS, float)):
+                value = get_config_element_typed(element_name, spooler_cfg, CFG_SPOOLER, typ)
+                if value is not None and value <= 0:
+                    raise_config_error("Spooler {0} {1} must be greater than 0.".format(element_name, value))
+                c[element_name] = value
+            eviction_policy = get_config_element_typed(CFG_SPOOLER_EVICTION_POLICY, spooler_cfg, CFG_SPOOLER, str,
+                                                       default=DEFAULT_SPOOLER_EVICTION_POLICY)
+            if eviction_policy not in CFG_SPOOLER_EVICTION_POLICIES:
+                raise_config_error("Spooler eviction policy {0} is not known.".format(eviction_policy))
+            c[CFG_SPOOLER_EVICTION_POLICY] = eviction_policy
+            eviction_batch_size = get_config_element_typed(CFG_SPOOLER_EVICTION_BATCH_SIZE, spooler_cfg,
+                                                           CFG_SPOOLER, int,
+                                                           default=DEFAULT_SPOOLER_EVICTION_BATCH_SIZE)
+            if eviction_batch_size < 1:
+                raise_config_error("Spooler eviction batch size {0} must be at least 1.".format(eviction_batch_size))
+            c[CFG_SPOOLER_EVICTION_BATCH_SIZE] = eviction_batch_size
+            thin_factor = get_config_element_typed(CFG_SPOOLER_THIN_FACTOR, spooler_cfg, CFG_SPOOLER, int,
+                                                   default=DEFAULT_SPOOLER_THIN_FACTOR)
+            if thin_factor < 2:
+                raise_config_error("Spooler thin factor {0} must be at least 2.".format(thin_factor))
+            c[CFG_SPOOLER_THIN_FACTOR] = thin_factor
+
+            partition = get_config_element_typed(CFG_SPOOLER_PARTITION, spooler_cfg, CFG_SPOOLER, str,
+                                                 default=DEFAULT_SPOOLER_PARTITION)
+            if partition not in CFG_SPOOLER_PARTITIONS:
+                raise_config_error("Spooler partition {0} is not known.".format(partition))
+            c[CFG_SPOOLER_PARTITION] = partition
+
+            backend = get_config_element_typed(CFG_SPOOLER_BACKEND, spooler_cfg, CFG_SPOOLER, str,
+                                               default=DEFAULT_SPOOLER_BACKEND)
+            if backend not in CFG_SPOOLER_BACKENDS:
+                raise_config_error("Spooler backend {0} is not known.".format(backend))
+            if backend != CFG_SPOOLER_BACKEND_SQLITE and partition != CFG_SPOOLER_PARTITION_NONE:
+                raise_config_error("Spooler partition {0} is only supported by backend {1}.".
+                                   format(partition, CFG_SPOOLER_BACKEND_SQLITE))
+            c[CFG_SPOOLER_BACKEND] = backend
+            segment_size = get_config_element_typed(CFG_SPOOLER_SEGMENT_SIZE_BYTES, spooler_cfg, CFG_SPOOLER, int,
+                                                    default=DEFAULT_SPOOLER_SEGMENT_SIZE_BYTES)
+            if segment_size < 1:
+                raise_config_error("Spooler segment size {0} must be at least 1.".format(segment_size))
+            c[CFG_SPOOLER_SEGMENT_SIZE_BYTES] = segment_size
+
+            for (element_name, default) in ((CFG_SPOOLER_RETRY_MAX_ATTEMPTS, DEFAULT_SPOOLER_RETRY_MAX_ATTEMPTS),
+                                            (CFG_SPOOLER_RETRY_BACKOFF_SEC, DEFAULT_SPOOLER_RETRY_BACKOFF_SEC),
+                                            (CFG_SPOOLER_RETRY_MAX_BACKOFF_SEC, DEFAULT_SPOOLER_RETRY_MAX_BACKOFF_SEC)):
+                if element_name == CFG_SPOOLER_RETRY_MAX_ATTEMPTS and backend == CFG_SPOOLER_BACKEND_SEGMENT_LOG:
+                    # Only the spooler appends to a segment log, rejected observations can't be retried
+                    default = 1
+                value = get_config_element_typed(element_name, spooler_cfg, CFG_SPOOLER, int, default=default)
+                if value < 1:
+                    raise_config_error("Spooler {0} {1} must be at least 1.".format(element_name, value))
+                c[element_name] = value
+            if backend == CFG_SPOOLER_BACKEND_SEGMENT_LOG and c[CFG_SPOOLER_RETRY_MAX_ATTEMPTS] > 1:
+                raise_config_error("Spooler {0} {1} is not supported by backend {2}, which does not retry.".
+                                   format(CFG_SPOOLER_RETRY_MAX_ATTEMPTS, c[CFG_SPOOLER_RETRY_MAX_ATTEMPTS], backend))
+
+            compression = get_config_element_typed(CFG_SPOOLER_COMPRESSION, spooler_cfg, CFG_SPOOLER, str,
+                                                   default=DEFAULT_SPOOLER_COMPRESSION)
+            if compression not in CFG_SPOOLER_COMPRESSIONS:
+                raise_config_error("Spooler compression {0} is not known.".format(compression))
+            if compression != CFG_SPOOLER_COMPRESSION_NONE and (backend != CFG_SPOOLER_BACKEND_SQLITE or
+                                                                partition != CFG_SPOOLER_PARTITION_NONE):
+                raise_config_error("Spooler compression {0} is only supported by backend {1} without partitions.".
+                                   format(compression, CFG_SPOOLER_BACKEND_SQLITE))
+            c[CFG_SPOOLER_COMPRESSION] = compression
+            block_size = get_config_element_typed(CFG_SPOOLER_BLOCK_SIZE, spooler_cfg, CFG_SPOOLER, int,
+                                                  default=DEFAULT_SPOOLER_BLOCK_SIZE)
+            if block_size < 2:
+                raise_config_error("Spooler block size {0} must be at least 2.".format(block_size))
+            c[CFG_SPOOLER_BLOCK_SIZE] = block_size
+
+            # Buffering in memory is only enabled if a flush interval is set
+            flush_interval = get_config_element_typed(CFG_SPOOLER_FLUSH_INTERVAL_SEC, spooler_cfg, CFG_SPOOLER, float)
+            if flush_interval is not None and flush_interval <= 0:
+                raise_config_error("Spooler flush interval {0} must be greater than 0.".format(flush_interval))
+            c[CFG_SPOOLER_FLUSH_INTERVAL_SEC] = flush_interval
+            flush_max_observations = get_config_element_typed(CFG_SPOOLER_FLUSH_MAX_OBS, spooler_cfg, CFG_SPOOLER, int,
+                                                              default=DEFAULT_SPOOLER_FLUSH_MAX_OBS)
+            if flush_max_observations < 1:
+                raise_config_error("Spooler flush max observations {0} must be at least 1.".
+                                   format(flush_max_observations))
+            c[CFG_SPOOLER_FLUSH_MAX_OBS] = flush_max_observations
+
+            compaction_batch_size = get_config_element_typed(CFG_SPOOLER_COMPACTION_BATCH_SIZE, spooler_cfg,
+                                                             CFG_SPOOLER, int,
+                                                             default=DEFAULT_SPOOLER_COMPACTION_BATCH_SIZE)
+            if compaction_batch_size < 1:
+                raise_config_error("Spooler compaction batch size {0} must be at least 1.".
+                                   format(compaction_batch_size))
+            c[CFG_SPOOLER_COMPACTION_BATCH_SIZE] = compaction_batch_size
+
+            # Archiving of delivered observations is only enabled if a path is set
+            c[CFG_SPOOLER_ARCHIVE_PATH] = get_config_element_typed(CFG_SPOOLER_ARCHIVE_PATH, spooler_cfg,
+                                                                   CFG_SPOOLER, str)
+            archive_format = get_config_element_typed(CFG_SPOOLER_ARCHIVE_FORMAT, spooler_cfg, CFG_SPOOLER, str,
+                                                      default=DEFAULT_SPOOLER_ARCHIVE_FORMAT)
+            if archive_format not in CFG_SPOOLER_ARCHIVE_FORMATS:
+                raise_config_error("Spooler archive format {0} is not known.".format(archive_format))
+            c[CFG_SPOOLER_ARCHIVE_FORMAT] = archive_format
+            archive_compression = get_config_element_typed(CFG_SPOOLER_ARCHIVE_COMPRESSION, spooler_cfg,
+                                                           CFG_SPOOLER, str,
+                                                           default=DEFAULT_SPOOLER_ARCHIVE_COMPRESSION)
+            if archive_compression not in CFG_SPOOLER_ARCHIVE_COMPRESSIONS:
+                raise_config_error("Spooler archive compression {0} is not known.".format(archive_compression))
+            if archive_compression == CFG_SPOOLER_ARCHIVE_COMPRESSION_ZSTD and \
+                    importlib.util.find_spec('zstandard') is None:
+                raise_config_error("Spooler archive compression {0} requires the zstandard package.".
+                                   format(archive_compression))
+            c[CFG_SPOOLER_ARCHIVE_COMPRESSION] = archive_compression
+            archive_max_bytes = get_config_element_typed(CFG_SPOOLER_ARCHIVE_MAX_BYTES, spooler_cfg, CFG_SPOOLER, int)
+            if archive_max_bytes is not None and archive_max_bytes <= 0:
+                raise_config_error("Spooler archive max bytes {0} must be greater than 0.".format(archive_max_bytes))
+            c[CFG_SPOOLER_ARCHIVE_MAX_BYTES] = archive_max_bytes
+
+            # Rollups are only kept if a path is set
+            rollup_path = get_config_element_typed(CFG_SPOOLER_ROLLUP_PATH, spooler_cfg, CFG_SPOOLER, str)
+            c[CFG_SPOOLER_ROLLUP_PATH] = rollup_path
+            for (element_name, default) in ((CFG_SPOOLER_ROLLUP_15MIN_RETENTION_DAYS,
+                                             DEFAULT_SPOOLER_ROLLUP_15MIN_RETENTION_DAYS),
+                                            (CFG_SPOOLER_ROLLUP_HOURLY_RETENTION_DAYS,
+                                             DEFAULT_SPOOLER_ROLLUP_HOURLY_RETENTION_DAYS)):
+                value = get_config_element_typed(element_name, spooler_cfg, CFG_SPOOLER, float, default=default)
+                if value <= 0:
+                    raise_config_error("Spooler {0} {1} must be greater than 0.".format(element_name, value))
+                c[element_name] = value
+            rollup_upload = get_config_element_typed(CFG_SPOOLER_ROLLUP_UPLOAD, spooler_cfg, CFG_SPOOLER, str,
+                                                     default=DEFAULT_SPOOLER_ROLLUP_UPLOAD)
+            if rollup_upload not in CFG_SPOOLER_ROLLUP_UPLOADS:
+                raise_config_error("Spooler rollup upload {0} is not known.".format(rollup_upload))
+            if rollup_upload != CFG_SPOOLER_ROLLUP_UPLOAD_NONE and rollup_path is None:
+                raise_config_error("Spooler rollup upload {0} requires {1} to be set.".
+                                   format(rollup_upload, CFG_SPOOLER_ROLLUP_PATH))
+            # Raw observations are never delivered when rollups are uploaded instead, so only the
+            #   spool budget bounds them
+            if rollup_upload != CFG_SPOOLER_ROLLUP_UPLOAD_NONE and \
+                    all(c[e] is None for e in (CFG_SPOOLER_MAX_BYTES, CFG_SPOOLER_MAX_ROWS, CFG_SPOOLER_MAX_AGE_HOURS)):
+                raise_config_error("Spooler rollup upload {0} requires one of {1}, {2} or {3} to be set.".
+                                   format(rollup_upload, CFG_SPOOLER_MAX_BYTES, CFG_SPOOLER_MAX_ROWS,
+                                          CFG_SPOOLER_MAX_AGE_HOURS))
+            c[CFG_SPOOLER_ROLLUP_UPLOAD] = rollup_upload
+
         @classmethod
         def get_configuration(cls):
             """
@@ -166,16 +339,10 @@ class Config:
             c[CFG_LOGGING_LOGGER_PATH] = logger_path
 
             # Spooler
-            db_path = DEFAULT_DB_PATH
-            if CFG_SPOOLER in config_raw:
-                db_path = get_config_element(CFG_SPOOLER_DB_PATH, config_raw[CFG_SPOOLER], CFG_SPOOLER,
-                                             optional=True)
-                if db_path is None:
-                    db_path = DEFAULT_DB_PATH
-            db_path_dir = os.path.dirname(db_path)
-            if not os.path.exists(db_path_dir):
-                raise raise_config_error("Spooler path directory {0} does not exist.".format(db_path_dir))
-            c[CFG_SPOOLER_DB_PATH] = db_path
+            spooler_cfg = config_raw.get(CFG_SPOOLER)
+            if spooler_cfg is None:
+                spooler_cfg = {}
+            cls.read_spooler_configuration(spooler_cfg, c)
 
             # Thing
             thing_id = get_config_element(CFG_ID, config_raw[CFG_THING], CFG_THING)
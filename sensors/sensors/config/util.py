@@ -1,5 +1,8 @@
 import logging
 
+BOOLEAN_TRUE = ('true', 'yes', 'on', '1')
+BOOLEAN_FALSE = ('false', 'no', 'off', '0')
+
 class ConfigurationError(Exception):
     """Exception raised for errors in configuration
 
@@ -33,3 +36,32 @@ def get_config_element_with_default(element_name, container, default=None):
     else:
         element = container[element_name]
     return element
+
+
+def boolean(value):
+    """Convert a YAML boolean, or a string such as "false" (quoted in YAML), to bool
+
+    """
+    if isinstance(value, bool):
+        return value
+    s = str(value).strip().lower()
+    if s in BOOLEAN_TRUE:
+        return True
+    if s in BOOLEAN_FALSE:
+        return False
+    raise ValueError("{0} is not a boolean".format(value))
+
+
+def get_config_element_typed(element_name, container, container_name, typ, default=None):
+    """Get an optional config element, converted with typ (e.g. int, float), or default if absent
+
+    """
+    element = get_config_element_with_default(element_name, container, default=default)
+    if element is None:
+        return None
+    try:
+        return typ(element)
+    except (TypeError, ValueError):
+        raise_config_error("{container_name} element {element_name} with value {element} is not a valid {typ}".
+                           format(container_name=container_name, element_name=element_name,
+                                  element=str(element), typ=typ.__name__))
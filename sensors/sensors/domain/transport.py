@@ -1,9 +1,11 @@
 from sensors.common.constants import *
+from sensors.config.util import get_config_element_typed, boolean
 
 
 class Transport:
     TRANSPORT_TYPE_HTTPS = CFG_TRANSPORT_TYPE_HTTPS
     IDENTIFIER_SEPARATOR = '|'
+    DEFAULT_DRAIN = True
 
     def __init__(self, typ, **kwargs):
         self.typ = typ
@@ -13,8 +15,22 @@ class Transport:
         raise NotImplementedError
 
     def transmit(self, repo):
+        """Transmit a batch of observations read from repo
+
+        :return: (number of observations transmitted, whether the batch was full, in which case
+            more observations are likely waiting)
+        """
         raise NotImplementedError
 
     def transmit_interval_seconds(self) -> int:
         return int(self.properties.get(CFG_TRANSPORT_HTTPS_TRANSMIT_INTERVAL_SEC,
                                        self.DEFAULT_TRANSMIT_INTERVAL_SECONDS))
+
+    def drain(self) -> bool:
+        """Whether to transmit batches back-to-back while there is a backlog"""
+        return get_config_element_typed(CFG_TRANSPORT_DRAIN, self.properties, 'transport', boolean,
+                                        default=self.DEFAULT_DRAIN)
+
+    def drain_max_observations_per_second(self) -> float:
+        """Rate limit while draining a backlog, or None if there is none"""
+        return get_config_element_typed(CFG_TRANSPORT_DRAIN_MAX_RATE, self.properties, 'transport', float)
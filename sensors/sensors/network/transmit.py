@@ -5,10 +5,53 @@ import time
 from sensors.common.logging import configure_logger
 from sensors.config import Config, ConfigurationError
 from sensors.common.constants import *
-from sensors.persistence.sqlite import SqliteRepository
+from sensors.persistence import get_repository_instance
+from sensors.persistence.rollup import Rollups
 from sensors.transport import AuthenticationException, TransmissionException
 
 SCHEDULE_PRIORITY_DEFAULT = 1
+# How often to report progress while draining a backlog
+DRAIN_PROGRESS_SECONDS = 60
+
+
+def transmit(t, repo):
+    """Transmit a batch with transport t, then drain the backlog if the batch was full"""
+    (n, more) = t.transmit(repo)
+    if more and t.drain():
+        drain(t, repo, n)
+
+
+def drain(t, repo, transmitted=0):
+    """Transmit batches back-to-back, no faster than the drain rate limit of the transport,
+    until a batch is not full, that is until the transport has caught up with the backlog.
+
+    :param transmitted: Number of observations transmitted by the batch that revealed the backlog
+    :return: Number of observations transmitted, including those of that batch
+    """
+    max_rate = t.drain_max_observations_per_second()
+    start = time.monotonic()
+    last_progress = start
+    logger.info("Transmitter: draining backlog of {0}...".format(t.identifier()))
+    more = True
+    try:
+        while more:
+            now = time.monotonic()
+            if max_rate is not None and transmitted > max_rate * (now - start):
+                time.sleep(transmitted / max_rate - (now - start))
+            (n, more) = t.transmit(repo)
+            transmitted += n
+            now = time.monotonic()
+            if now - last_progress >= DRAIN_PROGRESS_SECONDS:
+                logger.info("Transmitter: drained {0} observations in {1:.0f} seconds ({2:.1f} observations/s).".
+                            format(transmitted, now - start, transmitted / (now - start)))
+                last_progress = now
+    finally:
+        elapsed = time.monotonic() - start
+        logger.info("Transmitter: {0} backlog of {1} after {2} observations in {3:.1f} seconds "
+                    "({4:.1f} observations/s).".
+                    format("caught up with" if not more else "stopped draining", t.identifier(), transmitted, elapsed,
+                           transmitted / elapsed if elapsed > 0 else 0.0))
+    return transmitted
 
 
 def main():
@@ -25,7 +68,13 @@ def main():
     logger = configure_logger(config)
     logger.info("Transmitter: entering.")
 
-    repo = SqliteRepository(config)
+    repo = get_repository_instance(config)
+    # Transports upload either the spooled observations or, to save bandwidth, their rollups
+    upload_repo = repo
+    if config[CFG_SPOOLER_ROLLUP_UPLOAD] != CFG_SPOOLER_ROLLUP_UPLOAD_NONE:
+        upload_repo = Rollups(config)
+        logger.info("Transmitter: uploading {0} rollups instead of observations.".
+                    format(config[CFG_SPOOLER_ROLLUP_UPLOAD]))
     s = sched.scheduler(time.time, time.sleep)
 
     while True:
@@ -38,16 +87,21 @@ def main():
             else:
                 transmit_interval = float(transmit_interval)
 
+            repo.retry_observations()
+
             transports = config[CFG_TRANSPORTS]
             logger.debug("Transmitter: scheduling network transmissions for {0} transports...".format(len(transports)))
             for t in transports:
                 s.enter(transmit_interval,
                         SCHEDULE_PRIORITY_DEFAULT,
-                        t.transmit,
-                        argument=(repo,))
+                        transmit,
+                        argument=(t, upload_repo))
                 logger.debug("Transmitter: Running scheduler...")
                 s.run()
                 logger.debug("Transmitter: End of iteration.")
+
+            # Purge what was delivered while waiting for the next transmission
+            repo.compact(max_seconds=transmit_interval)
         except KeyboardInterrupt:
             break
         except AuthenticationException as ae:
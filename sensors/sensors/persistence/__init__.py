@@ -0,0 +1,44 @@
+from sensors.common.constants import (CFG_SPOOLER_PARTITION, CFG_SPOOLER_PARTITION_NONE,
+                                      CFG_SPOOLER_BACKEND, CFG_SPOOLER_BACKEND_SEGMENT_LOG,
+                                      CFG_SPOOLER_COMPRESSION, CFG_SPOOLER_COMPRESSION_GORILLA,
+                                      CFG_SPOOLER_FLUSH_INTERVAL_SEC, CFG_SPOOLER_RETRY_MAX_ATTEMPTS)
+from sensors.config.util import raise_config_error
+
+
+def sort_by_datastream(observations):
+    """Observations ordered by datastream, then multidatastream, as get_observations_by_datastream()
+    returns them.  The sort is stable, so each datastream's observations stay oldest-first."""
+    if observations is None:
+        return None
+    # Avoid circular imports...
+    from sensors.domain.multiobservation import MultiObservation
+    return sorted(observations, key=lambda o: (1, o.multidatastreamId) if isinstance(o, MultiObservation)
+                  else (0, o.datastreamId))
+
+
+def get_repository_instance(config, buffered=False):
+    """Create the spool repository selected by the spooler section of the configuration
+
+    :param buffered: Whether to put the repository behind a BufferedRepository, if the
+        configuration sets a flush interval.  Only the spooler should write through a buffer.
+    """
+    if buffered and config[CFG_SPOOLER_FLUSH_INTERVAL_SEC] is not None:
+        from sensors.persistence.buffer import BufferedRepository
+        return BufferedRepository(get_repository_instance(config), config)
+    # Avoid circular imports...
+    from sensors.persistence.sqlite import SqliteRepository
+    from sensors.persistence.partition import PartitionedSqliteRepository
+    from sensors.persistence.segment_log import SegmentLogRepository
+    from sensors.persistence.blocks import BlockSqliteRepository
+    if config[CFG_SPOOLER_BACKEND] == CFG_SPOOLER_BACKEND_SEGMENT_LOG:
+        if config.get(CFG_SPOOLER_RETRY_MAX_ATTEMPTS, 1) > 1:
+            raise_config_error("Spooler {0} {1} is not supported by backend {2}, which does not retry.".
+                               format(CFG_SPOOLER_RETRY_MAX_ATTEMPTS, config[CFG_SPOOLER_RETRY_MAX_ATTEMPTS],
+                                      CFG_SPOOLER_BACKEND_SEGMENT_LOG))
+        return SegmentLogRepository(config)
+    elif config[CFG_SPOOLER_COMPRESSION] == CFG_SPOOLER_COMPRESSION_GORILLA:
+        return BlockSqliteRepository(config)
+    elif config[CFG_SPOOLER_PARTITION] == CFG_SPOOLER_PARTITION_NONE:
+        return SqliteRepository(config)
+    else:
+        return PartitionedSqliteRepository(config)
@@ -0,0 +1,228 @@
+import io
+import os
+import csv
+import json
+import gzip
+import heapq
+import math
+import itertools
+from datetime import datetime, timezone
+
+from sensors.common.constants import (CFG_SPOOLER_ARCHIVE_PATH, CFG_SPOOLER_ARCHIVE_FORMAT,
+                                      CFG_SPOOLER_ARCHIVE_FORMAT_CSV, CFG_SPOOLER_ARCHIVE_COMPRESSION,
+                                      CFG_SPOOLER_ARCHIVE_COMPRESSION_GZIP, CFG_SPOOLER_ARCHIVE_COMPRESSION_ZSTD,
+                                      CFG_SPOOLER_ARCHIVE_MAX_BYTES)
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.common import logging
+
+
+class Archive:
+    """Append-only, compressed files of delivered observations, one per UTC day of archiving,
+    e.g. observations-20180610.ndjson.gz.
+
+    Each write appends a new gzip member (or zstd frame) to the file of the day, which
+    standard tools read as a single stream, so files are never rewritten.  Once the files
+    take more than archive_max_bytes, the oldest are deleted, but never the current one.
+    """
+
+    FILE_PREFIX = 'observations-'
+    DATE_FMT = '%Y%m%d'
+    COMPRESSION_SUFFIXES = {CFG_SPOOLER_ARCHIVE_COMPRESSION_GZIP: '.gz',
+                            CFG_SPOOLER_ARCHIVE_COMPRESSION_ZSTD: '.zst'}
+    CSV_FIELDS = ('id', 'featureOfInterestId', 'datastreamId', 'multidatastreamId', 'phenomenonTime', 'result',
+                  'parameters')
+
+    def __init__(self, config):
+        self.directory = config[CFG_SPOOLER_ARCHIVE_PATH]
+        self.format = config[CFG_SPOOLER_ARCHIVE_FORMAT]
+        self.compression = config[CFG_SPOOLER_ARCHIVE_COMPRESSION]
+        self.max_bytes = config[CFG_SPOOLER_ARCHIVE_MAX_BYTES]
+        self.suffix = '.' + self.format + self.COMPRESSION_SUFFIXES[self.compression]
+        self.logger = logging.get_instance()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, t):
+        return os.path.join(self.directory, self.FILE_PREFIX + t.strftime(self.DATE_FMT) + self.suffix)
+
+    def files(self):
+        """Paths of the archive files, oldest first"""
+        return sorted([os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                       if f.startswith(self.FILE_PREFIX) and f.endswith(self.suffix)])
+
+    def _open(self, path):
+        if self.compression == CFG_SPOOLER_ARCHIVE_COMPRESSION_ZSTD:
+            import zstandard
+            raw = zstandard.ZstdCompressor().stream_writer(open(path, 'ab'))
+        else:
+            raw = gzip.open(path, 'ab')
+        return io.TextIOWrapper(raw, encoding='utf-8', newline='')
+
+    @staticmethod
+    def _to_record(o):
+        result = o.result
+        if isinstance(o, MultiObservation):
+            # NaN is not valid JSON
+            result = [None if isinstance(r, float) and math.isnan(r) else r for r in result]
+        return {'id': o.id,
+                'featureOfInterestId': o.featureOfInterestId,
+                'datastreamId': None if isinstance(o, MultiObservation) else o.datastreamId,
+                'multidatastreamId': o.multidatastreamId if isinstance(o, MultiObservation) else None,
+                'phenomenonTime': o.phenomenonTime,
+                'result': result,
+                'parameters': o.parameters}
+
+    def write(self, observations):
+        """Append observations to the file of the day, reading them one at a time from the
+        iterable so that they are never all held in memory.
+
+        :return: Number of observations archived
+        """
+        observations = iter(observations)
+        first = next(observations, None)
+        if first is None:
+            return 0
+        path = self.path_for(datetime.now(timezone.utc))
+        is_new = not os.path.exists(path)
+        n = 0
+        with self._open(path) as f:
+            if self.format == CFG_SPOOLER_ARCHIVE_FORMAT_CSV:
+                writer = csv.writer(f)
+                if is_new:
+                    writer.writerow(self.CSV_FIELDS)
+            for o in itertools.chain([first], observations):
+                record = self._to_record(o)
+                if self.format == CFG_SPOOLER_ARCHIVE_FORMAT_CSV:
+                    # MultiObservation results and parameters are JSON within the CSV field
+                    writer.writerow([json.dumps(record[k]) if isinstance(record[k], (list, dict)) else record[k]
+                                     for k in self.CSV_FIELDS])
+                else:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                n += 1
+        if self.max_bytes is not None:
+            self._enforce_max_bytes(path)
+        return n
+
+    @staticmethod
+    def _from_record(record):
+        if record['multidatastreamId'] is not None:
+            o = MultiObservation()
+            o.multidatastreamId = record['multidatastreamId']
+            o.result = [math.nan if r is None else r for r in record['result']]
+        else:
+            o = Observation()
+            o.datastreamId = record['datastreamId']
+            o.result = record['result']
+        o.id = record['id']
+        o.featureOfInterestId = record['featureOfInterestId']
+        o.phenomenonTime = record['phenomenonTime']
+        o.parameters = record['parameters']
+        return o
+
+    def _iter_records(self, path, needle):
+        """Generator of the records of an archive file that contain needle"""
+        with gzip.open(path, 'rt', newline='') if self.compression != CFG_SPOOLER_ARCHIVE_COMPRESSION_ZSTD \
+                else self._open_zstd(path) as f:
+            if self.format == CFG_SPOOLER_ARCHIVE_FORMAT_CSV:
+                for row in csv.DictReader(f):
+                    if needle not in row['datastreamId'] and needle not in row['multidatastreamId']:
+                        continue
+                    record = {k: (v if v != '' else None) for (k, v) in row.items()}
+                    record['id'] = int(record['id'])
+                    if record['multidatastreamId'] is not None:
+                        record['result'] = json.loads(record['result'])
+                    record['parameters'] = json.loads(record['parameters']) if record['parameters'] else {}
+                    yield record
+            else:
+                needle = json.dumps(needle)
+                for line in f:
+                    # Only parse lines that may be of the datastream
+                    if needle in line:
+                        yield json.loads(line)
+
+    @staticmethod
+    def _open_zstd(path):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True),
+                                encoding='utf-8', newline='')
+
+    def query(self, datastream_id, start=None, end=None, limit=None):
+        """Generator of (phenomenon time, observation) for the archived observations of a
+        datastream or multidatastream.  Matches are sorted by time one file at a time, so
+        they are in order of time unless observations were delivered out of order.  Files
+        are read one at a time, and at most limit matches of a file are kept in memory.
+        Matches of a file with the same time, i.e. archived twice, are yielded once.
+
+        :param start: Earliest phenomenon time, in microseconds since the epoch, or None
+        :param end: Phenomenon time to stop before, in microseconds since the epoch, or None
+        :param limit: Maximum number of observations, or None
+        """
+        # Avoid circular imports
+        from sensors.persistence.sqlite import SqliteRepository
+        if limit is not None and limit <= 0:
+            return
+        first_file = None
+        if start is not None:
+            # Observations are archived after they were made, so older files can be skipped
+            first_file = self.path_for(SqliteRepository.EPOCH + start * SqliteRepository.MICROSECOND)
+        n = 0
+        last = None
+        for path in self.files():
+            if first_file is not None and path < first_file:
+                continue
+            matches = self._query_file(path, datastream_id, start, end)
+            if limit is None:
+                matches = [next(g) for (t, g) in itertools.groupby(sorted(matches, key=lambda m: m[0]),
+                                                                    key=lambda m: m[0])]
+            else:
+                matches = self._earliest(matches, limit - n)
+            for (t, record) in matches:
+                yield (t, self._from_record(record))
+                # Copies in different files are dropped by SqliteRepository._merge_by_time()
+                if t != last:
+                    n += 1
+                last = t
+            if limit is not None and n >= limit:
+                return
+
+    @staticmethod
+    def _earliest(matches, k):
+        """The matches with the k earliest distinct times, in order of time, keeping no more
+        than k of them in memory"""
+        selected = {}
+        # Times of the selected matches, negated so that the latest is at the top
+        heap = []
+        for (t, record) in matches:
+            if t in selected:
+                continue
+            if len(heap) < k:
+                heapq.heappush(heap, -t)
+            elif t < -heap[0]:
+                del selected[-heapq.heappushpop(heap, -t)]
+            else:
+                continue
+            selected[t] = record
+        return sorted(selected.items(), key=lambda m: m[0])
+
+    def _query_file(self, path, datastream_id, start, end):
+        """Generator of (phenomenon time, record) for the matches of query() in an archive file"""
+        # Avoid circular imports
+        from sensors.persistence.sqlite import SqliteRepository
+        for record in self._iter_records(path, datastream_id):
+            if datastream_id not in (record['datastreamId'], record['multidatastreamId']):
+                continue
+            t = SqliteRepository._encode_phenomenon_time(record['phenomenonTime'])
+            if not isinstance(t, int) or (start is not None and t < start) or (end is not None and t >= end):
+                continue
+            yield (t, record)
+
+    def _enforce_max_bytes(self, current_path):
+        files = self.files()
+        sizes = [os.path.getsize(f) for f in files]
+        total = sum(sizes)
+        for (f, size) in zip(files, sizes):
+            if total <= self.max_bytes or f == current_path:
+                break
+            os.unlink(f)
+            total -= size
+            self.logger.warn("Spooler: deleted archive {0} to keep archive within archive_max_bytes.".format(f))
@@ -0,0 +1,364 @@
+import json
+import zlib
+import heapq
+from datetime import datetime, timedelta, timezone
+
+from sensors.common.constants import CFG_SPOOLER_BLOCK_SIZE
+from sensors.persistence.sqlite import SqliteRepository
+from sensors.persistence import gorilla, sort_by_datastream
+
+
+class BlockSqliteRepository(SqliteRepository):
+    """SQLite spool that packs runs of pending observations into compressed blocks.
+
+    Once a datastream has block_size pending observations, the oldest of them are removed
+    from the observation table and stored as a single row of the observation_block table:
+    ids and phenomenon times delta-of-delta encoded, results XOR encoded (see gorilla), and
+    parameters as zlib-compressed JSON.  Blocks are only decoded when observations are read
+    from them, and are rewritten without the observations that have been delivered.
+
+    Only observations whose phenomenon time was stored as an integer and whose result is
+    a float (for Observations) can be packed, others stay in the observation table.
+
+    The (datastreamId, phenomenonTime) of packed observations are kept in the
+    observation_block_key table, and a trigger drops observations inserted with one of them,
+    so duplicates are ignored whether the observation they duplicate is packed or not.
+    """
+
+    SQL_CREATE_BLOCK_TABLE = '''CREATE TABLE IF NOT EXISTS observation_block
+    (id INTEGER PRIMARY KEY,
+    featureOfInterestId TEXT,
+    datastreamId TEXT NOT NULL,
+    is_multiobservation INTEGER NOT NULL,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    last_time INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    parameters BLOB NOT NULL)
+    '''
+    SQL_CREATE_BLOCK_IDX = "CREATE INDEX IF NOT EXISTS observation_block_first_id_idx ON observation_block (first_id)"
+    SQL_CREATE_BLOCK_KEY_TABLE = '''CREATE TABLE IF NOT EXISTS observation_block_key
+    (datastreamId TEXT NOT NULL,
+    phenomenonTime INTEGER NOT NULL,
+    block_id INTEGER NOT NULL,
+    PRIMARY KEY (datastreamId, phenomenonTime)) WITHOUT ROWID
+    '''
+    SQL_CREATE_BLOCK_KEY_IDX = ("CREATE INDEX IF NOT EXISTS observation_block_key_block_idx "
+                                "ON observation_block_key (block_id)")
+    # Extends the unique index on (datastreamId, phenomenonTime) of observation to packed observations
+    SQL_CREATE_BLOCK_KEY_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS observation_block_key_insert
+    BEFORE INSERT ON observation
+    WHEN EXISTS (SELECT 1 FROM observation_block_key
+                 WHERE datastreamId = NEW.datastreamId AND phenomenonTime = NEW.phenomenonTime)
+    BEGIN
+        SELECT RAISE(IGNORE);
+    END
+    '''
+    SQL_CREATE_BLOCK_KEY = ("INSERT OR IGNORE INTO observation_block_key (datastreamId, phenomenonTime, block_id) "
+                            "VALUES (?, ?, ?)")
+    SQL_DELETE_BLOCK_KEY = "DELETE FROM observation_block_key WHERE datastreamId = ? AND phenomenonTime = ?"
+    SQL_DELETE_BLOCK_KEYS = "DELETE FROM observation_block_key WHERE block_id = ?"
+    SQL_DELETE_EXPIRED_BLOCK_KEYS = ("DELETE FROM observation_block_key WHERE block_id IN "
+                                     "(SELECT id FROM observation_block WHERE last_time < ?)")
+    SQL_CREATE_BLOCK = ("INSERT INTO observation_block (featureOfInterestId, datastreamId, is_multiobservation, "
+                        "first_id, last_id, last_time, count, data, parameters) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    SQL_UPDATE_BLOCK = ("UPDATE observation_block "
+                        "SET first_id=?, last_id=?, last_time=?, count=?, data=?, parameters=? WHERE id=?")
+    SQL_DELETE_BLOCK = "DELETE FROM observation_block WHERE id=?"
+    SQL_GET_BLOCKS = "SELECT * FROM observation_block ORDER BY first_id"
+    SQL_GET_BLOCKS_AFTER = "SELECT * FROM observation_block WHERE last_id > ? ORDER BY first_id"
+    SQL_GET_BLOCKS_IN_RANGE = "SELECT * FROM observation_block WHERE first_id <= ? AND last_id >= ?"
+    SQL_GET_BLOCKS_UP_TO = "SELECT * FROM observation_block WHERE first_id <= ?"
+    SQL_GET_BLOCK_OBS_COUNT = "SELECT total(count) FROM observation_block"
+    SQL_GET_BLOCK_STATS = ("SELECT datastreamId, total(count), max(last_time) FROM observation_block "
+                           "GROUP BY datastreamId")
+    SQL_GET_FIRST_BLOCK_DATA = "SELECT data FROM observation_block WHERE datastreamId = ? ORDER BY first_id LIMIT 1"
+    SQL_QUERY_BLOCKS = "SELECT * FROM observation_block WHERE datastreamId = ? AND last_time >= ? ORDER BY first_id"
+    SQL_GET_OLDEST_BLOCK = "SELECT id, first_id, count FROM observation_block ORDER BY first_id LIMIT 1"
+    SQL_GET_OLDEST_OBS_ID = "SELECT min(id) FROM observation"
+    SQL_GET_EXPIRED_BLOCK_OBS_COUNT = "SELECT total(count) FROM observation_block WHERE last_time < ?"
+    SQL_EVICT_EXPIRED_BLOCKS = "DELETE FROM observation_block WHERE last_time < ?"
+    SQL_GET_PACKABLE_GROUPS = ("SELECT featureOfInterestId, datastreamId, is_multiobservation FROM observation "
+                               "WHERE status='PENDING' "
+                               "GROUP BY featureOfInterestId, datastreamId, is_multiobservation HAVING count(*) >= ?")
+    SQL_GET_GROUP_OBS = ("SELECT * FROM observation WHERE status='PENDING' AND featureOfInterestId IS ? "
+                         "AND datastreamId = ? AND is_multiobservation = ? ORDER BY id LIMIT ?")
+    # An observation re-spooled before its duplicate was packed is kept rather than the packed one
+    SQL_UNPACK_OBS = ("INSERT OR IGNORE INTO observation "
+                      "(id, featureOfInterestId, datastreamId, phenomenonTime, result, parameters, status, "
+                      "is_multiobservation) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+    # Columns of observation_block
+    (BLOCK_ID, BLOCK_FOI_ID, BLOCK_DATASTREAM_ID, BLOCK_IS_MULTI, BLOCK_FIRST_ID, BLOCK_LAST_ID,
+     BLOCK_LAST_TIME, BLOCK_COUNT, BLOCK_DATA, BLOCK_PARAMETERS) = range(10)
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.block_size = config[CFG_SPOOLER_BLOCK_SIZE]
+        self._created_since_packing = 0
+        self._perform_action_with_connection(BlockSqliteRepository._create_block_table)
+
+    @staticmethod
+    def _create_block_table(conn):
+        cls = BlockSqliteRepository
+        conn.execute("BEGIN IMMEDIATE")
+        has_keys = conn.execute(SqliteRepository.SQL_TABLE_EXISTS, ('observation_block_key',)).fetchone() is not None
+        conn.execute(cls.SQL_CREATE_BLOCK_TABLE)
+        conn.execute(cls.SQL_CREATE_BLOCK_IDX)
+        conn.execute(cls.SQL_CREATE_BLOCK_KEY_TABLE)
+        conn.execute(cls.SQL_CREATE_BLOCK_KEY_IDX)
+        conn.execute(cls.SQL_CREATE_BLOCK_KEY_TRIGGER)
+        if not has_keys:
+            # Blocks packed before keys were kept
+            for block in conn.execute(cls.SQL_GET_BLOCKS).fetchall():
+                conn.executemany(cls.SQL_CREATE_BLOCK_KEY, [(r[2], r[3], block[cls.BLOCK_ID])
+                                                            for r in cls._iter_block_rows(block)])
+
+    # Encoding
+
+    @staticmethod
+    def _get_values(row):
+        """Results of an observation row as a tuple of floats, or None if they can't be packed
+        without changing how they read back"""
+        result = row[4]
+        if row[7]:
+            return tuple(SqliteRepository._unpack_results(result))
+        try:
+            value = float(result)
+        except (TypeError, ValueError):
+            return None
+        return (value,) if repr(value) == result else None
+
+    @staticmethod
+    def _is_packable(row):
+        return isinstance(row[3], int) and BlockSqliteRepository._get_values(row) is not None
+
+    @staticmethod
+    def _encode_rows(rows):
+        """Columns of observation_block, from first_id on, for observation rows of one datastream"""
+        data = gorilla.encode_block([r[0] for r in rows], [r[3] for r in rows],
+                                    [BlockSqliteRepository._get_values(r) for r in rows])
+        parameters = zlib.compress(json.dumps([r[5] for r in rows], separators=(',', ':')).encode('utf-8'))
+        return (rows[0][0], rows[-1][0], max([r[3] for r in rows]), len(rows), data, parameters)
+
+    @staticmethod
+    def _iter_block_rows(block):
+        """Generator yielding the observation rows packed in a block, decoding it as it goes"""
+        cls = BlockSqliteRepository
+        parameters = json.loads(zlib.decompress(block[cls.BLOCK_PARAMETERS]).decode('utf-8'))
+        is_multiobservation = block[cls.BLOCK_IS_MULTI]
+        for ((obs_id, phenomenon_time, values), p) in zip(gorilla.decode_block(block[cls.BLOCK_DATA]), parameters):
+            if is_multiobservation:
+                result = SqliteRepository._pack_results(values)
+            else:
+                result = repr(values[0])
+            yield (obs_id, block[cls.BLOCK_FOI_ID], block[cls.BLOCK_DATASTREAM_ID], phenomenon_time, result, p,
+                   SqliteRepository.STATUS_PENDING, is_multiobservation)
+
+    # Packing
+
+    def create_observation(self, o):
+        self.create_observations([o])
+
+    def create_multiobservation(self, mo):
+        self.create_observations([mo])
+
+    def create_observations(self, observations):
+        created = super().create_observations(observations)
+        self._created_since_packing += len(created)
+        if self._created_since_packing >= self.block_size:
+            self._created_since_packing = 0
+            self.pack_observations()
+        return created
+
+    def pack_observations(self):
+        """Pack the oldest pending observations of every datastream that has at least
+        block_size of them into blocks.
+
+        :return: Number of observations packed
+        """
+        def pack(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            packed = 0
+            groups = conn.execute(BlockSqliteRepository.SQL_GET_PACKABLE_GROUPS, (self.block_size,)).fetchall()
+            for (foi_id, datastream_id, is_multiobservation) in groups:
+                rows = conn.execute(BlockSqliteRepository.SQL_GET_GROUP_OBS,
+                                    (foi_id, datastream_id, is_multiobservation, self.block_size)).fetchall()
+                rows = [r for r in rows if self._is_packable(r)]
+                if is_multiobservation and len(rows) > 0:
+                    # All results of a block must have the same number of components
+                    rows = [r for r in rows if len(r[4]) == len(rows[0][4])]
+                if len(rows) < 2:
+                    continue
+                block_id = conn.execute(BlockSqliteRepository.SQL_CREATE_BLOCK,
+                                        (foi_id, datastream_id, is_multiobservation) +
+                                        self._encode_rows(rows)).lastrowid
+                conn.executemany(BlockSqliteRepository.SQL_CREATE_BLOCK_KEY, [(r[2], r[3], block_id) for r in rows])
+                conn.executemany(SqliteRepository.SQL_DELETE_OBS_BY_ID, [(r[0],) for r in rows])
+                packed += len(rows)
+            return packed
+
+        packed = self._perform_action_with_connection(pack)
+        if packed > 0:
+            self.logger.debug("Spooler: packed {0} observations into blocks.".format(packed))
+        return packed
+
+    def _remove_from_blocks(self, conn, ids=None, up_to_id=None, unpack=False):
+        """Remove observations from the blocks they are packed in, rewriting or deleting the blocks.
+
+        :param ids: Ids of the observations to remove
+        :param up_to_id: Alternatively, remove all observations with an id up to this one
+        :param unpack: Whether to move the observations to the observation table
+        :return: Rows of the observations removed
+        """
+        removed_rows = []
+        if ids is not None:
+            if len(ids) == 0:
+                return removed_rows
+            ids = set(ids)
+            blocks = conn.execute(BlockSqliteRepository.SQL_GET_BLOCKS_IN_RANGE, (max(ids), min(ids))).fetchall()
+        else:
+            blocks = conn.execute(BlockSqliteRepository.SQL_GET_BLOCKS_UP_TO, (up_to_id,)).fetchall()
+        for block in blocks:
+            keep = []
+            removed = []
+            for row in self._iter_block_rows(block):
+                if (ids is not None and row[0] in ids) or (up_to_id is not None and row[0] <= up_to_id):
+                    removed.append(row)
+                else:
+                    keep.append(row)
+            if len(removed) == 0:
+                continue
+            removed_rows.extend(removed)
+            conn.executemany(BlockSqliteRepository.SQL_DELETE_BLOCK_KEY, [(r[2], r[3]) for r in removed])
+            if unpack:
+                conn.executemany(BlockSqliteRepository.SQL_UNPACK_OBS, removed)
+            if len(keep) == 0:
+                conn.execute(BlockSqliteRepository.SQL_DELETE_BLOCK, (block[BlockSqliteRepository.BLOCK_ID],))
+            else:
+                conn.execute(BlockSqliteRepository.SQL_UPDATE_BLOCK,
+                             self._encode_rows(keep) + (block[BlockSqliteRepository.BLOCK_ID],))
+        return removed_rows
+
+    # Reading and acknowledgement
+
+    def get_observations(self, limit="360", after_id=0, transport=None):
+        limit = int(limit)
+        observations = super().get_observations(limit=limit, after_id=after_id, transport=transport)
+        if observations is None:
+            return None
+        conn = self._get_connection()
+        if transport is not None:
+            after_id = max(after_id, self._get_transport_cursor(conn, transport))
+        for block in conn.execute(BlockSqliteRepository.SQL_GET_BLOCKS_AFTER, (after_id,)):
+            if len(observations) >= limit and block[BlockSqliteRepository.BLOCK_FIRST_ID] > observations[-1].id:
+                # Neither this block nor any later one holds observations among the oldest limit
+                break
+            observations.extend([self._get_observation_from_row(r) for r in self._iter_block_rows(block)
+                                 if r[0] > after_id])
+            observations.sort(key=lambda o: o.id)
+            del observations[limit:]
+        return observations
+
+    def get_all_observations(self):
+        observations = super().get_all_observations()
+        for block in self._get_connection().execute(BlockSqliteRepository.SQL_GET_BLOCKS):
+            observations.extend([self._get_observation_from_row(r) for r in self._iter_block_rows(block)])
+        observations.sort(key=lambda o: o.id)
+        return observations
+
+    def get_observation_count(self):
+        conn = self._get_connection()
+        return super().get_observation_count() + \
+            int(conn.execute(BlockSqliteRepository.SQL_GET_BLOCK_OBS_COUNT).fetchone()[0])
+
+    def _stats(self):
+        # Packed observations are pending, and within a datastream are packed in time order
+        stats = super()._stats()
+        conn = self._get_connection()
+        times = [stats['oldest_phenomenon_time'], stats['newest_phenomenon_time']]
+        for (datastream_id, count, last_time) in conn.execute(BlockSqliteRepository.SQL_GET_BLOCK_STATS).fetchall():
+            counts = stats['by_datastream'].setdefault(datastream_id, {})
+            counts[SqliteRepository.STATUS_PENDING] = counts.get(SqliteRepository.STATUS_PENDING, 0) + int(count)
+            data = conn.execute(BlockSqliteRepository.SQL_GET_FIRST_BLOCK_DATA, (datastream_id,)).fetchone()[0]
+            # Only the first sample of the block is decoded
+            times.extend([next(gorilla.decode_block(data))[1], last_time])
+        stats.update(self._time_range(times))
+        return self._summarize_stats(stats)
+
+    def _query_spool(self, datastream_id, start, end):
+        return heapq.merge(super()._query_spool(datastream_id, start, end),
+                           self._query_blocks(datastream_id, start, end), key=lambda s: s[0])
+
+    def _query_blocks(self, datastream_id, start, end):
+        start = self.MIN_TIME if start is None else start
+        end = self.MAX_TIME if end is None else end
+        # Blocks that ended before start are not decoded at all
+        for block in self._get_connection().execute(BlockSqliteRepository.SQL_QUERY_BLOCKS, (datastream_id, start)):
+            for r in self._iter_block_rows(block):
+                if start <= r[3] < end:
+                    yield (r[3], self._get_observation_from_row(r))
+
+    def get_observations_by_datastream(self, limit="360", after_id=0, transport=None):
+        return sort_by_datastream(self.get_observations(limit=limit, after_id=after_id, transport=transport))
+
+    def delete_observations(self, ids, transport=None):
+        super().delete_observations(ids, transport=transport)
+        if transport is None:
+            self._perform_action_with_connection(lambda c: self._archive_rows(self._remove_from_blocks(c, ids=ids)))
+        else:
+            self._remove_delivered_from_blocks(transport)
+
+    def update_observation_status(self, ids, status=SqliteRepository.STATUS_ERROR, transport=None):
+        # Only observations in the observation table have a status
+        self._perform_action_with_connection(lambda c: self._remove_from_blocks(c, ids=ids, unpack=True))
+        super().update_observation_status(ids, status=status, transport=transport)
+        if transport is not None:
+            self._remove_delivered_from_blocks(transport)
+
+    def _remove_delivered_from_blocks(self, transport):
+        # Packed observations are archived as they are delivered, rather than when compacting
+        self._perform_action_with_connection(lambda c: self._archive_rows(
+            self._remove_from_blocks(c, up_to_id=self._get_delivered_id(c, transport))))
+
+    def _prepare_claim(self, conn, after_id, limit):
+        """Unpack the blocks that hold observations among the oldest limit pending ones after
+        after_id, as only observations in the observation table can be claimed"""
+        oldest_ids = [r[0] for r in conn.execute(SqliteRepository.SQL_GET_OBS_TO_CLAIM, (after_id, limit))]
+        ids = []
+        for block in conn.execute(BlockSqliteRepository.SQL_GET_BLOCKS_AFTER, (after_id,)).fetchall():
+            if len(oldest_ids) >= limit and block[BlockSqliteRepository.BLOCK_FIRST_ID] > oldest_ids[-1]:
+                break
+            block_ids = [r[0] for r in self._iter_block_rows(block) if r[0] > after_id]
+            ids.extend(block_ids)
+            oldest_ids = sorted(oldest_ids + block_ids)[:limit]
+        self._remove_from_blocks(conn, ids=ids, unpack=True)
+
+    # Spool budget
+
+    def enforce_spool_budget(self):
+        evicted = 0
+        if self.max_age_hours is not None:
+            cutoff = datetime.now(timezone.utc) - timedelta(hours=self.max_age_hours)
+            cutoff_time = (cutoff - SqliteRepository.EPOCH) // SqliteRepository.MICROSECOND
+            conn = self._get_connection()
+            with conn:
+                evicted = int(conn.execute(BlockSqliteRepository.SQL_GET_EXPIRED_BLOCK_OBS_COUNT,
+                                           (cutoff_time,)).fetchone()[0])
+                conn.execute(BlockSqliteRepository.SQL_DELETE_EXPIRED_BLOCK_KEYS, (cutoff_time,))
+                conn.execute(BlockSqliteRepository.SQL_EVICT_EXPIRED_BLOCKS, (cutoff_time,))
+            if evicted > 0:
+                self.logger.warn("Spooler: evicted {0} packed observations past max_age_hours.".format(evicted))
+        return evicted + super().enforce_spool_budget()
+
+    def _evict(self, conn):
+        """Evict the oldest block, if it is older than the oldest observation that isn't packed"""
+        block = conn.execute(BlockSqliteRepository.SQL_GET_OLDEST_BLOCK).fetchone()
+        if block is not None:
+            oldest_id = conn.execute(BlockSqliteRepository.SQL_GET_OLDEST_OBS_ID).fetchone()[0]
+            if oldest_id is None or block[1] < oldest_id:
+                conn.execute(BlockSqliteRepository.SQL_DELETE_BLOCK_KEYS, (block[0],))
+                conn.execute(BlockSqliteRepository.SQL_DELETE_BLOCK, (block[0],))
+                return block[2]
+        return super()._evict(conn)
@@ -0,0 +1,110 @@
+import time
+
+from sensors.common.constants import CFG_SPOOLER_FLUSH_INTERVAL_SEC, CFG_SPOOLER_FLUSH_MAX_OBS
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.common import logging
+
+
+class BufferedRepository:
+    """Holds new observations in memory and writes them to another repository in one
+    transaction once flush_interval_seconds have passed since the oldest was buffered, once
+    flush_max_observations are buffered, or on close().  Observations written within this
+    "durability window" are lost if the process dies without closing the repository.
+
+    Only writes are buffered.  The transmitter runs in its own process and reads the
+    repository, so observations are only read once they have been flushed.  Methods not
+    defined here are those of the repository.
+    """
+
+    def __init__(self, repo, config):
+        self.repo = repo
+        self.flush_interval_seconds = config[CFG_SPOOLER_FLUSH_INTERVAL_SEC]
+        self.flush_max_observations = config[CFG_SPOOLER_FLUSH_MAX_OBS]
+        # Buffered observations, in the order they were created
+        self.buffer = []
+        self._oldest_buffered = None
+        self.max_buffered = 0
+        self.flushes = 0
+        self.flushed_observations = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self.logger = logging.get_instance()
+
+    def __getattr__(self, name):
+        if name == 'repo':
+            raise AttributeError(name)
+        return getattr(self.repo, name)
+
+    def create_observation(self, o):
+        self.create_observations([o])
+
+    def create_multiobservation(self, mo):
+        self.create_observations([mo])
+
+    def create_observations(self, observations):
+        """Buffer observations, flushing the buffer if it is due.  Call with no observations to
+        flush a buffer whose flush_interval_seconds have passed.
+
+        :return: List of the observations stored by a flush, if one was due
+        """
+        observations = list(observations)
+        for o in observations:
+            if not isinstance(o, (Observation, MultiObservation)):
+                raise TypeError("Observation of type {0} is unknown".format(o.__class__.__name__))
+        self.buffer.extend(observations)
+        if len(self.buffer) > 0 and self._oldest_buffered is None:
+            self._oldest_buffered = time.monotonic()
+        self.max_buffered = max(self.max_buffered, len(self.buffer))
+        if len(self.buffer) >= self.flush_max_observations or self.seconds_until_flush() == 0:
+            return self.flush()
+        return []
+
+    def seconds_until_flush(self):
+        """Seconds until the buffer is due to be flushed, or None if it is empty"""
+        if self._oldest_buffered is None:
+            return None
+        return max(self._oldest_buffered + self.flush_interval_seconds - time.monotonic(), 0)
+
+    def flush(self):
+        """Write all buffered observations to the repository
+
+        :return: List of the observations stored, see create_observations() of the repository
+        """
+        if len(self.buffer) == 0:
+            return []
+        observations = self.buffer
+        start = time.monotonic()
+        created = self.repo.create_observations(observations)
+        elapsed = time.monotonic() - start
+        self.buffer = []
+        self._oldest_buffered = None
+        self.flushes += 1
+        self.flushed_observations += len(observations)
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        self.total_flush_seconds += elapsed
+        self.logger.debug("Spooler: flushed {0} buffered observations in {1:.3f} seconds.".
+                          format(len(observations), elapsed))
+        return created
+
+    def get_buffer_stats(self):
+        """Occupancy of the buffer and latency of flushes, in seconds"""
+        return {'buffered': len(self.buffer),
+                'max_buffered': self.max_buffered,
+                'flushes': self.flushes,
+                'flushed_observations': self.flushed_observations,
+                'last_flush_seconds': self.last_flush_seconds,
+                'max_flush_seconds': self.max_flush_seconds,
+                'mean_flush_seconds': self.total_flush_seconds / self.flushes if self.flushes > 0 else 0.0}
+
+    def stats(self):
+        """Statistics of the repository, plus the number of observations not yet flushed to it"""
+        stats = self.repo.stats()
+        stats['buffered'] = len(self.buffer)
+        return stats
+
+    def close(self):
+        self.flush()
+        self.repo.close()
@@ -0,0 +1,49 @@
+import os
+import sys
+import argparse
+from datetime import datetime, timezone
+
+from sensors.common.logging import configure_logger
+from sensors.config import Config
+from sensors.common.constants import *
+from sensors.domain.multiobservation import MultiObservation
+from sensors.persistence import get_repository_instance
+
+CMD_LIST = 'list'
+CMD_REQUEUE = 'requeue'
+CMD_PURGE = 'purge'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List, requeue or purge observations that were given up on')
+    parser.add_argument('-c', '--config', type=str, required=False)
+    parser.add_argument('command', choices=(CMD_LIST, CMD_REQUEUE, CMD_PURGE))
+    parser.add_argument('ids', type=int, nargs='*',
+                        help='Ids of the dead letters to requeue or purge, all of them if none are given')
+    args = parser.parse_args()
+
+    if args.config is not None:
+        assert (os.path.exists(args.config))
+        os.environ[ENV_YAML_PATH] = args.config
+
+    config = Config().config
+    configure_logger(config)
+    repo = get_repository_instance(config)
+    if not hasattr(repo, 'get_dead_letters'):
+        sys.exit("Spooler backend {0} does not keep dead letters.".format(config[CFG_SPOOLER_BACKEND]))
+
+    ids = args.ids if len(args.ids) > 0 else None
+    if args.command == CMD_LIST:
+        for (o, attempts, dead_since) in repo.get_dead_letters():
+            if ids is not None and o.id not in ids:
+                continue
+            datastream_id = o.multidatastreamId if isinstance(o, MultiObservation) else o.datastreamId
+            print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}".format(o.id, datastream_id, o.phenomenonTime, o.result, attempts,
+                                                        datetime.fromtimestamp(dead_since, timezone.utc).isoformat()))
+    elif args.command == CMD_REQUEUE:
+        if not hasattr(repo, 'requeue_dead_letters'):
+            sys.exit("Spooler backend {0} can't requeue dead letters.".format(config[CFG_SPOOLER_BACKEND]))
+        print("Requeued {0} dead letters.".format(repo.requeue_dead_letters(ids)))
+    else:
+        print("Purged {0} dead letters.".format(repo.purge_dead_letters(ids)))
+    repo.close()
@@ -0,0 +1,224 @@
+"""Gorilla-style compression of time series, after Pelkonen et al., "Gorilla: A Fast, Scalable,
+In-Memory Time Series Database", VLDB 2015.
+
+Integer series (timestamps and ids) are stored as delta-of-deltas, which are 0 for regularly
+spaced samples, and float series as the XOR of each value with the previous one, which has
+few meaningful bits for slowly changing readings.
+"""
+import struct
+
+HEADER = struct.Struct('<IB')
+FLOAT = struct.Struct('<d')
+UINT64 = struct.Struct('<Q')
+
+WORD_BITS = 64
+WORD_MASK = (1 << WORD_BITS) - 1
+
+# (Control bits, control bit count, value bit count) for delta-of-deltas.  The ranges are wider
+#   than in the paper, as timestamps are in microseconds and readings are not exactly periodic.
+DOD_BUCKETS = ((0b10, 2, 7),
+               (0b110, 3, 12),
+               (0b1110, 4, 20),
+               (0b11110, 5, 32),
+               (0b11111, 5, 64))
+
+LEADING_ZEROS_BITS = 5
+MAX_LEADING_ZEROS = (1 << LEADING_ZEROS_BITS) - 1
+MEANINGFUL_BITS_BITS = 6
+
+
+class BitWriter:
+
+    def __init__(self):
+        self._bytes = bytearray()
+        self._acc = 0
+        self._nbits = 0
+
+    def write(self, value, nbits):
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._nbits += nbits
+        while self._nbits >= 8:
+            self._nbits -= 8
+            self._bytes.append((self._acc >> self._nbits) & 0xff)
+        self._acc &= (1 << self._nbits) - 1
+
+    def getvalue(self):
+        if self._nbits == 0:
+            return bytes(self._bytes)
+        return bytes(self._bytes) + bytes([(self._acc << (8 - self._nbits)) & 0xff])
+
+
+class BitReader:
+
+    def __init__(self, data, offset=0):
+        self._data = data
+        self._pos = offset * 8
+
+    def read(self, nbits):
+        if nbits == 0:
+            return 0
+        start = self._pos // 8
+        end = (self._pos + nbits + 7) // 8
+        chunk = int.from_bytes(self._data[start:end], 'big')
+        self._pos += nbits
+        return (chunk >> (end * 8 - self._pos)) & ((1 << nbits) - 1)
+
+    def read_ones(self, limit):
+        """Number of consecutive 1 bits, reading at most limit bits"""
+        n = 0
+        while n < limit and self.read(1) == 1:
+            n += 1
+        return n
+
+
+def _to_signed(value, nbits):
+    if value >= 1 << (nbits - 1):
+        value -= 1 << nbits
+    return value
+
+
+class DeltaOfDeltaEncoder:
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.count = 0
+        self.prev = 0
+        self.prev_delta = 0
+
+    def write(self, value):
+        if self.count == 0:
+            self.writer.write(value, WORD_BITS)
+        else:
+            delta = value - self.prev
+            dod = delta - self.prev_delta
+            if dod == 0:
+                self.writer.write(0, 1)
+            else:
+                for (control, control_bits, value_bits) in DOD_BUCKETS:
+                    if -(1 << (value_bits - 1)) <= dod < (1 << (value_bits - 1)):
+                        self.writer.write(control, control_bits)
+                        self.writer.write(dod, value_bits)
+                        break
+            self.prev_delta = delta
+        self.prev = value
+        self.count += 1
+
+
+class DeltaOfDeltaDecoder:
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.count = 0
+        self.prev = 0
+        self.prev_delta = 0
+
+    def read(self):
+        if self.count == 0:
+            value = _to_signed(self.reader.read(WORD_BITS), WORD_BITS)
+        else:
+            ones = self.reader.read_ones(len(DOD_BUCKETS))
+            if ones == 0:
+                dod = 0
+            else:
+                value_bits = DOD_BUCKETS[ones - 1][2]
+                dod = _to_signed(self.reader.read(value_bits), value_bits)
+            self.prev_delta += dod
+            value = self.prev + self.prev_delta
+        self.prev = value
+        self.count += 1
+        return value
+
+
+class XorEncoder:
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.count = 0
+        self.prev = 0
+        self.leading = None
+        self.trailing = None
+
+    def write(self, value):
+        bits = UINT64.unpack(FLOAT.pack(value))[0]
+        if self.count == 0:
+            self.writer.write(bits, WORD_BITS)
+        else:
+            xor = bits ^ self.prev
+            if xor == 0:
+                self.writer.write(0, 1)
+            else:
+                leading = min(WORD_BITS - xor.bit_length(), MAX_LEADING_ZEROS)
+                trailing = (xor & -xor).bit_length() - 1
+                if self.leading is not None and leading >= self.leading and trailing >= self.trailing:
+                    # Meaningful bits fit in the previous window
+                    self.writer.write(0b10, 2)
+                    self.writer.write(xor >> self.trailing, WORD_BITS - self.leading - self.trailing)
+                else:
+                    meaningful = WORD_BITS - leading - trailing
+                    self.writer.write(0b11, 2)
+                    self.writer.write(leading, LEADING_ZEROS_BITS)
+                    # 64 meaningful bits are written as 0
+                    self.writer.write(meaningful, MEANINGFUL_BITS_BITS)
+                    self.writer.write(xor >> trailing, meaningful)
+                    self.leading = leading
+                    self.trailing = trailing
+        self.prev = bits
+        self.count += 1
+
+
+class XorDecoder:
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.count = 0
+        self.prev = 0
+        self.leading = None
+        self.trailing = None
+
+    def read(self):
+        if self.count == 0:
+            bits = self.reader.read(WORD_BITS)
+        elif self.reader.read(1) == 0:
+            bits = self.prev
+        else:
+            if self.reader.read(1) == 1:
+                self.leading = self.reader.read(LEADING_ZEROS_BITS)
+                meaningful = self.reader.read(MEANINGFUL_BITS_BITS) or WORD_BITS
+                self.trailing = WORD_BITS - self.leading - meaningful
+            meaningful = WORD_BITS - self.leading - self.trailing
+            bits = self.prev ^ (self.reader.read(meaningful) << self.trailing)
+        self.prev = bits
+        self.count += 1
+        return FLOAT.unpack(UINT64.pack(bits))[0]
+
+
+def encode_block(ids, times, values):
+    """Compress a run of samples.
+
+    :param ids: Ascending integer ids of the samples
+    :param times: Integer timestamps of the samples
+    :param values: Tuple of floats for each sample, all tuples being of the same length
+    :return: bytes
+    """
+    width = len(values[0]) if len(values) > 0 else 0
+    writer = BitWriter()
+    id_encoder = DeltaOfDeltaEncoder(writer)
+    time_encoder = DeltaOfDeltaEncoder(writer)
+    value_encoders = [XorEncoder(writer) for i in range(width)]
+    for (i, t, v) in zip(ids, times, values):
+        id_encoder.write(i)
+        time_encoder.write(t)
+        for (encoder, component) in zip(value_encoders, v):
+            encoder.write(component)
+    return HEADER.pack(len(ids), width) + writer.getvalue()
+
+
+def decode_block(data):
+    """Generator yielding (id, time, values) for each sample of a block created by encode_block()"""
+    (count, width) = HEADER.unpack_from(data)
+    reader = BitReader(data, HEADER.size)
+    id_decoder = DeltaOfDeltaDecoder(reader)
+    time_decoder = DeltaOfDeltaDecoder(reader)
+    value_decoders = [XorDecoder(reader) for i in range(width)]
+    for i in range(count):
+        yield (id_decoder.read(), time_decoder.read(), tuple([d.read() for d in value_decoders]))
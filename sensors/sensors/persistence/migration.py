@@ -0,0 +1,168 @@
+"""Versioned migrations of an SQLite database, keyed by PRAGMA user_version.
+
+Migrations are run in order of version, each in its own transaction which also sets
+user_version, so a migration interrupted by a crash or power loss is simply run again
+the next time the database is opened.  A ChunkedMigration instead rewrites a table a
+chunk of rows at a time, committing its progress along with each chunk: it resumes
+where it stopped, holds the write lock for one chunk at a time, and only needs free
+space for a chunk rather than for a copy of the table.
+
+An online ChunkedMigration is for changes the code can live with half-done: opening the
+database only starts it, and its chunks are run later, a few at a time, by
+run_online_migrations() while the database is in use.
+"""
+import time
+
+from sensors.common import logging
+
+SQL_CREATE_PROGRESS_TABLE = '''CREATE TABLE IF NOT EXISTS migration_progress
+(version INTEGER PRIMARY KEY,
+last_id INTEGER NOT NULL)
+'''
+SQL_GET_PROGRESS = "SELECT last_id FROM migration_progress WHERE version = ?"
+SQL_INIT_PROGRESS = "INSERT INTO migration_progress (version, last_id) VALUES (?, 0)"
+SQL_UPDATE_PROGRESS = "UPDATE migration_progress SET last_id = ? WHERE version = ?"
+SQL_DELETE_PROGRESS = "DELETE FROM migration_progress WHERE version = ?"
+SQL_PROGRESS_TABLE_EXISTS = "SELECT name FROM sqlite_master WHERE type='table' AND name='migration_progress'"
+SQL_GET_VERSIONS_IN_PROGRESS = "SELECT version FROM migration_progress ORDER BY version"
+
+
+class Migration:
+    """Migration to version, run(cursor) being called in a single transaction"""
+
+    def __init__(self, version, description, run):
+        self.version = version
+        self.description = description
+        self.run = run
+
+    def step(self, cursor, chunk_size):
+        """Migrate as much as fits in one transaction.
+
+        :return: True once the migration is complete
+        """
+        self.run(cursor)
+        return True
+
+
+class ChunkedMigration(Migration):
+    """Migration to version that goes through a table in chunks of rows.
+
+    prepare(cursor) is called once before the first chunk, and finish(cursor) in the same
+    transaction as the last.  run(cursor, after_id, chunk_size) migrates at most chunk_size
+    rows whose id is greater than after_id, returning the greatest id it migrated, or None
+    if there were no rows left.
+
+    If online, the version is set as soon as prepare() has run, and the chunks are left to
+    run_online_migrations().
+    """
+
+    def __init__(self, version, description, run, prepare=None, finish=None, online=False):
+        super().__init__(version, description, run)
+        self.prepare = prepare
+        self.finish = finish
+        self.online = online
+
+    def step(self, cursor, chunk_size):
+        cursor.execute(SQL_CREATE_PROGRESS_TABLE)
+        row = cursor.execute(SQL_GET_PROGRESS, (self.version,)).fetchone()
+        if row is None:
+            if self.prepare is not None:
+                self.prepare(cursor)
+            cursor.execute(SQL_INIT_PROGRESS, (self.version,))
+            after_id = 0
+        else:
+            after_id = row[0]
+        if self.online:
+            return True
+        return self.run_chunk(cursor, after_id, chunk_size)
+
+    def run_chunk(self, cursor, after_id, chunk_size):
+        """Migrate the chunk after after_id, or finish the migration if there is none left.
+
+        :return: True once the migration is complete
+        """
+        last_id = self.run(cursor, after_id, chunk_size)
+        if last_id is not None:
+            cursor.execute(SQL_UPDATE_PROGRESS, (last_id, self.version))
+            logging.get_instance().debug("Spooler: migrated spool up to id {0}.".format(last_id))
+            return False
+        if self.finish is not None:
+            self.finish(cursor)
+        cursor.execute(SQL_DELETE_PROGRESS, (self.version,))
+        return True
+
+
+def get_version(cursor):
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+
+def set_version(cursor, version):
+    cursor.execute("PRAGMA user_version = {0}".format(version))
+
+
+def get_versions_in_progress(conn):
+    """Versions of the chunked migrations that were started but are not complete"""
+    if conn.execute(SQL_PROGRESS_TABLE_EXISTS).fetchone() is None:
+        return []
+    return [r[0] for r in conn.execute(SQL_GET_VERSIONS_IN_PROGRESS)]
+
+
+def run_migrations(conn, migrations, chunk_size, before_step=None):
+    """Run the migrations whose version is above user_version, in order of version.
+
+    Several processes may open the database at the same time: each transaction takes the
+    write lock up front and re-reads user_version, so every step is run exactly once.
+
+    :param before_step: Optional function called with the cursor at the start of every
+      transaction that migrates
+    """
+    logger = logging.get_instance()
+    for migration in sorted(migrations, key=lambda m: m.version):
+        started = False
+        done = False
+        while not done:
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                if get_version(cursor) >= migration.version:
+                    break
+                if not started:
+                    logger.info("Spooler: migrating spool to schema version {0}: {1}".
+                                format(migration.version, migration.description))
+                    started = True
+                if before_step is not None:
+                    before_step(cursor)
+                done = migration.step(cursor, chunk_size)
+                if done:
+                    set_version(cursor, migration.version)
+                cursor.close()
+
+
+def run_online_migrations(conn, migrations, chunk_size, max_seconds=None):
+    """Run the chunks of the online migrations in progress, in order of version, each chunk in
+    its own transaction.
+
+    :param max_seconds: Stop after the chunk during which this many seconds have passed
+    :return: True once no online migration is in progress
+    """
+    versions = get_versions_in_progress(conn)
+    if len(versions) == 0:
+        return True
+    logger = logging.get_instance()
+    start = time.monotonic()
+    online = [m for m in migrations if m.version in versions and isinstance(m, ChunkedMigration) and m.online]
+    for migration in sorted(online, key=lambda m: m.version):
+        done = False
+        while not done:
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                # Another process may have completed the migration
+                row = cursor.execute(SQL_GET_PROGRESS, (migration.version,)).fetchone()
+                done = row is None or migration.run_chunk(cursor, row[0], chunk_size)
+                cursor.close()
+            if not done and max_seconds is not None and time.monotonic() - start >= max_seconds:
+                return False
+        logger.info("Spooler: completed migration to schema version {0}: {1}".
+                    format(migration.version, migration.description))
+    return True
@@ -0,0 +1,390 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from sensors.common.constants import (CFG_SPOOLER_DB_PATH, CFG_SPOOLER_PARTITION, CFG_SPOOLER_PARTITION_DAY,
+                                      CFG_SPOOLER_MAX_BYTES, CFG_SPOOLER_MAX_ROWS, CFG_SPOOLER_MAX_AGE_HOURS,
+                                      CFG_SPOOLER_ARCHIVE_PATH)
+from sensors.persistence.sqlite import SqliteRepository
+from sensors.persistence.archive import Archive
+from sensors.persistence import sort_by_datastream
+from sensors.common import logging
+
+
+class PartitionedSqliteRepository:
+    """Spool that writes to one SQLite file per hour or per day of ingest time.
+
+    Partitions are named after db_path, e.g. /var/spool/sensor-2018061014.sqlite, and each
+    is managed by its own SqliteRepository.  Observation ids handed out by this repository
+    encode the partition (hours since the epoch) in their upper bits, so that they stay
+    unique and ordered across partitions.  A partition that has been completely delivered,
+    or that is past retention, is dropped by unlinking its file.  Only the most recently used
+    partitions are kept open.
+    """
+
+    STATUS_PENDING = SqliteRepository.STATUS_PENDING
+    STATUS_ERROR = SqliteRepository.STATUS_ERROR
+    STATUS_IN_FLIGHT = SqliteRepository.STATUS_IN_FLIGHT
+
+    PARTITION_ID_SHIFT = 32
+    PARTITION_LOCAL_ID_MASK = (1 << PARTITION_ID_SHIFT) - 1
+    SECONDS_PER_HOUR = 3600
+    HOUR_TIMESTAMP_FMT = '%Y%m%d%H'
+    DAY_TIMESTAMP_FMT = '%Y%m%d'
+    SQLITE_SIDECAR_SUFFIXES = ('-wal', '-shm')
+    # A partition is not dropped until this many seconds after it stops receiving
+    #   observations, so that a spooler whose clock is slightly behind can finish writing to it.
+    DROP_GRACE_SECONDS = 60
+    MAX_OPEN_PARTITIONS = 4
+
+    def __init__(self, config):
+        self.config = config
+        self.hours_per_partition = 24 if config[CFG_SPOOLER_PARTITION] == CFG_SPOOLER_PARTITION_DAY else 1
+        self.timestamp_fmt = (self.DAY_TIMESTAMP_FMT if self.hours_per_partition == 24
+                              else self.HOUR_TIMESTAMP_FMT)
+        self.max_bytes = config[CFG_SPOOLER_MAX_BYTES]
+        self.max_rows = config[CFG_SPOOLER_MAX_ROWS]
+        self.max_age_hours = config[CFG_SPOOLER_MAX_AGE_HOURS]
+        # Partitions archive to the same files, this is only used to read them
+        self.archive = Archive(config) if config[CFG_SPOOLER_ARCHIVE_PATH] is not None else None
+
+        (root, self.ext) = os.path.splitext(config[CFG_SPOOLER_DB_PATH])
+        self.directory = os.path.dirname(root)
+        self.prefix = os.path.basename(root) + '-'
+        self.partition_re = re.compile('^' + re.escape(self.prefix) + r'(\d+)' + re.escape(self.ext) + '$')
+
+        # Open partitions, least recently used first
+        self.partitions = OrderedDict()
+        self.write_key = None
+        self.logger = logging.get_instance()
+
+    def _key_for_time(self, t):
+        hours = int(t // self.SECONDS_PER_HOUR)
+        return hours - (hours % self.hours_per_partition)
+
+    def _path_for_key(self, key):
+        start = datetime.fromtimestamp(key * self.SECONDS_PER_HOUR, timezone.utc)
+        return os.path.join(self.directory, self.prefix + start.strftime(self.timestamp_fmt) + self.ext)
+
+    def _key_for_path(self, filename):
+        m = self.partition_re.match(filename)
+        if m is None:
+            return None
+        try:
+            start = datetime.strptime(m.group(1), self.timestamp_fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None
+        return self._key_for_time(start.timestamp())
+
+    def partition_keys(self):
+        """Keys of partitions currently on disk, oldest first"""
+        keys = set()
+        for filename in os.listdir(self.directory):
+            key = self._key_for_path(filename)
+            if key is not None:
+                keys.add(key)
+        return sorted(keys)
+
+    def _open_partition(self, key):
+        # Budgets are enforced here, by dropping whole partitions
+        partition_config = dict(self.config)
+        partition_config[CFG_SPOOLER_DB_PATH] = self._path_for_key(key)
+        partition_config[CFG_SPOOLER_MAX_BYTES] = None
+        partition_config[CFG_SPOOLER_MAX_ROWS] = None
+        partition_config[CFG_SPOOLER_MAX_AGE_HOURS] = None
+        return SqliteRepository(partition_config)
+
+    def _get_partition(self, key, create=False):
+        """Open the partition of key, or return None if its file does not exist unless create is True,
+        so that ids of dropped partitions don't bring them back.
+        """
+        repo = self.partitions.get(key)
+        if repo is not None:
+            self.partitions.move_to_end(key)
+            return repo
+        if not create and not os.path.exists(self._path_for_key(key)):
+            return None
+        repo = self._open_partition(key)
+        self.partitions[key] = repo
+        while len(self.partitions) > self.MAX_OPEN_PARTITIONS:
+            self.partitions.popitem(last=False)[1].close()
+        return repo
+
+    def _live_partitions(self):
+        """(key, repository) of each partition on disk, oldest first"""
+        for key in self.partition_keys():
+            repo = self._get_partition(key)
+            # Another process may have dropped it since the directory was listed
+            if repo is not None:
+                yield (key, repo)
+
+    def _get_write_partition(self):
+        key = self._key_for_time(time.time())
+        if key != self.write_key:
+            # Don't hold on to the connection of a partition that won't be written to again
+            if self.write_key is not None and self.write_key in self.partitions:
+                self.partitions.pop(self.write_key).close()
+            self.write_key = key
+        return self._get_partition(key, create=True)
+
+    def _make_id(self, key, local_id):
+        return (key << self.PARTITION_ID_SHIFT) | local_id
+
+    def _split_id(self, obs_id):
+        return (obs_id >> self.PARTITION_ID_SHIFT, obs_id & self.PARTITION_LOCAL_ID_MASK)
+
+    def _ids_by_partition(self, ids):
+        ids_by_key = {}
+        for obs_id in ids:
+            (key, local_id) = self._split_id(obs_id)
+            ids_by_key.setdefault(key, []).append(local_id)
+        return ids_by_key
+
+    def _globalize_ids(self, key, observations):
+        for o in observations:
+            o.id = self._make_id(key, o.id)
+        return observations
+
+    def _is_closed(self, key, now):
+        return (key + self.hours_per_partition) * self.SECONDS_PER_HOUR + self.DROP_GRACE_SECONDS <= now
+
+    def _is_droppable(self, key, repo, now):
+        """Whether a partition is closed and holds nothing but delivered observations.  Observations
+        in ERROR (waiting for a retry) are counted, and dead letters are kept until they are
+        requeued or purged."""
+        return self._is_closed(key, now) and repo.get_observation_count() == 0 and not repo.has_dead_letters()
+
+    def drop_partition(self, key):
+        repo = self.partitions.pop(key, None)
+        if repo is not None:
+            repo.close()
+        path = self._path_for_key(key)
+        for p in [path] + [path + s for s in self.SQLITE_SIDECAR_SUFFIXES]:
+            try:
+                os.unlink(p)
+            except FileNotFoundError:
+                pass
+        self.logger.info("Spooler: dropped spool partition {0}".format(path))
+
+    def _partition_size(self, key):
+        path = self._path_for_key(key)
+        size = 0
+        for p in [path] + [path + s for s in self.SQLITE_SIDECAR_SUFFIXES]:
+            try:
+                size += os.path.getsize(p)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def create_observation(self, o):
+        self.create_observations([o])
+
+    def create_multiobservation(self, mo):
+        self.create_observations([mo])
+
+    def create_observations(self, observations):
+        created = self._get_write_partition().create_observations(observations)
+        if len(created) > 0:
+            self.enforce_spool_budget()
+        return created
+
+    def enforce_spool_budget(self):
+        """Drop whole partitions, oldest first, that are past max_age_hours or that need to
+        go to bring the spool within max_bytes and max_rows.  The partition being written
+        to is never dropped.
+
+        :return: Number of partitions dropped
+        """
+        if self.max_bytes is None and self.max_rows is None and self.max_age_hours is None:
+            return 0
+        now = time.time()
+        keys = [k for k in self.partition_keys() if k != self.write_key]
+        dropped = 0
+        if self.max_age_hours is not None:
+            oldest_kept = now - self.max_age_hours * self.SECONDS_PER_HOUR
+            for key in list(keys):
+                if (key + self.hours_per_partition) * self.SECONDS_PER_HOUR <= oldest_kept:
+                    self.drop_partition(key)
+                    keys.remove(key)
+                    dropped += 1
+        while len(keys) > 0 and self._over_budget():
+            self.drop_partition(keys.pop(0))
+            dropped += 1
+        if dropped > 0:
+            self.logger.warn("Spooler: dropped {0} spool partitions to keep spool within budget.".format(dropped))
+        return dropped
+
+    def _over_budget(self):
+        keys = self.partition_keys()
+        if self.max_bytes is not None:
+            if sum([self._partition_size(k) for k in keys]) > self.max_bytes:
+                return True
+        if self.max_rows is not None:
+            if sum([repo.get_observation_count() for (k, repo) in self._live_partitions()]) > self.max_rows:
+                return True
+        return False
+
+    def get_observations(self, limit="360", after_id=0, transport=None):
+        limit = int(limit)
+        (after_key, after_local_id) = self._split_id(after_id)
+        observations = []
+        for (key, repo) in self._live_partitions():
+            if key < after_key:
+                continue
+            local_after_id = after_local_id if key == after_key else 0
+            obs = repo.get_observations(limit=limit - len(observations),
+                                                            after_id=local_after_id, transport=transport)
+            if obs is None:
+                return None
+            observations.extend(self._globalize_ids(key, obs))
+            if len(observations) >= limit:
+                break
+        return observations
+
+    def get_observations_by_datastream(self, limit="360", after_id=0, transport=None):
+        return sort_by_datastream(self.get_observations(limit=limit, after_id=after_id, transport=transport))
+
+    def iter_observations(self, page_size=360, after_id=0, transport=None):
+        while True:
+            observations = self.get_observations(limit=page_size, after_id=after_id, transport=transport)
+            if not observations:
+                break
+            for o in observations:
+                yield o
+            after_id = observations[-1].id
+
+    def claim_observations(self, limit=360, lease_seconds=300, transport=None):
+        observations = []
+        for (key, repo) in self._live_partitions():
+            obs = repo.claim_observations(limit=limit - len(observations), lease_seconds=lease_seconds,
+                                          transport=transport)
+            if obs is None:
+                return None
+            observations.extend(self._globalize_ids(key, obs))
+            if len(observations) >= limit:
+                break
+        return observations
+
+    def _partitions_of_ids(self, ids):
+        """(key, repository, local ids) of the partitions of ids that are still on disk"""
+        for (key, local_ids) in self._ids_by_partition(ids).items():
+            repo = self._get_partition(key)
+            if repo is not None:
+                yield (key, repo, local_ids)
+
+    def release_observations(self, ids):
+        for (key, repo, local_ids) in self._partitions_of_ids(ids):
+            repo.release_observations(local_ids)
+
+    def delete_observations(self, ids, transport=None):
+        now = time.time()
+        for (key, repo, local_ids) in self._partitions_of_ids(ids):
+            repo.delete_observations(local_ids, transport=transport)
+            if self._is_droppable(key, repo, now):
+                if repo.archive is not None:
+                    # Delivered observations must reach the archive before the file goes
+                    repo.compact()
+                self.drop_partition(key)
+
+    def update_observation_status(self, ids, status=STATUS_ERROR, transport=None):
+        for (key, repo, local_ids) in self._partitions_of_ids(ids):
+            repo.update_observation_status(local_ids, status=status, transport=transport)
+
+    def compact(self, max_seconds=None):
+        """Purge delivered observations from every partition, see SqliteRepository.compact()"""
+        now = time.time()
+        purged = 0
+        for (key, repo) in self._live_partitions():
+            purged += repo.compact(max_seconds=max_seconds)
+            if self._is_droppable(key, repo, now):
+                self.drop_partition(key)
+        return purged
+
+    def query(self, datastream_id, start=None, end=None, limit=None):
+        """Observations of a datastream or multidatastream from all partitions and the archive,
+        see SqliteRepository.query()"""
+        start = SqliteRepository._encode_query_time(start)
+        end = SqliteRepository._encode_query_time(end)
+        streams = []
+        for key in self.partition_keys():
+            # Observations are spooled after they were made, so older partitions can be skipped
+            if start is not None and \
+                    (key + self.hours_per_partition) * self.SECONDS_PER_HOUR * 1000000 <= start:
+                continue
+            streams.append(self._query_partition(key, datastream_id, start, end))
+        if self.archive is not None:
+            streams.append(self.archive.query(datastream_id, start, end, limit=limit))
+        return SqliteRepository._merge_by_time(streams, limit)
+
+    def _query_partition(self, key, datastream_id, start, end):
+        if not os.path.exists(self._path_for_key(key)):
+            return
+        # Streams of all partitions are read together, so they are opened apart from the open
+        #   partitions, whose number is bounded
+        repo = self._open_partition(key)
+        try:
+            for (t, o) in repo._query_spool(datastream_id, start, end):
+                o.id = self._make_id(key, o.id)
+                yield (t, o)
+        finally:
+            repo.close()
+
+    def retry_observations(self):
+        return sum([repo.retry_observations() for (k, repo) in self._live_partitions()])
+
+    def get_dead_letters(self):
+        dead_letters = []
+        for (key, repo) in self._live_partitions():
+            for (o, attempts, dead_since) in repo.get_dead_letters():
+                o.id = self._make_id(key, o.id)
+                dead_letters.append((o, attempts, dead_since))
+        return dead_letters
+
+    def _for_dead_letters(self, action, ids):
+        if ids is None:
+            return sum([action(repo, None) for (k, repo) in self._live_partitions()])
+        return sum([action(repo, local_ids) for (k, repo, local_ids) in self._partitions_of_ids(ids)])
+
+    def requeue_dead_letters(self, ids=None):
+        # Requeued observations go back into the partition they came from
+        return self._for_dead_letters(lambda repo, local_ids: repo.requeue_dead_letters(local_ids), ids)
+
+    def purge_dead_letters(self, ids=None):
+        return self._for_dead_letters(lambda repo, local_ids: repo.purge_dead_letters(local_ids), ids)
+
+    def stats(self):
+        """Statistics of all partitions, see SqliteRepository.stats()"""
+        by_datastream = {}
+        times = []
+        db_size = 0
+        delivered = 0
+        keys = self.partition_keys()
+        for (key, repo) in self._live_partitions():
+            stats = repo._stats()
+            for (datastream_id, counts) in stats['by_datastream'].items():
+                totals = by_datastream.setdefault(datastream_id, {})
+                for (status, count) in counts.items():
+                    totals[status] = totals.get(status, 0) + count
+            times.extend([stats['oldest_phenomenon_time'], stats['newest_phenomenon_time']])
+            db_size += stats['db_size_bytes']
+            delivered += stats['awaiting_compaction']
+        stats = {'by_datastream': by_datastream,
+                 'awaiting_compaction': delivered,
+                 'db_size_bytes': db_size}
+        for (name, t) in SqliteRepository._time_range(times).items():
+            stats[name] = SqliteRepository._decode_phenomenon_time(t)
+        stats['partitions'] = len(keys)
+        return SqliteRepository._summarize_stats(stats)
+
+    def get_all_observations(self):
+        observations = []
+        for (key, repo) in self._live_partitions():
+            observations.extend(self._globalize_ids(key, repo.get_all_observations()))
+        return observations
+
+    def close(self):
+        for repo in self.partitions.values():
+            repo.close()
+        self.partitions = OrderedDict()
@@ -0,0 +1,338 @@
+import os
+import math
+import time
+import sqlite3
+
+from sensors.common.constants import (CFG_SPOOLER_ROLLUP_PATH, CFG_SPOOLER_ROLLUP_15MIN_RETENTION_DAYS,
+                                      CFG_SPOOLER_ROLLUP_HOURLY_RETENTION_DAYS, CFG_SPOOLER_ROLLUP_UPLOAD,
+                                      CFG_SPOOLER_ROLLUP_UPLOAD_NONE, CFG_SPOOLER_ROLLUP_TIER_15MIN,
+                                      CFG_SPOOLER_ROLLUP_TIER_HOURLY, CFG_SPOOLER_SYNCHRONOUS,
+                                      CFG_SPOOLER_BUSY_TIMEOUT_MS)
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.persistence.sqlite import SqliteRepository
+from sensors.persistence import sort_by_datastream
+from sensors.common import logging
+
+
+class Rollups:
+    """Count, mean, min, max and standard deviation of results over 15-minute and hourly buckets
+    of phenomenon time, per datastream and per component of multidatastream results.
+
+    Rollups are kept in their own SQLite database, rollup_path, with a table per tier, so that
+    they outlive the raw observations in the spool.  The spooler folds each batch it receives
+    into the buckets: the batch is summarized in memory, then merged into the stored buckets
+    (means and sums of squared deviations are combined as in Chan et al.'s parallel variance),
+    all in one transaction, which also drops the buckets of each tier that are past retention.
+    Results that aren't numbers are not counted.
+
+    Rollups can also be read and acknowledged like a repository, so that transports can upload
+    the buckets of the rollup_upload tier instead of raw observations.  Each bucket is uploaded
+    once it has ended, as an observation whose phenomenonTime is the interval of the bucket,
+    whose result is the mean and whose parameters hold the count, min, max and stddev.  A bucket
+    that late observations change after it was uploaded is uploaded again, in full.
+    """
+
+    STATUS_PENDING = SqliteRepository.STATUS_PENDING
+    STATUS_ERROR = SqliteRepository.STATUS_ERROR
+
+    # Bucket length of each tier, in seconds
+    TIER_SECONDS = {CFG_SPOOLER_ROLLUP_TIER_15MIN: 15 * 60,
+                    CFG_SPOOLER_ROLLUP_TIER_HOURLY: 60 * 60}
+    SECONDS_PER_DAY = 24 * 60 * 60
+    MICROSECONDS_PER_SECOND = 1000000
+    # A bucket is not uploaded until this many seconds after it ends, so that observations
+    #   still being batched by the spooler make it in.  Those arriving later are uploaded again.
+    CLOSE_GRACE_SECONDS = 60
+
+    SQL_CREATE_ROLLUP_TABLE = '''CREATE TABLE IF NOT EXISTS rollup_{0}
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    datastreamId TEXT NOT NULL,
+    is_multiobservation INTEGER NOT NULL,
+    bucket_start INTEGER NOT NULL,
+    count BLOB NOT NULL,
+    mean BLOB NOT NULL,
+    m2 BLOB NOT NULL,
+    min BLOB NOT NULL,
+    max BLOB NOT NULL,
+    UNIQUE (datastreamId, bucket_start))
+    '''
+    SQL_CREATE_ROLLUP_IDX = "CREATE INDEX IF NOT EXISTS rollup_{0}_bucket_start_idx ON rollup_{0} (bucket_start)"
+    SQL_CREATE_CURSOR_TABLE = '''CREATE TABLE IF NOT EXISTS rollup_cursor
+    (transport TEXT NOT NULL,
+    tier TEXT NOT NULL,
+    last_id INTEGER NOT NULL,
+    PRIMARY KEY (transport, tier))
+    '''
+    SQL_GET_BUCKET = "SELECT * FROM rollup_{0} WHERE datastreamId = ? AND bucket_start = ?"
+    SQL_CREATE_BUCKET = ("INSERT INTO rollup_{0} (datastreamId, is_multiobservation, bucket_start, count, mean, m2, "
+                         "min, max) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    SQL_UPDATE_BUCKET = "UPDATE rollup_{0} SET count=?, mean=?, m2=?, min=?, max=? WHERE id=?"
+    SQL_DELETE_BUCKET = "DELETE FROM rollup_{0} WHERE id=?"
+    SQL_PRUNE_BUCKETS = "DELETE FROM rollup_{0} WHERE bucket_start < ?"
+    SQL_GET_BUCKETS_AFTER = "SELECT * FROM rollup_{0} WHERE id > ? ORDER BY id LIMIT ?"
+    SQL_QUERY_BUCKETS = ("SELECT * FROM rollup_{0} WHERE datastreamId = ? AND bucket_start >= ? AND bucket_start < ? "
+                         "ORDER BY bucket_start")
+    SQL_INIT_CURSOR = "INSERT OR IGNORE INTO rollup_cursor (transport, tier, last_id) VALUES (?, ?, 0)"
+    SQL_ADVANCE_CURSOR = "UPDATE rollup_cursor SET last_id = max(last_id, ?) WHERE transport = ? AND tier = ?"
+    SQL_GET_CURSOR = "SELECT last_id FROM rollup_cursor WHERE transport = ? AND tier = ?"
+    SQL_GET_UPLOADED_ID = "SELECT max(last_id) FROM rollup_cursor WHERE tier = ?"
+
+    # Columns of rollup tables
+    (ROLLUP_ID, ROLLUP_DATASTREAM_ID, ROLLUP_IS_MULTI, ROLLUP_BUCKET_START, ROLLUP_COUNT, ROLLUP_MEAN, ROLLUP_M2,
+     ROLLUP_MIN, ROLLUP_MAX) = range(9)
+
+    def __init__(self, config):
+        self.db_path = config[CFG_SPOOLER_ROLLUP_PATH]
+        self.synchronous = config[CFG_SPOOLER_SYNCHRONOUS]
+        self.busy_timeout_ms = config[CFG_SPOOLER_BUSY_TIMEOUT_MS]
+        self.retention_days = {CFG_SPOOLER_ROLLUP_TIER_15MIN: config[CFG_SPOOLER_ROLLUP_15MIN_RETENTION_DAYS],
+                               CFG_SPOOLER_ROLLUP_TIER_HOURLY: config[CFG_SPOOLER_ROLLUP_HOURLY_RETENTION_DAYS]}
+        # Tier read by get_observations()
+        self.upload_tier = config[CFG_SPOOLER_ROLLUP_UPLOAD]
+        if self.upload_tier == CFG_SPOOLER_ROLLUP_UPLOAD_NONE:
+            self.upload_tier = CFG_SPOOLER_ROLLUP_TIER_HOURLY
+        self._conn = None
+        self._conn_pid = None
+        self.logger = logging.get_instance()
+        self._perform_action_with_connection(Rollups._create_tables)
+
+    def _get_connection(self):
+        # Keyed by PID like SqliteRepository, as the spooler and transmitter both open rollups
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            self._conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous={0}".format(self.synchronous))
+            self._conn_pid = pid
+        return self._conn
+
+    def _perform_action_with_connection(self, action):
+        conn = self._get_connection()
+        with conn:
+            return action(conn)
+
+    def close(self):
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._conn_pid = None
+
+    @staticmethod
+    def _create_tables(conn):
+        for tier in Rollups.TIER_SECONDS:
+            conn.execute(Rollups.SQL_CREATE_ROLLUP_TABLE.format(tier))
+            conn.execute(Rollups.SQL_CREATE_ROLLUP_IDX.format(tier))
+        conn.execute(Rollups.SQL_CREATE_CURSOR_TABLE)
+
+    # Statistics, as lists of count, mean, m2 (sum of squared deviations from the mean),
+    #   min and max with an element per component
+
+    @staticmethod
+    def _get_values(o):
+        """Results of an observation as floats, NaN for those that aren't numbers"""
+        results = o.result if isinstance(o, MultiObservation) else [o.result]
+        values = []
+        for r in results:
+            try:
+                v = float(r)
+            except (TypeError, ValueError):
+                v = math.nan
+            values.append(v if math.isfinite(v) else math.nan)
+        return values
+
+    @staticmethod
+    def _extend_stats(stats, n):
+        while len(stats[0]) < n:
+            for (s, empty) in zip(stats, (0, 0.0, 0.0, math.inf, -math.inf)):
+                s.append(empty)
+
+    @staticmethod
+    def _add_values(stats, values):
+        """Add values to stats with Welford's algorithm"""
+        (counts, means, m2s, mins, maxs) = stats
+        Rollups._extend_stats(stats, len(values))
+        for (i, v) in enumerate(values):
+            if math.isnan(v):
+                continue
+            counts[i] += 1
+            delta = v - means[i]
+            means[i] += delta / counts[i]
+            m2s[i] += delta * (v - means[i])
+            mins[i] = min(mins[i], v)
+            maxs[i] = max(maxs[i], v)
+
+    @staticmethod
+    def _merge_stats(a, b):
+        """Stats of the union of the values of stats a and b"""
+        n = max(len(a[0]), len(b[0]))
+        Rollups._extend_stats(a, n)
+        Rollups._extend_stats(b, n)
+        merged = ([], [], [], [], [])
+        for i in range(n):
+            (na, nb) = (a[0][i], b[0][i])
+            count = na + nb
+            if count == 0:
+                (mean, m2) = (0.0, 0.0)
+            else:
+                delta = b[1][i] - a[1][i]
+                mean = a[1][i] + delta * nb / count
+                m2 = a[2][i] + b[2][i] + delta * delta * na * nb / count
+            for (s, v) in zip(merged, (count, mean, m2, min(a[3][i], b[3][i]), max(a[4][i], b[4][i]))):
+                s.append(v)
+        return merged
+
+    @staticmethod
+    def _pack_stats(stats):
+        return tuple([SqliteRepository._pack_results(s) for s in stats])
+
+    @staticmethod
+    def _unpack_stats(row):
+        stats = [SqliteRepository._unpack_results(row[c]) for c in range(Rollups.ROLLUP_COUNT, Rollups.ROLLUP_MAX + 1)]
+        stats[0] = [int(c) for c in stats[0]]
+        return tuple(stats)
+
+    # Ingest
+
+    def add(self, observations):
+        """Fold observations into the buckets of every tier, in one transaction.  Observations
+        whose phenomenon time can't be parsed are skipped.
+
+        :return: Number of observations rolled up
+        """
+        batch = {}
+        n = 0
+        for o in observations:
+            t = SqliteRepository._encode_phenomenon_time(o.phenomenonTime)
+            if not isinstance(t, int):
+                continue
+            is_multiobservation = isinstance(o, MultiObservation)
+            datastream_id = o.multidatastreamId if is_multiobservation else o.datastreamId
+            values = self._get_values(o)
+            for (tier, seconds) in self.TIER_SECONDS.items():
+                bucket_start = t - t % (seconds * self.MICROSECONDS_PER_SECOND)
+                stats = batch.setdefault((tier, datastream_id, is_multiobservation, bucket_start), ([], [], [], [], []))
+                self._add_values(stats, values)
+            n += 1
+
+        def merge(conn):
+            # Buckets up to this id were uploaded by some transport
+            uploaded_id = conn.execute(Rollups.SQL_GET_UPLOADED_ID, (self.upload_tier,)).fetchone()[0] or 0
+            changed = 0
+            for ((tier, datastream_id, is_multiobservation, bucket_start), stats) in batch.items():
+                row = conn.execute(Rollups.SQL_GET_BUCKET.format(tier), (datastream_id, bucket_start)).fetchone()
+                if row is not None:
+                    stats = self._merge_stats(self._unpack_stats(row), stats)
+                    if tier != self.upload_tier or row[Rollups.ROLLUP_ID] > uploaded_id:
+                        conn.execute(Rollups.SQL_UPDATE_BUCKET.format(tier),
+                                     self._pack_stats(stats) + (row[Rollups.ROLLUP_ID],))
+                        continue
+                    # Moved past the cursors under a new id, to be uploaded again
+                    conn.execute(Rollups.SQL_DELETE_BUCKET.format(tier), (row[Rollups.ROLLUP_ID],))
+                    changed += 1
+                conn.execute(Rollups.SQL_CREATE_BUCKET.format(tier),
+                             (datastream_id, int(is_multiobservation), bucket_start) + self._pack_stats(stats))
+            if changed > 0:
+                self.logger.info("Spooler: {0} uploaded rollups changed by late observations will be uploaded again.".
+                                 format(changed))
+            now = time.time()
+            for (tier, days) in self.retention_days.items():
+                cutoff = int((now - days * self.SECONDS_PER_DAY) * self.MICROSECONDS_PER_SECOND)
+                conn.execute(Rollups.SQL_PRUNE_BUCKETS.format(tier), (cutoff,))
+
+        self._perform_action_with_connection(merge)
+        return n
+
+    # Reading
+
+    def _get_observation_from_row(self, tier, r):
+        (counts, means, m2s, mins, maxs) = self._unpack_stats(r)
+        present = [c > 0 for c in counts]
+        stddevs = [math.sqrt(m2 / (c - 1)) if c > 1 else 0.0 for (c, m2) in zip(counts, m2s)]
+        bucket_start = r[self.ROLLUP_BUCKET_START]
+        bucket_end = bucket_start + self.TIER_SECONDS[tier] * self.MICROSECONDS_PER_SECOND
+        # Missing results are NaN, which transports leave out, other missing values are None
+        result = [m if p else math.nan for (m, p) in zip(means, present)]
+        parameters = {'rollup': tier,
+                      'count': counts,
+                      'min': [v if p else None for (v, p) in zip(mins, present)],
+                      'max': [v if p else None for (v, p) in zip(maxs, present)],
+                      'stddev': [v if p else None for (v, p) in zip(stddevs, present)]}
+        if r[self.ROLLUP_IS_MULTI]:
+            o = MultiObservation()
+            o.multidatastreamId = r[self.ROLLUP_DATASTREAM_ID]
+            o.result = result
+        else:
+            o = Observation()
+            o.datastreamId = r[self.ROLLUP_DATASTREAM_ID]
+            o.result = result[0]
+            parameters = {k: (v if k == 'rollup' else v[0]) for (k, v) in parameters.items()}
+        o.id = r[self.ROLLUP_ID]
+        o.phenomenonTime = (SqliteRepository._decode_phenomenon_time(bucket_start) + '/' +
+                            SqliteRepository._decode_phenomenon_time(bucket_end))
+        o.parameters = parameters
+        return o
+
+    def query(self, datastream_id, tier=CFG_SPOOLER_ROLLUP_TIER_HOURLY, start=None, end=None):
+        """Rollups of a datastream or multidatastream whose bucket starts from start (inclusive)
+        to end (exclusive), oldest first, see SqliteRepository.query()
+
+        :return: List of observations
+        """
+        start = SqliteRepository._encode_query_time(start)
+        end = SqliteRepository._encode_query_time(end)
+        params = (datastream_id, SqliteRepository.MIN_TIME if start is None else start,
+                  SqliteRepository.MAX_TIME if end is None else end)
+        return [self._get_observation_from_row(tier, r)
+                for r in self._get_connection().execute(Rollups.SQL_QUERY_BUCKETS.format(tier), params)]
+
+    # Upload, with the methods of a repository used by transports
+
+    def get_observations(self, limit="360", after_id=0, transport=None):
+        """Buckets of the upload tier that have ended, in the order they were created.  The
+        first bucket still open holds back those after it, so that a transport's cursor
+        never moves past a bucket that hasn't been uploaded.
+
+        :param transport: Identifier of the transport reading.  If given, only buckets the
+            transport has not yet acknowledged are returned.
+        """
+        tier = self.upload_tier
+        conn = self._get_connection()
+        if transport is not None:
+            row = conn.execute(Rollups.SQL_GET_CURSOR, (transport, tier)).fetchone()
+            if row is not None:
+                after_id = max(after_id, row[0])
+        closed_before = int((time.time() - self.CLOSE_GRACE_SECONDS - self.TIER_SECONDS[tier]) *
+                            self.MICROSECONDS_PER_SECOND)
+        observations = []
+        for r in conn.execute(Rollups.SQL_GET_BUCKETS_AFTER.format(tier), (after_id, int(limit))).fetchall():
+            if r[self.ROLLUP_BUCKET_START] > closed_before:
+                break
+            observations.append(self._get_observation_from_row(tier, r))
+        return observations
+
+    def get_observations_by_datastream(self, limit="360", after_id=0, transport=None):
+        return sort_by_datastream(self.get_observations(limit=limit, after_id=after_id, transport=transport))
+
+    def delete_observations(self, ids, transport=None):
+        """Advance the cursor of transport past the uploaded buckets, which are kept until
+        they are past retention"""
+        if len(ids) == 0 or transport is None:
+            return
+
+        def acknowledge(conn):
+            conn.execute(Rollups.SQL_INIT_CURSOR, (transport, self.upload_tier))
+            conn.execute(Rollups.SQL_ADVANCE_CURSOR, (max(ids), transport, self.upload_tier))
+
+        self._perform_action_with_connection(acknowledge)
+
+    def update_observation_status(self, ids, status=STATUS_ERROR, transport=None):
+        """Buckets rejected by the server are not retried"""
+        self.logger.warn("Spooler: {0} rollups rejected by {1} will not be uploaded again.".format(len(ids), transport))
+        self.delete_observations(ids, transport=transport)
+
+    def retry_observations(self):
+        return 0
+
+    def compact(self, max_seconds=None):
+        return 0
@@ -0,0 +1,610 @@
+import os
+import mmap
+import json
+import time
+import fcntl
+import heapq
+import struct
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from sensors.common.constants import (CFG_SPOOLER_DB_PATH, CFG_SPOOLER_SYNCHRONOUS, CFG_SPOOLER_MAX_BYTES,
+                                      CFG_SPOOLER_SEGMENT_SIZE_BYTES, CFG_TRANSPORTS)
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.persistence import sort_by_datastream
+from sensors.persistence.sqlite import SqliteRepository
+from sensors.common import logging
+
+
+class SegmentLogRepository:
+    """Append-only spool made of fixed-size segment files.
+
+    Observations are appended to the newest segment as length-prefixed JSON records.
+    Each consumer (one per transport) reads the log through memory-mapped segments and
+    durably records the offset up to which it has acknowledged observations.  Segments
+    entirely below the offsets of all configured transports are deleted.  Observations
+    rejected by the server (STATUS_ERROR) are moved to a separate error log so that they
+    don't hold back the acknowledged offset.  They are not retried, as only the spooler
+    appends to the log: the error log holds the dead letters, whose id is their offset in the
+    error log plus one.
+
+    Concurrent senders claim observations of the default consumer under a lease recorded in
+    a claims file, which also remembers claimed observations that were settled until the
+    checkpoint of the default consumer moves past them.
+
+    The id of an observation is its byte offset in the log plus one, so ids are ordered
+    and 0 can be used to mean "from the beginning".
+    """
+
+    STATUS_PENDING = "PENDING"
+    STATUS_ERROR = "ERROR"
+    STATUS_DEAD_LETTER = SqliteRepository.STATUS_DEAD_LETTER
+
+    DIRECTORY_SUFFIX = '.segments'
+    SEGMENT_SUFFIX = '.seg'
+    SEGMENT_NAME_FMT = '{0:020d}' + SEGMENT_SUFFIX
+    ERROR_LOG_NAME = 'errors.log'
+    CHECKPOINT_SUFFIX = '.ack'
+    DEFAULT_CONSUMER = 'default'
+    CLAIMS_NAME = 'claims.json'
+    CLAIMS_LOCK_NAME = 'claims.lock'
+    ERRORS_LOCK_NAME = 'errors.lock'
+    # Lease expiry of claimed observations that were acknowledged or rejected
+    SETTLED = -1
+
+    LENGTH_PREFIX = struct.Struct('<I')
+    JSON_SEPARATORS = (',', ':')
+
+    def __init__(self, config):
+        self.directory = os.path.splitext(config[CFG_SPOOLER_DB_PATH])[0] + self.DIRECTORY_SUFFIX
+        os.makedirs(self.directory, exist_ok=True)
+        self.segment_size = config[CFG_SPOOLER_SEGMENT_SIZE_BYTES]
+        self.fsync = config[CFG_SPOOLER_SYNCHRONOUS] != 'OFF'
+        self.max_bytes = config[CFG_SPOOLER_MAX_BYTES]
+        self.transports = [t.identifier() for t in config[CFG_TRANSPORTS]]
+        self.checkpoints = {}
+        # Offsets acknowledged beyond the checkpoint of each consumer, which can only advance
+        #   over a contiguous prefix
+        self.acked = {}
+        self._writer = None
+        self._writer_pid = None
+        self._write_base = None
+        self._write_offset = None
+        self.logger = logging.get_instance()
+
+    # Segment files
+
+    def _segment_path(self, base):
+        return os.path.join(self.directory, self.SEGMENT_NAME_FMT.format(base))
+
+    def segment_bases(self):
+        """Base offsets of the segments on disk, oldest first"""
+        bases = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.SEGMENT_SUFFIX):
+                try:
+                    bases.append(int(filename[:-len(self.SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(bases)
+
+    def _delete_segment(self, base):
+        try:
+            os.unlink(self._segment_path(base))
+        except FileNotFoundError:
+            # Already deleted by another process
+            pass
+
+    def _iter_file_records(self, path, base=0, start=0):
+        """Yield (offset, payload) for each complete record of a file, starting at offset start.
+        A record that is only partially written (by a concurrent or crashed writer) ends the file.
+        """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = max(start - base, 0)
+                while pos + self.LENGTH_PREFIX.size <= size:
+                    (length,) = self.LENGTH_PREFIX.unpack_from(mm, pos)
+                    end = pos + self.LENGTH_PREFIX.size + length
+                    if end > size:
+                        break
+                    yield (base + pos, mm[pos + self.LENGTH_PREFIX.size:end])
+                    pos = end
+
+    def _iter_records(self, start):
+        bases = self.segment_bases()
+        for (i, base) in enumerate(bases):
+            if i + 1 < len(bases) and bases[i + 1] <= start:
+                continue
+            for record in self._iter_file_records(self._segment_path(base), base, start):
+                yield record
+
+    @staticmethod
+    def _record_end(offset, payload):
+        return offset + SegmentLogRepository.LENGTH_PREFIX.size + len(payload)
+
+    # Writing
+
+    def _get_writer(self):
+        pid = os.getpid()
+        if self._writer is None or self._writer_pid != pid:
+            bases = self.segment_bases()
+            base = bases[-1] if len(bases) > 0 else 0
+            path = self._segment_path(base)
+            # Recover from a crash in the middle of an append by discarding the torn record
+            end = 0
+            for (offset, payload) in self._iter_file_records(path):
+                end = self._record_end(offset, payload)
+            if os.path.exists(path) and os.path.getsize(path) != end:
+                self.logger.warn("Spooler: truncating torn record at end of segment {0}".format(path))
+                os.truncate(path, end)
+            self._writer = open(path, 'ab')
+            self._writer_pid = pid
+            self._write_base = base
+            self._write_offset = base + end
+        return self._writer
+
+    def _roll_segment(self):
+        self._writer.close()
+        self._write_base = self._write_offset
+        self._writer = open(self._segment_path(self._write_base), 'ab')
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _encode(self, o):
+        if isinstance(o, Observation):
+            e = [0, o.featureOfInterestId, o.datastreamId, o.phenomenonTime, o.result, o.parameters]
+        elif isinstance(o, MultiObservation):
+            e = [1, o.featureOfInterestId, o.multidatastreamId, o.phenomenonTime, o.result, o.parameters]
+        else:
+            raise TypeError("Observation of type {0} is unknown".format(o.__class__.__name__))
+        payload = json.dumps(e, separators=self.JSON_SEPARATORS).encode('utf-8')
+        return self.LENGTH_PREFIX.pack(len(payload)) + payload
+
+    @staticmethod
+    def _decode(offset, payload):
+        # Records of the error log are followed by the attempts and the time they were rejected
+        (is_multiobservation, foi_id, datastream_id, phenomenon_time, result, parameters) = \
+            json.loads(bytes(payload).decode('utf-8'))[:6]
+        if is_multiobservation:
+            o = MultiObservation()
+            o.multidatastreamId = datastream_id
+        else:
+            o = Observation()
+            o.datastreamId = datastream_id
+        o.id = None if offset is None else offset + 1
+        o.featureOfInterestId = foi_id
+        o.phenomenonTime = phenomenon_time
+        o.result = result
+        o.parameters = parameters if parameters is not None else {}
+        return o
+
+    def create_observation(self, o):
+        self.create_observations([o])
+
+    def create_multiobservation(self, mo):
+        self.create_observations([mo])
+
+    def create_observations(self, observations):
+        """Append observations to the log, which does not look for duplicates.
+
+        :return: List of the observations stored
+        """
+        observations = list(observations)
+        records = [self._encode(o) for o in observations]
+        if len(records) == 0:
+            return []
+        writer = self._get_writer()
+        for record in records:
+            if self._write_offset > self._write_base and \
+                    self._write_offset - self._write_base + len(record) > self.segment_size:
+                self._sync(writer)
+                self._roll_segment()
+                writer = self._writer
+            writer.write(record)
+            self._write_offset += len(record)
+        self._sync(writer)
+        self.enforce_spool_budget()
+        return observations
+
+    def enforce_spool_budget(self):
+        """Delete the oldest segments, never the one being written to, while the log is
+        larger than max_bytes.
+
+        :return: Number of segments deleted
+        """
+        if self.max_bytes is None:
+            return 0
+        bases = self.segment_bases()
+        sizes = {}
+        for base in bases:
+            try:
+                sizes[base] = os.path.getsize(self._segment_path(base))
+            except FileNotFoundError:
+                sizes[base] = 0
+        total = sum(sizes.values())
+        dropped = 0
+        for base in bases[:-1]:
+            if total <= self.max_bytes:
+                break
+            self._delete_segment(base)
+            total -= sizes[base]
+            dropped += 1
+        if dropped > 0:
+            self.logger.warn("Spooler: dropped {0} spool segments to keep spool within budget.".format(dropped))
+        return dropped
+
+    # Reading and acknowledgement
+
+    @classmethod
+    def _consumer(cls, transport):
+        if transport is None:
+            return cls.DEFAULT_CONSUMER
+        return quote(transport, safe='')
+
+    def _checkpoint_path(self, consumer):
+        return os.path.join(self.directory, consumer + self.CHECKPOINT_SUFFIX)
+
+    def _read_checkpoint(self, consumer):
+        try:
+            with open(self._checkpoint_path(consumer), 'r') as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_checkpoint(self, consumer, checkpoint):
+        checkpoint_path = self._checkpoint_path(consumer)
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(checkpoint))
+            self._sync(f)
+        os.replace(tmp_path, checkpoint_path)
+        self.checkpoints[consumer] = checkpoint
+
+    def get_checkpoint(self, transport=None):
+        consumer = self._consumer(transport)
+        if consumer not in self.checkpoints:
+            self.checkpoints[consumer] = self._read_checkpoint(consumer)
+        return self.checkpoints[consumer]
+
+    def _start_offset(self, transport):
+        checkpoint = self.get_checkpoint(transport)
+        bases = self.segment_bases()
+        if len(bases) > 0:
+            # Segments may have been dropped to keep within budget
+            return max(checkpoint, bases[0])
+        return checkpoint
+
+    def get_observations(self, limit="360", after_id=0, transport=None):
+        limit = int(limit)
+        observations = []
+        acked = self.acked.get(self._consumer(transport), set())
+        if transport is None:
+            # Observations claimed by a sender are not read while their lease holds
+            now = int(time.time())
+            claims = self._read_claims()
+            acked = acked.union([o for (o, expires) in claims.items() if expires == self.SETTLED or expires > now])
+        start = self._start_offset(transport)
+        after_offset = after_id - 1
+        if after_offset >= start:
+            start = after_offset
+        for (offset, payload) in self._iter_records(start):
+            if offset <= after_offset or offset in acked:
+                continue
+            observations.append(self._decode(offset, payload))
+            if len(observations) >= limit:
+                break
+        return observations
+
+    def get_observations_by_datastream(self, limit="360", after_id=0, transport=None):
+        return sort_by_datastream(self.get_observations(limit=limit, after_id=after_id, transport=transport))
+
+    def iter_observations(self, page_size=360, after_id=0, transport=None):
+        while True:
+            observations = self.get_observations(limit=page_size, after_id=after_id, transport=transport)
+            if not observations:
+                break
+            for o in observations:
+                yield o
+            after_id = observations[-1].id
+
+    def delete_observations(self, ids, transport=None):
+        """Acknowledge observations for the consumer of transport, or for the default consumer
+        if transport is None.
+        """
+        consumer = self._consumer(transport)
+        acked = self.acked.setdefault(consumer, set())
+        acked.update([i - 1 for i in ids])
+        if transport is None and os.path.exists(self._claims_path()):
+            checkpoint = self._settle_claims(ids)
+        else:
+            checkpoint = self._advance_checkpoint(transport)
+        if checkpoint is None:
+            return
+
+        if transport is not None and len(self.transports) > 0:
+            # Checkpoints of other transports may only be known from disk
+            delivered = min([self._read_checkpoint(self._consumer(t)) for t in self.transports])
+        else:
+            delivered = checkpoint
+        bases = self.segment_bases()
+        for (i, base) in enumerate(bases[:-1]):
+            if bases[i + 1] <= delivered:
+                self._delete_segment(base)
+
+    def _advance_checkpoint(self, transport, settled=()):
+        """Move the checkpoint of the consumer of transport over the contiguous prefix of
+        acknowledged observations.
+
+        :return: The new checkpoint, or None if it did not move
+        """
+        consumer = self._consumer(transport)
+        acked = self.acked.setdefault(consumer, set())
+        checkpoint = self._start_offset(transport)
+        for (offset, payload) in self._iter_records(checkpoint):
+            if offset not in acked and offset not in settled:
+                break
+            acked.discard(offset)
+            checkpoint = self._record_end(offset, payload)
+        if checkpoint == self.get_checkpoint(transport):
+            return None
+        self._write_checkpoint(consumer, checkpoint)
+        return checkpoint
+
+    # Claims
+
+    def _claims_path(self):
+        return os.path.join(self.directory, self.CLAIMS_NAME)
+
+    @contextmanager
+    def _claims_locked(self):
+        with open(os.path.join(self.directory, self.CLAIMS_LOCK_NAME), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _read_claims(self):
+        """Lease expiry of each claimed offset"""
+        try:
+            with open(self._claims_path(), 'r') as f:
+                return dict([(int(offset), expires) for (offset, expires) in json.load(f).items()])
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_claims(self, claims):
+        claims_path = self._claims_path()
+        tmp_path = claims_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(claims, f, separators=self.JSON_SEPARATORS)
+            self._sync(f)
+        os.replace(tmp_path, claims_path)
+
+    def _refresh_checkpoint(self):
+        # Claimants in other processes advance the checkpoint of the default consumer too
+        consumer = self.DEFAULT_CONSUMER
+        self.checkpoints[consumer] = max(self.get_checkpoint(), self._read_checkpoint(consumer))
+
+    def _settle_claims(self, ids):
+        """Mark claimed observations as settled and advance the checkpoint of the default consumer
+        over those settled by any claimant.
+        """
+        with self._claims_locked():
+            self._refresh_checkpoint()
+            claims = self._read_claims()
+            for i in ids:
+                if i - 1 in claims:
+                    claims[i - 1] = self.SETTLED
+            settled = set([o for (o, expires) in claims.items() if expires == self.SETTLED])
+            checkpoint = self._advance_checkpoint(None, settled)
+            if checkpoint is not None:
+                claims = dict([(o, expires) for (o, expires) in claims.items() if o >= checkpoint])
+            self._write_claims(claims)
+        return checkpoint
+
+    def claim_observations(self, limit=360, lease_seconds=300):
+        """Lease the oldest observations of the default consumer that are neither acknowledged
+        nor claimed, for lease_seconds.  Claimed observations are settled by delete_observations()
+        or update_observation_status() without a transport, or given back by release_observations().
+        """
+        limit = int(limit)
+        now = int(time.time())
+        observations = []
+        with self._claims_locked():
+            self._refresh_checkpoint()
+            start = self._start_offset(None)
+            claims = dict([(o, expires) for (o, expires) in self._read_claims().items()
+                           if o >= start and (expires == self.SETTLED or expires > now)])
+            acked = self.acked.get(self.DEFAULT_CONSUMER, set())
+            for (offset, payload) in self._iter_records(start):
+                if len(observations) >= limit:
+                    break
+                if offset in claims or offset in acked:
+                    continue
+                claims[offset] = now + lease_seconds
+                observations.append(self._decode(offset, payload))
+            self._write_claims(claims)
+        return observations
+
+    def release_observations(self, ids):
+        """Give back claimed observations before their lease expires"""
+        with self._claims_locked():
+            claims = self._read_claims()
+            for i in ids:
+                if claims.get(i - 1, self.SETTLED) != self.SETTLED:
+                    del claims[i - 1]
+            self._write_claims(claims)
+
+    def update_observation_status(self, ids, status=STATUS_ERROR, transport=None):
+        if status != self.STATUS_ERROR:
+            return
+        offsets = set([i - 1 for i in ids])
+        records = []
+        now = int(time.time())
+        for (offset, payload) in self._iter_records(self._start_offset(transport)):
+            if offset in offsets:
+                record = json.dumps(json.loads(bytes(payload).decode('utf-8')) + [1, now],
+                                    separators=self.JSON_SEPARATORS).encode('utf-8')
+                records.append(self.LENGTH_PREFIX.pack(len(record)) + record)
+                offsets.remove(offset)
+                if len(offsets) == 0:
+                    break
+        with self._errors_locked():
+            with open(self._error_log_path(), 'ab') as f:
+                f.write(b''.join(records))
+                self._sync(f)
+        self.delete_observations(ids, transport=transport)
+
+    def compact(self, max_seconds=None):
+        # Segments are unlinked as soon as every transport has acknowledged them
+        return 0
+
+    def retry_observations(self):
+        # Rejected observations are dead letters, the configuration sets retry_max_attempts to 1
+        return 0
+
+    def get_error_observations(self):
+        return [self._decode(None, payload) for (offset, payload) in self._iter_file_records(self._error_log_path())]
+
+    # Dead letters
+
+    def _error_log_path(self):
+        return os.path.join(self.directory, self.ERROR_LOG_NAME)
+
+    @contextmanager
+    def _errors_locked(self):
+        with open(os.path.join(self.directory, self.ERRORS_LOCK_NAME), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def get_dead_letters(self):
+        """Observations rejected by the server, oldest first, see SqliteRepository.get_dead_letters().
+        Those rejected before the time was recorded are dated by the error log.
+        """
+        path = self._error_log_path()
+        dead_letters = []
+        for (offset, payload) in self._iter_file_records(path):
+            record = json.loads(bytes(payload).decode('utf-8'))
+            (attempts, dead_since) = record[6:] if len(record) > 6 else (1, int(os.path.getmtime(path)))
+            dead_letters.append((self._decode(offset, payload), attempts, dead_since))
+        return dead_letters
+
+    def has_dead_letters(self):
+        try:
+            return os.path.getsize(self._error_log_path()) > 0
+        except FileNotFoundError:
+            return False
+
+    def purge_dead_letters(self, ids=None):
+        """Delete dead letters by rewriting the error log, which gives those that are kept new ids.
+
+        :param ids: Ids of the dead letters to delete, or None for all of them
+        :return: Number of dead letters deleted
+        """
+        path = self._error_log_path()
+        with self._errors_locked():
+            kept = []
+            purged = 0
+            for (offset, payload) in self._iter_file_records(path):
+                if ids is None or offset + 1 in ids:
+                    purged += 1
+                else:
+                    kept.append(self.LENGTH_PREFIX.pack(len(payload)) + payload)
+            if purged > 0:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(b''.join(kept))
+                    self._sync(f)
+                os.replace(tmp_path, path)
+        return purged
+
+    # Statistics and queries, which read the log from disk
+
+    def stats(self):
+        """Counts of the observations that some transport has not acknowledged yet, and of dead
+        letters, by datastream, the range of their phenomenon times and the size of the log,
+        with the keys of SqliteRepository.stats().  The records are read from the oldest segment
+        that isn't delivered, so this takes time in proportion to the size of the log.
+        """
+        by_datastream = {}
+        times = []
+        # Observations are acknowledged either for each transport or for the default consumer
+        start = max([self._read_checkpoint(self.DEFAULT_CONSUMER)] +
+                    [min([self._read_checkpoint(self._consumer(t)) for t in self.transports] or [0])])
+        bases = self.segment_bases()
+        if len(bases) > 0:
+            start = max(start, bases[0])
+        records = [(self.STATUS_PENDING, payload) for (offset, payload) in self._iter_records(start)]
+        records.extend([(self.STATUS_DEAD_LETTER, payload)
+                        for (offset, payload) in self._iter_file_records(self._error_log_path())])
+        for (status, payload) in records:
+            record = json.loads(bytes(payload).decode('utf-8'))
+            counts = by_datastream.setdefault(record[2], {})
+            counts[status] = counts.get(status, 0) + 1
+            times.append(SqliteRepository._encode_phenomenon_time(record[3]))
+        size = 0
+        for filename in os.listdir(self.directory):
+            try:
+                size += os.path.getsize(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+        stats = {'by_datastream': by_datastream,
+                 'awaiting_compaction': 0,
+                 'db_size_bytes': size}
+        stats.update(SqliteRepository._time_range(times))
+        stats['oldest_phenomenon_time'] = SqliteRepository._decode_phenomenon_time(stats['oldest_phenomenon_time'])
+        stats['newest_phenomenon_time'] = SqliteRepository._decode_phenomenon_time(stats['newest_phenomenon_time'])
+        return SqliteRepository._summarize_stats(stats)
+
+    def query(self, datastream_id, start=None, end=None, limit=None):
+        """Observations of a datastream or multidatastream whose phenomenon time is from start
+        (inclusive) to end (exclusive), oldest first, whether delivered or not, see
+        SqliteRepository.query().  The log is in order of arrival rather than of time, so every
+        segment on disk is read, keeping no more than limit matches in memory.
+
+        :return: Iterator of observations
+        """
+        start = SqliteRepository._encode_query_time(start)
+        end = SqliteRepository._encode_query_time(end)
+        start = SqliteRepository.MIN_TIME if start is None else start
+        end = SqliteRepository.MAX_TIME if end is None else end
+
+        def matches():
+            bases = self.segment_bases()
+            for (offset, payload) in self._iter_records(bases[0] if len(bases) > 0 else 0):
+                record = json.loads(bytes(payload).decode('utf-8'))
+                if record[2] != datastream_id:
+                    continue
+                t = SqliteRepository._encode_phenomenon_time(record[3])
+                if isinstance(t, int) and start <= t < end:
+                    yield (t, offset, bytes(payload))
+
+        if limit is None:
+            found = sorted(matches())
+        else:
+            found = heapq.nsmallest(limit, matches())
+        return iter([self._decode(offset, payload) for (t, offset, payload) in found])
+
+    def get_all_observations(self):
+        """Pending observations followed by those in the error log, which have no id"""
+        return list(self.iter_observations()) + self.get_error_observations()
+
+    def close(self):
+        if self._writer is not None and self._writer_pid == os.getpid():
+            self._writer.close()
+        self._writer = None
+        self._writer_pid = None
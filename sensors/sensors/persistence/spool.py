@@ -1,31 +1,132 @@
+import sys
+import queue
+import time
+import signal
+
 from sensors.config import Config
+from sensors.common.constants import CFG_SPOOLER_BATCH_SIZE, CFG_SPOOLER_BATCH_MAX_WAIT_SEC, CFG_SPOOLER_ROLLUP_PATH
 from sensors.common.logging import configure_logger
 from sensors.domain.observation import Observation
 from sensors.domain.multiobservation import MultiObservation
-from sensors.persistence.sqlite import SqliteRepository
+from sensors.persistence import get_repository_instance
+from sensors.persistence.buffer import BufferedRepository
+from sensors.persistence.rollup import Rollups
+
+
+def _exit_on_sigterm(signum, frame):
+    # Unwind through spool_data() so that buffered observations are flushed
+    sys.exit(0)
+
+
+def get_batch(q, batch_size, max_wait_seconds, first_wait_seconds=None, batch=None):
+    """Block until one observation is available, then drain q until batch_size
+    observations have been read or max_wait_seconds have elapsed.
+
+    :param first_wait_seconds: If not None, return an empty list if no observation becomes
+        available within this many seconds
+    :param batch: List to append the objects to as they are read, so that the caller still
+        has them if reading is interrupted, or None for a new list
+    :return: List of objects read from the queue
+    """
+    batch = [] if batch is None else batch
+    try:
+        batch.append(q.get(timeout=first_wait_seconds))
+    except queue.Empty:
+        return batch
+    deadline = time.monotonic() + max_wait_seconds
+    while len(batch) < batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(q.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
 
 
 def spool_data(q):
     config = Config().config
     logger = configure_logger(config)
     logger.info("Spooler: entering.")
-    repo = SqliteRepository(config)
+    repo = get_repository_instance(config, buffered=True)
+    rollups = Rollups(config) if config[CFG_SPOOLER_ROLLUP_PATH] is not None else None
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    batch_size = config[CFG_SPOOLER_BATCH_SIZE]
+    max_wait = config[CFG_SPOOLER_BATCH_MAX_WAIT_SEC]
+    received = []
+    try:
+        _spool_loop(q, repo, batch_size, max_wait, logger, rollups=rollups, received=received)
+    finally:
+        # Don't be interrupted again while the last observations are stored
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        _store_remaining(q, received, repo, logger, rollups=rollups)
+        if isinstance(repo, BufferedRepository):
+            # Flush before rollups are closed, so that the last observations are rolled up too
+            created = repo.flush()
+            if rollups is not None and len(created) > 0:
+                rollups.add(created)
+        if rollups is not None:
+            rollups.close()
+        repo.close()
+        if isinstance(repo, BufferedRepository):
+            logger.info("Spooler: buffer statistics: {0}".format(repo.get_buffer_stats()))
+    logger.info("Spooler: exiting.")
+
+
+def _spool_loop(q, repo, batch_size, max_wait, logger, rollups=None, received=None):
+    """Store observations from q until interrupted
+
+    :param received: List holding the objects read from q that are not stored yet, which
+        the caller stores if the loop is interrupted, e.g. on SIGTERM
+    """
+    received = [] if received is None else received
     while True:
         try:
             logger.debug("Spooler: getting from queue...")
-            obs = q.get()
-            logger.debug("Spooler: received observation: {0}".format(str(obs)))
-            if isinstance(obs, Observation):
-                repo.create_observation(obs)
-            elif isinstance(obs, MultiObservation):
-                repo.create_multiobservation(obs)
-            else:
-                raise TypeError("Observation of type {0} is unknown".format(obs.__class__.__name__))
-            logger.debug("Spooler: observation stored in database")
+            # Wake up in time to flush the buffer even if no observations arrive
+            first_wait = repo.seconds_until_flush() if isinstance(repo, BufferedRepository) else None
+            get_batch(q, batch_size, max_wait, first_wait_seconds=first_wait, batch=received)
+            _store(received, repo, logger, rollups=rollups)
+            del received[:]
         except KeyboardInterrupt:
             break
         except Exception as e:
+            del received[:]
             logger.exception("Spooler: caught exception: {0}".format(str(e)))
         finally:
             pass
-    logger.info("Spooler: exiting.")
+
+
+def _store(received, repo, logger, rollups=None):
+    batch = []
+    for obs in received:
+        logger.debug("Spooler: received observation: {0}".format(str(obs)))
+        if isinstance(obs, (Observation, MultiObservation)):
+            batch.append(obs)
+        else:
+            logger.error("Spooler: observation of type {0} is unknown, discarding.".
+                         format(obs.__class__.__name__))
+    created = repo.create_observations(batch)
+    logger.debug("Spooler: {0} observations stored in database".format(len(created)))
+    # Duplicates the spool ignored must not be counted twice
+    if rollups is not None and len(created) > 0:
+        rollups.add(created)
+
+
+def _store_remaining(q, received, repo, logger, rollups=None):
+    """Store the objects read from q but not stored yet, and those still in q, when exiting.
+    Observations stored twice, if storing was interrupted, are ignored by the SQLite spool."""
+    while True:
+        try:
+            received.append(q.get_nowait())
+        except queue.Empty:
+            break
+    if len(received) == 0:
+        return
+    try:
+        _store(received, repo, logger, rollups=rollups)
+        logger.info("Spooler: stored {0} observations on exit.".format(len(received)))
+    except Exception as e:
+        logger.exception("Spooler: caught exception storing observations on exit: {0}".format(str(e)))
+    del received[:]
@@ -0,0 +1,28 @@
+import os
+import sys
+import json
+import argparse
+
+from sensors.common.logging import configure_logger
+from sensors.config import Config
+from sensors.common.constants import *
+from sensors.persistence import get_repository_instance
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print statistics of the spool as JSON')
+    parser.add_argument('-c', '--config', type=str, required=False)
+    args = parser.parse_args()
+
+    if args.config is not None:
+        assert (os.path.exists(args.config))
+        os.environ[ENV_YAML_PATH] = args.config
+
+    config = Config().config
+    configure_logger(config)
+    repo = get_repository_instance(config)
+    if not hasattr(repo, 'stats'):
+        sys.exit("Spooler backend {0} does not keep statistics.".format(config[CFG_SPOOLER_BACKEND]))
+
+    print(json.dumps(repo.stats(), indent=2, sort_keys=True))
+    repo.close()
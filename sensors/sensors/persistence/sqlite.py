@@ -1,121 +1,1291 @@
+import os
+import re
+import json
+import math
+import sys
+import struct
+import time
+import heapq
 import sqlite3
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 
-from sensors.common.constants import CFG_SPOOLER_DB_PATH
+from sensors.common.constants import (CFG_SPOOLER_DB_PATH, CFG_SPOOLER_SYNCHRONOUS, CFG_SPOOLER_BUSY_TIMEOUT_MS,
+                                      CFG_SPOOLER_MAX_BYTES, CFG_SPOOLER_MAX_ROWS, CFG_SPOOLER_MAX_AGE_HOURS,
+                                      CFG_SPOOLER_EVICTION_POLICY, CFG_SPOOLER_EVICTION_BATCH_SIZE,
+                                      CFG_SPOOLER_THIN_FACTOR, CFG_SPOOLER_EVICTION_POLICY_THIN,
+                                      CFG_SPOOLER_EVICTION_POLICY_DROP_ERRORS_FIRST, CFG_SPOOLER_RETRY_MAX_ATTEMPTS,
+                                      CFG_SPOOLER_RETRY_BACKOFF_SEC, CFG_SPOOLER_RETRY_MAX_BACKOFF_SEC, CFG_TRANSPORTS,
+                                      CFG_SPOOLER_COMPACTION_BATCH_SIZE, CFG_SPOOLER_ARCHIVE_PATH)
 from sensors.domain.observation import Observation
 from sensors.domain.multiobservation import MultiObservation
 from sensors.common import logging
+from sensors.persistence import migration
+from sensors.persistence.archive import Archive
 
 
 class SqliteRepository:
 
     STATUS_PENDING = "PENDING"
     STATUS_ERROR = "ERROR"
+    # Claimed by a sender with claim_observations() until lease_expires
+    STATUS_IN_FLIGHT = "IN_FLIGHT"
+    # Status under which dead letters are counted in observation_counter
+    STATUS_DEAD_LETTER = "DEAD_LETTER"
 
+    # Version of the on-disk schema, stored in PRAGMA user_version.  Version 1 stores
+    #   MultiObservation results as packed little-endian doubles and parameters as compact JSON.
+    #   Version 2 adds the trigger-maintained observation_count table.  Version 3 makes ids
+    #   AUTOINCREMENT, so that they are never re-used and can serve as per-transport cursors.
+    #   Version 4 adds the IN_FLIGHT status and lease_expires column used by claim_observations().
+    #   Version 5 adds the attempts and next_attempt columns used to retry rejected observations,
+    #   and the dead_letter table.  Version 6 stores phenomenonTime as microseconds since the epoch
+    #   and adds a unique index on (datastreamId, phenomenonTime) to drop duplicate observations.
+    #   Version 7 adds the trigger-maintained observation_counter table used by stats().  Version 8
+    #   also counts delivered observations in observation_count, so that they can be left out.
+    #   Each version has a step in _get_migrations().
+    SCHEMA_VERSION = 8
+
+    # Separator used for MultiObservation results before schema version 1
     MULTI_OBS_SEP = ','
+    RESULT_STRUCT_FMT = '<{0}d'
+    RESULT_STRUCT_SIZE = 8
+    PHENOMENON_TIME_RE = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d{1,6})\d*)?'
+                                    r'(Z|[+-]\d{2}:?\d{2})?$')
+    PHENOMENON_TIME_FMT = '%Y-%m-%dT%H:%M:%S'
+    EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    MICROSECOND = timedelta(microseconds=1)
+    # Bounds of encoded phenomenon times, for queries with no start or end
+    MIN_TIME = -(1 << 63)
+    MAX_TIME = (1 << 63) - 1
 
     SQL_CREATE_OBS_TABLE = '''CREATE TABLE IF NOT EXISTS observation 
-    (id INTEGER PRIMARY KEY ASC,
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
     featureOfInterestId TEXT,
     datastreamId TEXT NOT NULL,
-    phenomenonTime DATETIME,
+    phenomenonTime INTEGER,
     result TEXT NOT NULL,
     parameters TEXT,
-    status TEXT NOT NULL CHECK (status="PENDING" or status="ERROR") DEFAULT "PENDING",
-    is_multiobservation INTEGER NOT NULL CHECK(is_multiobservation = 0 or is_multiobservation = 1) DEFAULT 0)
+    status TEXT NOT NULL CHECK (status="PENDING" or status="ERROR" or status="IN_FLIGHT") DEFAULT "PENDING",
+    is_multiobservation INTEGER NOT NULL CHECK(is_multiobservation = 0 or is_multiobservation = 1) DEFAULT 0,
+    lease_expires INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt INTEGER)
     '''
-    SQL_CREATE_OBS = ("INSERT INTO observation "
+    SQL_CREATE_OBS = ("INSERT OR IGNORE INTO observation "
                       "(featureOfInterestId, datastreamId, phenomenonTime, result, parameters) "
                       "VALUES (?, ?, ?, ?, ?)"
                       )
-    SQL_CREATE_MULT_OBS = ("INSERT INTO observation "
+    SQL_CREATE_MULT_OBS = ("INSERT OR IGNORE INTO observation "
                            "(featureOfInterestId, datastreamId, phenomenonTime, result, parameters, is_multiobservation) "
                            "VALUES (?, ?, ?, ?, ?, 1)"
                           )
-    SQL_GET_OBS = 'SELECT * FROM observation WHERE status="PENDING" LIMIT ?'
-    SQL_GET_ALL_OBS = 'SELECT * FROM observation'
-    SQL_DELETE_OBS = "DELETE FROM observation WHERE id IN ({0})"
-    SQL_UPDATE_STATUS = 'UPDATE observation SET status="{0}" WHERE id IN ({1})'
+    SQL_CREATE_OBS_BULK = ("INSERT OR IGNORE INTO observation "
+                           "(featureOfInterestId, datastreamId, phenomenonTime, result, parameters, is_multiobservation) "
+                           "VALUES (?, ?, ?, ?, ?, ?)"
+                           )
+    SQL_CREATE_OBS_UNIQUE_IDX = ("CREATE UNIQUE INDEX IF NOT EXISTS observation_datastream_time_idx "
+                                 "ON observation (datastreamId, phenomenonTime)")
+    SQL_CREATE_OBS_PENDING_IDX = ("CREATE INDEX IF NOT EXISTS observation_pending_idx "
+                                  "ON observation (id) WHERE status='PENDING'")
+    SQL_CREATE_OBS_ERROR_IDX = ("CREATE INDEX IF NOT EXISTS observation_error_idx "
+                                "ON observation (id) WHERE status='ERROR'")
+    SQL_CREATE_OBS_IN_FLIGHT_IDX = ("CREATE INDEX IF NOT EXISTS observation_in_flight_idx "
+                                    "ON observation (lease_expires) WHERE status='IN_FLIGHT'")
+    SQL_CREATE_OBS_RETRY_IDX = ("CREATE INDEX IF NOT EXISTS observation_retry_idx "
+                                "ON observation (next_attempt) WHERE status='ERROR'")
+    SQL_CREATE_OBS_TIME_IDX = "CREATE INDEX IF NOT EXISTS observation_time_idx ON observation (phenomenonTime)"
+    SQL_CREATE_DEAD_LETTER_TABLE = '''CREATE TABLE IF NOT EXISTS dead_letter
+    (id INTEGER PRIMARY KEY,
+    featureOfInterestId TEXT,
+    datastreamId TEXT NOT NULL,
+    phenomenonTime INTEGER,
+    result TEXT NOT NULL,
+    parameters TEXT,
+    is_multiobservation INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL,
+    dead_since INTEGER NOT NULL)
+    '''
+    # delivered counts the delivered observations (see SQL_PURGE_DELIVERED) up to delivered_id,
+    #   which is -1 until they are counted when the repository is opened
+    SQL_CREATE_OBS_COUNT_TABLE = '''CREATE TABLE IF NOT EXISTS observation_count
+    (id INTEGER PRIMARY KEY CHECK (id = 0),
+    count INTEGER NOT NULL,
+    delivered_id INTEGER NOT NULL DEFAULT -1,
+    delivered INTEGER NOT NULL DEFAULT 0)
+    '''
+    SQL_INIT_OBS_COUNT = "INSERT OR IGNORE INTO observation_count (id, count) VALUES (0, 0)"
+    # Number of observations (and dead letters, with status DEAD_LETTER) by datastream and status
+    SQL_CREATE_OBS_COUNTER_TABLE = '''CREATE TABLE IF NOT EXISTS observation_counter
+    (datastreamId TEXT NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (datastreamId, status))
+    '''
+    SQL_CREATE_OBS_COUNT_INSERT_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS observation_count_insert
+    AFTER INSERT ON observation
+    BEGIN
+        UPDATE observation_count SET count = count + 1,
+        delivered = delivered + (NEW.status = 'PENDING' AND NEW.id <= delivered_id) WHERE id = 0;
+        INSERT OR IGNORE INTO observation_counter (datastreamId, status, count)
+        VALUES (NEW.datastreamId, NEW.status, 0);
+        UPDATE observation_counter SET count = count + 1 WHERE datastreamId = NEW.datastreamId AND status = NEW.status;
+    END
+    '''
+    SQL_CREATE_OBS_COUNT_DELETE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS observation_count_delete
+    AFTER DELETE ON observation
+    BEGIN
+        UPDATE observation_count SET count = count - 1,
+        delivered = delivered - (OLD.status = 'PENDING' AND OLD.id <= delivered_id) WHERE id = 0;
+        UPDATE observation_counter SET count = count - 1 WHERE datastreamId = OLD.datastreamId AND status = OLD.status;
+    END
+    '''
+    SQL_CREATE_OBS_COUNT_UPDATE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS observation_count_update
+    AFTER UPDATE OF status ON observation WHEN OLD.status != NEW.status
+    BEGIN
+        UPDATE observation_count SET delivered = delivered + (NEW.status = 'PENDING') - (OLD.status = 'PENDING')
+        WHERE id = 0 AND OLD.id <= delivered_id;
+        UPDATE observation_counter SET count = count - 1 WHERE datastreamId = OLD.datastreamId AND status = OLD.status;
+        INSERT OR IGNORE INTO observation_counter (datastreamId, status, count)
+        VALUES (NEW.datastreamId, NEW.status, 0);
+        UPDATE observation_counter SET count = count + 1 WHERE datastreamId = NEW.datastreamId AND status = NEW.status;
+    END
+    '''
+    SQL_CREATE_DEAD_LETTER_COUNT_INSERT_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS dead_letter_count_insert
+    AFTER INSERT ON dead_letter
+    BEGIN
+        INSERT OR IGNORE INTO observation_counter (datastreamId, status, count)
+        VALUES (NEW.datastreamId, 'DEAD_LETTER', 0);
+        UPDATE observation_counter SET count = count + 1
+        WHERE datastreamId = NEW.datastreamId AND status = 'DEAD_LETTER';
+    END
+    '''
+    SQL_CREATE_DEAD_LETTER_COUNT_DELETE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS dead_letter_count_delete
+    AFTER DELETE ON dead_letter
+    BEGIN
+        UPDATE observation_counter SET count = count - 1
+        WHERE datastreamId = OLD.datastreamId AND status = 'DEAD_LETTER';
+    END
+    '''
+    SQL_DROP_COUNT_TRIGGERS = ("DROP TRIGGER IF EXISTS observation_count_insert",
+                               "DROP TRIGGER IF EXISTS observation_count_delete",
+                               "DROP TRIGGER IF EXISTS observation_count_update",
+                               "DROP TRIGGER IF EXISTS dead_letter_count_insert",
+                               "DROP TRIGGER IF EXISTS dead_letter_count_delete")
+    SQL_MIGRATE_V7_OBS_COUNTERS = ("INSERT INTO observation_counter (datastreamId, status, count) "
+                                   "SELECT datastreamId, status, COUNT(*) FROM observation "
+                                   "GROUP BY datastreamId, status")
+    SQL_MIGRATE_V7_DEAD_LETTER_COUNTERS = ("INSERT INTO observation_counter (datastreamId, status, count) "
+                                           "SELECT datastreamId, 'DEAD_LETTER', COUNT(*) FROM dead_letter "
+                                           "GROUP BY datastreamId")
+    SQL_GET_OBS_COUNTERS = "SELECT datastreamId, status, count FROM observation_counter WHERE count > 0"
+    SQL_GET_OLDEST_PHENOMENON_TIME = "SELECT min(phenomenonTime) FROM observation WHERE datastreamId = ?"
+    SQL_GET_NEWEST_PHENOMENON_TIME = "SELECT max(phenomenonTime) FROM observation WHERE datastreamId = ?"
+    SQL_MIGRATE_V2_OBS_COUNT = "UPDATE observation_count SET count = (SELECT COUNT(*) FROM observation) WHERE id = 0"
+    SQL_GET_OBS_COUNT = "SELECT count - delivered FROM observation_count WHERE id = 0"
+    SQL_GET_OBS_COUNT_COLUMNS = "PRAGMA table_info(observation_count)"
+    SQL_MIGRATE_V8_ADD_DELIVERED_ID = ("ALTER TABLE observation_count "
+                                       "ADD COLUMN delivered_id INTEGER NOT NULL DEFAULT -1")
+    SQL_MIGRATE_V8_ADD_DELIVERED = "ALTER TABLE observation_count ADD COLUMN delivered INTEGER NOT NULL DEFAULT 0"
+    SQL_RESET_DELIVERED_COUNT = "UPDATE observation_count SET delivered_id = -1, delivered = 0 WHERE id = 0"
+    # Parameters are the delivered id, repeated.  The count is only updated if the delivered id moved,
+    #   by counting the observations between the old and the new delivered id.
+    SQL_RECOUNT_DELIVERED = ("UPDATE observation_count SET "
+                             "delivered = (SELECT count(*) FROM observation WHERE status='PENDING' AND id <= ?), "
+                             "delivered_id = ? WHERE id = 0 AND delivered_id < 0")
+    SQL_ADVANCE_DELIVERED_COUNT = ("UPDATE observation_count SET "
+                                   "delivered = delivered + (SELECT count(*) FROM observation WHERE status='PENDING' "
+                                   "AND id > observation_count.delivered_id AND id <= ?), "
+                                   "delivered_id = ? WHERE id = 0 AND delivered_id >= 0 AND delivered_id < ?")
+    SQL_RETREAT_DELIVERED_COUNT = ("UPDATE observation_count SET "
+                                   "delivered = delivered - (SELECT count(*) FROM observation WHERE status='PENDING' "
+                                   "AND id > ? AND id <= observation_count.delivered_id), "
+                                   "delivered_id = ? WHERE id = 0 AND delivered_id > ?")
+    SQL_EVICT_OLDEST = "DELETE FROM observation WHERE id IN (SELECT id FROM observation ORDER BY id LIMIT ?)"
+    SQL_EVICT_ERRORS = ("DELETE FROM observation WHERE id IN "
+                        "(SELECT id FROM observation WHERE status='ERROR' ORDER BY id LIMIT ?)")
+    # Parameters are the cutoff time, the delivered id and the limit.  Expired observations are found
+    #   through observation_time_idx, and delivered ones are left for compact() to archive and purge.
+    SQL_EVICT_EXPIRED = ("DELETE FROM observation WHERE id IN (SELECT id FROM observation "
+                         "WHERE phenomenonTime < ? AND (status != 'PENDING' OR id > ?) LIMIT ?)")
+    SQL_GET_OLDEST_IDS = "SELECT id, datastreamId FROM observation ORDER BY id LIMIT ?"
+    SQL_DELETE_OBS_BY_ID = "DELETE FROM observation WHERE id = ?"
+    SQL_CREATE_TRANSPORT_CURSOR_TABLE = '''CREATE TABLE IF NOT EXISTS transport_cursor
+    (transport TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL)
+    '''
+    SQL_CREATE_DELIVERY_ERROR_TABLE = '''CREATE TABLE IF NOT EXISTS delivery_error
+    (observation_id INTEGER NOT NULL,
+    transport TEXT NOT NULL,
+    PRIMARY KEY (observation_id, transport))
+    '''
+    # Observations a transport acknowledged past its cursor, which can't move over observations
+    #   before them that are still claimed or not yet acknowledged
+    SQL_CREATE_ACKED_AHEAD_TABLE = '''CREATE TABLE IF NOT EXISTS acknowledged_ahead
+    (transport TEXT NOT NULL,
+    observation_id INTEGER NOT NULL,
+    PRIMARY KEY (transport, observation_id)) WITHOUT ROWID
+    '''
+    SQL_INIT_TRANSPORT_CURSOR = "INSERT OR IGNORE INTO transport_cursor (transport, last_id) VALUES (?, 0)"
+    SQL_ADVANCE_TRANSPORT_CURSOR = "UPDATE transport_cursor SET last_id = max(last_id, ?) WHERE transport = ?"
+    SQL_GET_TRANSPORT_CURSORS = "SELECT transport, last_id FROM transport_cursor"
+    SQL_GET_IDS_IN_RANGE = "SELECT id FROM observation WHERE id > ? AND id <= ? AND status != 'ERROR'"
+    SQL_HAS_ACKED_AHEAD = "SELECT EXISTS (SELECT 1 FROM acknowledged_ahead WHERE transport = ?)"
+    SQL_CREATE_ACKED_AHEAD = "INSERT OR IGNORE INTO acknowledged_ahead (transport, observation_id) VALUES (?, ?)"
+    SQL_GET_FIRST_UNACKED = ("SELECT id FROM observation WHERE id > ? AND status != 'ERROR' AND id NOT IN "
+                             "(SELECT observation_id FROM acknowledged_ahead WHERE transport = ?) ORDER BY id LIMIT 1")
+    SQL_GET_LAST_ACKED_AHEAD = ("SELECT max(observation_id) FROM acknowledged_ahead "
+                                "WHERE transport = ? AND observation_id < ?")
+    SQL_DELETE_ACKED_AHEAD = "DELETE FROM acknowledged_ahead WHERE transport = ? AND observation_id <= ?"
+    SQL_CREATE_DELIVERY_ERROR = "INSERT OR IGNORE INTO delivery_error (observation_id, transport) VALUES (?, ?)"
+    # Parameters are the current time, retry_max_backoff_seconds and retry_backoff_seconds.
+    #   The exponent is capped as SQLite shifts by 64 or more bits to 0.
+    SQL_FAIL_OBS_SET = ("status='ERROR', lease_expires=NULL, attempts = attempts + 1, "
+                        "next_attempt = ? + min(?, ? << min(attempts, 30))")
+    # Bulk operations on ids bind ID_CHUNK_SIZE ids per execution, see _id_chunks()
+    ID_CHUNK_SIZE = 500
+    ID_CHUNK_PLACEHOLDERS = ",".join(["?"] * ID_CHUNK_SIZE)
+    SQL_FAIL_OBS = "UPDATE observation SET " + SQL_FAIL_OBS_SET + " WHERE id IN (" + ID_CHUNK_PLACEHOLDERS + ")"
+    SQL_MARK_DELIVERY_ERRORS = ("UPDATE observation SET " + SQL_FAIL_OBS_SET + " WHERE id IN "
+                                "(SELECT observation_id FROM delivery_error WHERE observation_id <= ?)")
+    SQL_BURY_OBS = ("INSERT INTO dead_letter (id, featureOfInterestId, datastreamId, phenomenonTime, result, "
+                    "parameters, is_multiobservation, attempts, dead_since) "
+                    "SELECT id, featureOfInterestId, datastreamId, phenomenonTime, result, parameters, "
+                    "is_multiobservation, attempts, ? FROM observation WHERE status='ERROR' AND attempts >= ?")
+    SQL_DELETE_BURIED_OBS = "DELETE FROM observation WHERE status='ERROR' AND attempts >= ?"
+    SQL_GET_DUE_RETRIES = ("SELECT id, featureOfInterestId, datastreamId, phenomenonTime, result, parameters, "
+                           "is_multiobservation, attempts FROM observation "
+                           "WHERE status='ERROR' AND next_attempt <= ? ORDER BY id")
+    # Retried observations are re-inserted, so that their new id is past the cursor of every transport
+    SQL_REQUEUE_OBS = ("INSERT INTO observation "
+                       "(featureOfInterestId, datastreamId, phenomenonTime, result, parameters, is_multiobservation, "
+                       "attempts) VALUES (?, ?, ?, ?, ?, ?, ?)")
+    SQL_GET_DEAD_LETTERS = ("SELECT id, featureOfInterestId, datastreamId, phenomenonTime, result, parameters, "
+                            "'ERROR', is_multiobservation, attempts, dead_since FROM dead_letter ORDER BY id")
+    SQL_GET_DEAD_LETTER_IDS = "SELECT id FROM dead_letter ORDER BY id"
+    SQL_HAS_DEAD_LETTERS = "SELECT EXISTS (SELECT 1 FROM dead_letter)"
+    SQL_REQUEUE_DEAD_LETTER = ("INSERT OR IGNORE INTO observation "
+                               "(featureOfInterestId, datastreamId, phenomenonTime, result, parameters, "
+                               "is_multiobservation) "
+                               "SELECT featureOfInterestId, datastreamId, phenomenonTime, result, parameters, "
+                               "is_multiobservation FROM dead_letter WHERE id = ?")
+    SQL_DELETE_DEAD_LETTER = "DELETE FROM dead_letter WHERE id = ?"
+    # Pending observations up to the id that every transport has acknowledged are delivered,
+    #   and are hidden from readers until compact() purges them.
+    SQL_PURGE_DELIVERED = ("DELETE FROM observation WHERE id IN "
+                           "(SELECT id FROM observation WHERE status='PENDING' AND id <= ? ORDER BY id LIMIT ?)")
+    SQL_GET_DELIVERED = "SELECT * FROM observation WHERE status='PENDING' AND id <= ? ORDER BY id LIMIT ?"
+    SQL_PURGE_DELIVERED_UP_TO = "DELETE FROM observation WHERE status='PENDING' AND id <= ?"
+    SQL_GET_OBS_BY_IDS = "SELECT * FROM observation WHERE id IN (" + ID_CHUNK_PLACEHOLDERS + ")"
+    SQL_COUNT_DELIVERED_BY_DATASTREAM = ("SELECT datastreamId, count(*) FROM observation "
+                                         "WHERE status='PENDING' AND id <= ? GROUP BY datastreamId")
+    SQL_DELETE_DELIVERY_ERRORS = "DELETE FROM delivery_error WHERE observation_id <= ?"
+    SQL_REBUILD_OBS_RENAME = "ALTER TABLE observation RENAME TO observation_old"
+    SQL_REBUILD_OBS_CHUNK_END = ("SELECT max(id) FROM "
+                                 "(SELECT id FROM observation_old WHERE id > ? ORDER BY id LIMIT ?)")
+    SQL_REBUILD_OBS_COPY = ("INSERT INTO observation "
+                            "(id, featureOfInterestId, datastreamId, phenomenonTime, result, parameters, status, "
+                            "is_multiobservation) "
+                            "SELECT id, featureOfInterestId, datastreamId, phenomenonTime, result, parameters, status, "
+                            "is_multiobservation FROM observation_old WHERE id > ? AND id <= ?")
+    SQL_REBUILD_OBS_DELETE = "DELETE FROM observation_old WHERE id <= ?"
+    SQL_REBUILD_OBS_DROP = "DROP TABLE observation_old"
+    SQL_RELEASE_EXPIRED_LEASES = ("UPDATE observation SET status='PENDING', lease_expires=NULL "
+                                  "WHERE status='IN_FLIGHT' AND lease_expires <= ?")
+    SQL_GET_OBS_TO_CLAIM = "SELECT * FROM observation WHERE status='PENDING' AND id > ? ORDER BY id LIMIT ?"
+    SQL_GET_OBS_TO_CLAIM_FOR_TRANSPORT = ("SELECT * FROM observation WHERE status='PENDING' AND id > ? AND id NOT IN "
+                                          "(SELECT observation_id FROM acknowledged_ahead WHERE transport = ?) "
+                                          "ORDER BY id LIMIT ?")
+    SQL_CLAIM_OBS = "UPDATE observation SET status='IN_FLIGHT', lease_expires=? WHERE id=?"
+    SQL_RELEASE_OBS = "UPDATE observation SET status='PENDING', lease_expires=NULL WHERE id=? AND status='IN_FLIGHT'"
+    SQL_SETTLE_CLAIMS = ("UPDATE observation SET status='PENDING', lease_expires=NULL "
+                         "WHERE status='IN_FLIGHT' AND id IN (" + ID_CHUNK_PLACEHOLDERS + ")")
+    SQL_MIGRATE_V5_ADD_ATTEMPTS = "ALTER TABLE observation ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+    SQL_MIGRATE_V5_ADD_NEXT_ATTEMPT = "ALTER TABLE observation ADD COLUMN next_attempt INTEGER"
+    # Observations parked as ERROR before retries existed get retried once more
+    SQL_MIGRATE_V5_SCHEDULE_ERRORS = "UPDATE observation SET next_attempt = 0 WHERE status='ERROR'"
+    SQL_GET_OBS_COLUMNS = "PRAGMA table_info(observation)"
+    SQL_GET_PHENOMENON_TIMES_CHUNK = "SELECT id, phenomenonTime FROM observation WHERE id > ? ORDER BY id LIMIT ?"
+    SQL_GET_TEXT_PHENOMENON_TIMES = "SELECT id, phenomenonTime FROM {0} WHERE typeof(phenomenonTime) = 'text'"
+    SQL_UPDATE_PHENOMENON_TIME = "UPDATE {0} SET phenomenonTime = ? WHERE id = ?"
+    SQL_DELETE_DUPLICATE_OBS = ("DELETE FROM observation WHERE phenomenonTime IS NOT NULL AND id NOT IN "
+                                "(SELECT min(id) FROM observation GROUP BY datastreamId, phenomenonTime)")
+    SQL_GET_OBS = "SELECT * FROM observation WHERE status='PENDING' AND id > ? ORDER BY id LIMIT ?"
+    SQL_GET_OBS_BY_DATASTREAM = ("SELECT * FROM (" + SQL_GET_OBS + ") "
+                                 "ORDER BY is_multiobservation, datastreamId, id")
+    SQL_GET_ALL_OBS = "SELECT * FROM observation WHERE status != 'PENDING' OR id > ?"
+    # Rows are read from observation_datastream_time_idx in order, so nothing is sorted
+    SQL_QUERY_OBS = ("SELECT * FROM observation WHERE datastreamId = ? AND phenomenonTime >= ? AND phenomenonTime < ? "
+                     "ORDER BY phenomenonTime")
+    SQL_TABLE_EXISTS = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+    SQL_GET_OBS_FOR_MIGRATION_V1 = ('SELECT id, result, parameters, is_multiobservation FROM observation '
+                                    'WHERE id > ? ORDER BY id LIMIT ?')
+    SQL_UPDATE_OBS_FOR_MIGRATION_V1 = 'UPDATE observation SET result=?, parameters=? WHERE id=?'
+    SQL_DELETE_OBS = "DELETE FROM observation WHERE id IN (" + ID_CHUNK_PLACEHOLDERS + ")"
+    SQL_UPDATE_STATUS = "UPDATE observation SET status=? WHERE id IN (" + ID_CHUNK_PLACEHOLDERS + ")"
 
     MAX_RETRIES = 5
+    # Rows rewritten per transaction by chunked migrations
+    MIGRATION_CHUNK_SIZE = 10000
+    # Upper bound on eviction rounds per call to enforce_spool_budget(), so that a single
+    #   insert never stalls for long even if the budget was shrunk drastically.
+    MAX_EVICTION_ROUNDS = 100
+
+    def _connect(self):
+        # busy_timeout is set via the timeout argument (in seconds) so that it also
+        #   applies while the PRAGMAs below are being run.
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000.0)
+        # Only takes effect on a new database, so must come before anything is written
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous={0}".format(self.synchronous))
+        conn.execute("PRAGMA busy_timeout={0}".format(self.busy_timeout_ms))
+        return conn
+
+    def _get_connection(self):
+        """Return the connection for this process, opening it if necessary.
+
+        The spooler and transmitter run in separate processes, and a connection must
+        never be shared across a fork, so the connection is keyed by PID.
+        """
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            self._conn = self._connect()
+            self._conn_pid = pid
+        return self._conn
 
     def _perform_action_with_connection(self, action):
-        with sqlite3.connect(self.db_path) as conn:
-            action(conn)
-            conn.commit()
+        conn = self._get_connection()
+        with conn:
+            return action(conn)
 
     def __init__(self, config):
         self.db_path = config[CFG_SPOOLER_DB_PATH]
-        self._perform_action_with_connection(SqliteRepository._create_tables)
+        self.synchronous = config[CFG_SPOOLER_SYNCHRONOUS]
+        self.busy_timeout_ms = config[CFG_SPOOLER_BUSY_TIMEOUT_MS]
+        self.max_bytes = config[CFG_SPOOLER_MAX_BYTES]
+        self.max_rows = config[CFG_SPOOLER_MAX_ROWS]
+        self.max_age_hours = config[CFG_SPOOLER_MAX_AGE_HOURS]
+        self.eviction_policy = config[CFG_SPOOLER_EVICTION_POLICY]
+        self.eviction_batch_size = config[CFG_SPOOLER_EVICTION_BATCH_SIZE]
+        self.thin_factor = config[CFG_SPOOLER_THIN_FACTOR]
+        self.compaction_batch_size = config[CFG_SPOOLER_COMPACTION_BATCH_SIZE]
+        # Delivered observations are written to the archive, if any, as they are purged
+        self.archive = Archive(config) if config[CFG_SPOOLER_ARCHIVE_PATH] is not None else None
+        self.retry_max_attempts = config[CFG_SPOOLER_RETRY_MAX_ATTEMPTS]
+        self.retry_backoff_seconds = config[CFG_SPOOLER_RETRY_BACKOFF_SEC]
+        self.retry_max_backoff_seconds = config[CFG_SPOOLER_RETRY_MAX_BACKOFF_SEC]
+        # Observations are only removed once every configured transport has acknowledged them
+        self.transports = [t.identifier() for t in config[CFG_TRANSPORTS]]
+        self._conn = None
+        self._conn_pid = None
+        self.duplicates_ignored = 0
         self.logger = logging.get_instance()
+        self._enable_incremental_vacuum(self._get_connection())
+        SqliteRepository._create_tables(self._get_connection())
+        # Transports may have been added to or removed from the configuration
+        self._perform_action_with_connection(self._update_delivered_count)
+
+    def close(self):
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._conn_pid = None
+
+    def _enable_incremental_vacuum(self, conn):
+        """Make sure pages freed by eviction can be returned to the file system.
+
+        New databases are created with auto_vacuum=INCREMENTAL (see _connect()), older ones
+        can only be converted by a full VACUUM.  The VACUUM is only worth its one-time cost
+        if the spool has a size budget.
+        """
+        if self.max_bytes is not None and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            self.logger.info("Spooler: converting {0} to incremental vacuum, this may take a while...".
+                             format(self.db_path))
+            conn.execute("VACUUM")
 
     @staticmethod
     def _create_tables(conn):
-        cursor = conn.cursor()
-        SqliteRepository._create_observation_table(cursor)
-        cursor.close()
+        """Create the schema of a new database, or migrate an existing one to SCHEMA_VERSION"""
+        with conn:
+            cursor = conn.cursor()
+            # Take the write lock up front so that concurrent processes don't both initialize
+            cursor.execute("BEGIN IMMEDIATE")
+            if cursor.execute(SqliteRepository.SQL_TABLE_EXISTS, ('observation',)).fetchone() is None:
+                migration.set_version(cursor, SqliteRepository.SCHEMA_VERSION)
+            cursor.close()
+        migration.run_migrations(conn, SqliteRepository._get_migrations(), SqliteRepository.MIGRATION_CHUNK_SIZE,
+                                 before_step=SqliteRepository._drop_count_triggers)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            SqliteRepository._create_observation_table(cursor)
+            if 6 not in migration.get_versions_in_progress(cursor):
+                cursor.execute(SqliteRepository.SQL_CREATE_OBS_UNIQUE_IDX)
+            cursor.close()
+
+    @staticmethod
+    def _get_migrations():
+        return [migration.ChunkedMigration(1, "pack MultiObservation results and parameters",
+                                           SqliteRepository._migrate_v1),
+                migration.Migration(2, "count observations", SqliteRepository._migrate_v2),
+                # Also covers version 3, which changed the id column
+                migration.ChunkedMigration(4, "rebuild observation table", SqliteRepository._rebuild_observation_chunk,
+                                           prepare=SqliteRepository._prepare_observation_rebuild,
+                                           finish=SqliteRepository._finish_observation_rebuild),
+                migration.Migration(5, "add retry columns and dead letters", SqliteRepository._migrate_v5),
+                # Phenomenon times still stored as text are read as they are, so this one runs while
+                #   the spool is in use, see compact()
+                migration.ChunkedMigration(6, "store phenomenon times as integers", SqliteRepository._migrate_v6,
+                                           finish=SqliteRepository._finish_migrate_v6, online=True),
+                migration.Migration(7, "count observations by datastream and status", SqliteRepository._migrate_v7),
+                migration.Migration(8, "count delivered observations", SqliteRepository._migrate_v8)]
+
+    @staticmethod
+    def _drop_count_triggers(cursor):
+        """Counters are not maintained while migrating, as rows are moved between tables.
+        Triggers are re-created by _create_observation_table() once the schema is up to date, and
+        delivered observations are counted again when the repository is opened.
+        """
+        for statement in SqliteRepository.SQL_DROP_COUNT_TRIGGERS:
+            cursor.execute(statement)
+        if 'delivered_id' in [c[1] for c in cursor.execute(SqliteRepository.SQL_GET_OBS_COUNT_COLUMNS)]:
+            cursor.execute(SqliteRepository.SQL_RESET_DELIVERED_COUNT)
+
+    @staticmethod
+    def _migrate_v1(cursor, after_id, chunk_size):
+        """Convert comma-separated MultiObservation results and legacy parameter strings
+        to the packed encodings used from schema version 1.
+        """
+        rows = cursor.execute(SqliteRepository.SQL_GET_OBS_FOR_MIGRATION_V1, (after_id, chunk_size)).fetchall()
+        updates = []
+        for (obs_id, result, parameters, is_multiobservation) in rows:
+            legacy = Observation()
+            legacy.set_parameters_from_str(parameters)
+            if is_multiobservation:
+                result = SqliteRepository._pack_results([float(s) for s in
+                                                         result.split(SqliteRepository.MULTI_OBS_SEP)])
+            updates.append((result, SqliteRepository._encode_parameters(legacy.parameters), obs_id))
+        cursor.executemany(SqliteRepository.SQL_UPDATE_OBS_FOR_MIGRATION_V1, updates)
+        return rows[-1][0] if len(rows) > 0 else None
+
+    @staticmethod
+    def _migrate_v2(cursor):
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_COUNT_TABLE)
+        cursor.execute(SqliteRepository.SQL_INIT_OBS_COUNT)
+        cursor.execute(SqliteRepository.SQL_MIGRATE_V2_OBS_COUNT)
+
+    @staticmethod
+    def _prepare_observation_rebuild(cursor):
+        """Rebuild the observation table with the current definition, which SQLite requires
+        to change the id column (version 3) or a CHECK constraint (version 4).  Rows are moved
+        to the new table a chunk at a time, so the spool never takes twice its size on disk.
+        Indexes are dropped along with the old table and re-created by _create_observation_table().
+        """
+        cursor.execute(SqliteRepository.SQL_REBUILD_OBS_RENAME)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_TABLE)
+
+    @staticmethod
+    def _rebuild_observation_chunk(cursor, after_id, chunk_size):
+        last_id = cursor.execute(SqliteRepository.SQL_REBUILD_OBS_CHUNK_END, (after_id, chunk_size)).fetchone()[0]
+        if last_id is not None:
+            cursor.execute(SqliteRepository.SQL_REBUILD_OBS_COPY, (after_id, last_id))
+            cursor.execute(SqliteRepository.SQL_REBUILD_OBS_DELETE, (last_id,))
+        return last_id
+
+    @staticmethod
+    def _finish_observation_rebuild(cursor):
+        cursor.execute(SqliteRepository.SQL_REBUILD_OBS_DROP)
+
+    @staticmethod
+    def _migrate_v5(cursor):
+        # A table rebuilt by the version 4 migration already has the columns
+        columns = [c[1] for c in cursor.execute(SqliteRepository.SQL_GET_OBS_COLUMNS)]
+        if 'attempts' not in columns:
+            cursor.execute(SqliteRepository.SQL_MIGRATE_V5_ADD_ATTEMPTS)
+        if 'next_attempt' not in columns:
+            cursor.execute(SqliteRepository.SQL_MIGRATE_V5_ADD_NEXT_ATTEMPT)
+        cursor.execute(SqliteRepository.SQL_CREATE_DEAD_LETTER_TABLE)
+        cursor.execute(SqliteRepository.SQL_MIGRATE_V5_SCHEDULE_ERRORS)
+
+    @staticmethod
+    def _encode_phenomenon_times(cursor, table, rows):
+        updates = []
+        for (obs_id, phenomenon_time) in rows:
+            encoded = SqliteRepository._encode_phenomenon_time(phenomenon_time)
+            if encoded != phenomenon_time:
+                updates.append((encoded, obs_id))
+        cursor.executemany(SqliteRepository.SQL_UPDATE_PHENOMENON_TIME.format(table), updates)
+
+    @staticmethod
+    def _migrate_v6(cursor, after_id, chunk_size):
+        """Convert ISO 8601 phenomenon times to integers"""
+        rows = cursor.execute(SqliteRepository.SQL_GET_PHENOMENON_TIMES_CHUNK, (after_id, chunk_size)).fetchall()
+        SqliteRepository._encode_phenomenon_times(cursor, 'observation', rows)
+        return rows[-1][0] if len(rows) > 0 else None
+
+    @staticmethod
+    def _finish_migrate_v6(cursor):
+        """Convert the phenomenon times of dead letters, then drop duplicate observations and
+        create the unique index, which can't exist until every phenomenon time is converted.
+        """
+        SqliteRepository._encode_phenomenon_times(
+            cursor, 'dead_letter', cursor.execute(SqliteRepository.SQL_GET_TEXT_PHENOMENON_TIMES.format('dead_letter')))
+        n = cursor.execute(SqliteRepository.SQL_DELETE_DUPLICATE_OBS).rowcount
+        if n > 0:
+            cursor.execute(SqliteRepository.SQL_MIGRATE_V2_OBS_COUNT)
+            logging.get_instance().warn("Spooler: removed {0} duplicate observations from spool.".format(n))
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_UNIQUE_IDX)
+
+    @staticmethod
+    def _migrate_v7(cursor):
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_COUNTER_TABLE)
+        cursor.execute(SqliteRepository.SQL_MIGRATE_V7_OBS_COUNTERS)
+        cursor.execute(SqliteRepository.SQL_MIGRATE_V7_DEAD_LETTER_COUNTERS)
+
+    @staticmethod
+    def _migrate_v8(cursor):
+        # A table created by the version 2 migration already has the columns
+        columns = [c[1] for c in cursor.execute(SqliteRepository.SQL_GET_OBS_COUNT_COLUMNS)]
+        if 'delivered_id' not in columns:
+            cursor.execute(SqliteRepository.SQL_MIGRATE_V8_ADD_DELIVERED_ID)
+        if 'delivered' not in columns:
+            cursor.execute(SqliteRepository.SQL_MIGRATE_V8_ADD_DELIVERED)
+
+    @staticmethod
+    def _encode_phenomenon_time(phenomenon_time):
+        """Microseconds since the epoch for an ISO 8601 phenomenon time, which is taken to be
+        in UTC if it has no offset.  Times that can't be parsed are stored as they are.
+        """
+        m = None
+        if isinstance(phenomenon_time, str):
+            m = SqliteRepository.PHENOMENON_TIME_RE.match(phenomenon_time)
+        if m is None:
+            return phenomenon_time
+        (seconds, fraction, offset) = m.groups()
+        t = datetime.strptime(seconds, SqliteRepository.PHENOMENON_TIME_FMT).replace(tzinfo=timezone.utc)
+        if fraction is not None:
+            t = t.replace(microsecond=int(fraction.ljust(6, '0')))
+        if offset is not None and offset != 'Z':
+            offset = offset.replace(':', '')
+            delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+            t = t - delta if offset[0] == '+' else t + delta
+        return (t - SqliteRepository.EPOCH) // SqliteRepository.MICROSECOND
+
+    @staticmethod
+    def _decode_phenomenon_time(encoded):
+        if not isinstance(encoded, int):
+            return encoded
+        t = SqliteRepository.EPOCH + timedelta(microseconds=encoded)
+        if t.microsecond == 0:
+            return t.strftime(SqliteRepository.PHENOMENON_TIME_FMT) + 'Z'
+        return t.strftime(SqliteRepository.PHENOMENON_TIME_FMT) + '.{0:06d}Z'.format(t.microsecond)
+
+    @staticmethod
+    def _pack_results(results):
+        # None cannot be packed, store it as NaN which the transport filters out anyway
+        values = [math.nan if r is None else r for r in results]
+        return struct.pack(SqliteRepository.RESULT_STRUCT_FMT.format(len(values)), *values)
+
+    @staticmethod
+    def _unpack_results(packed):
+        count = len(packed) // SqliteRepository.RESULT_STRUCT_SIZE
+        return list(struct.unpack(SqliteRepository.RESULT_STRUCT_FMT.format(count), packed))
+
+    @staticmethod
+    def _encode_parameters(parameters):
+        if not parameters:
+            return None
+        return json.dumps(parameters, separators=(',', ':'))
+
+    @staticmethod
+    def _decode_parameters(encoded):
+        if encoded is None:
+            return {}
+        return json.loads(encoded)
 
     @staticmethod
     def _create_observation_table(cursor):
         cursor.execute(SqliteRepository.SQL_CREATE_OBS_TABLE)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_PENDING_IDX)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_ERROR_IDX)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_IN_FLIGHT_IDX)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_RETRY_IDX)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_TIME_IDX)
+        cursor.execute(SqliteRepository.SQL_CREATE_DEAD_LETTER_TABLE)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_COUNT_TABLE)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_COUNTER_TABLE)
+        cursor.execute(SqliteRepository.SQL_INIT_OBS_COUNT)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_COUNT_INSERT_TRIGGER)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_COUNT_DELETE_TRIGGER)
+        cursor.execute(SqliteRepository.SQL_CREATE_OBS_COUNT_UPDATE_TRIGGER)
+        cursor.execute(SqliteRepository.SQL_CREATE_DEAD_LETTER_COUNT_INSERT_TRIGGER)
+        cursor.execute(SqliteRepository.SQL_CREATE_DEAD_LETTER_COUNT_DELETE_TRIGGER)
+        cursor.execute(SqliteRepository.SQL_CREATE_TRANSPORT_CURSOR_TABLE)
+        cursor.execute(SqliteRepository.SQL_CREATE_DELIVERY_ERROR_TABLE)
+        cursor.execute(SqliteRepository.SQL_CREATE_ACKED_AHEAD_TABLE)
 
     def create_observation(self, o):
-        observation = (o.featureOfInterestId, o.datastreamId,
-                       o.phenomenonTime, o.result, o.get_parameters_as_str())
-        self._perform_action_with_connection(lambda c: c.execute(SqliteRepository.SQL_CREATE_OBS,
-                                                                 observation))
+        observation = self._get_row_from_observation(o)[:-1]
+        n = self._perform_action_with_connection(lambda c: c.execute(SqliteRepository.SQL_CREATE_OBS,
+                                                                     observation).rowcount)
+        self._count_duplicates(1 - n)
+        self.enforce_spool_budget()
 
     def create_multiobservation(self, mo):
-        results = [str(i) for i in mo.result]
-        results_str = self.MULTI_OBS_SEP.join(results)
-        observation = (mo.featureOfInterestId, mo.multidatastreamId,
-                       mo.phenomenonTime, results_str, mo.get_parameters_as_str())
-        self._perform_action_with_connection(lambda c: c.execute(SqliteRepository.SQL_CREATE_MULT_OBS,
-                                                                 observation))
-
-    def get_observations(self, limit="360"):
+        observation = self._get_row_from_multiobservation(mo)[:-1]
+        n = self._perform_action_with_connection(lambda c: c.execute(SqliteRepository.SQL_CREATE_MULT_OBS,
+                                                                     observation).rowcount)
+        self._count_duplicates(1 - n)
+        self.enforce_spool_budget()
+
+    def create_observations(self, observations):
+        """Store any mix of Observations and MultiObservations in a single transaction.
+        Observations with the same datastream and phenomenon time as one already in the spool
+        are ignored, and counted in duplicates_ignored.
+
+        :param observations: Iterable of Observation and/or MultiObservation objects
+        :return: List of the observations stored, without the duplicates
+        """
+        observations = list(observations)
+        rows = [self._get_row(o) for o in observations]
+        if len(rows) == 0:
+            return []
+
+        def insert(conn):
+            return [o for (o, row) in zip(observations, rows)
+                    if conn.execute(SqliteRepository.SQL_CREATE_OBS_BULK, row).rowcount > 0]
+
+        created = self._perform_action_with_connection(insert)
+        self._count_duplicates(len(rows) - len(created))
+        self.enforce_spool_budget()
+        return created
+
+    def _count_duplicates(self, n):
+        if n > 0:
+            self.duplicates_ignored += n
+            self.logger.warn("Spooler: ignored {0} duplicate observations ({1} since start).".
+                             format(n, self.duplicates_ignored))
+
+    def enforce_spool_budget(self):
+        """Evict observations until the spool is within its configured budget.
+
+        Each round deletes at most eviction_batch_size rows found through the primary key
+        or an index, and the row count comes from the observation_count table, so
+        enforcement never scans the whole table.  Delivered observations are never evicted:
+        they are purged, and archived if an archive is configured, by compact().
+
+        :return: Number of observations evicted
+        """
+        if self.max_bytes is None and self.max_rows is None and self.max_age_hours is None:
+            return 0
+        conn = self._get_connection()
+        evicted = 0
+        if self.max_age_hours is not None:
+            cutoff = datetime.now(timezone.utc) - timedelta(hours=self.max_age_hours)
+            cutoff_time = (cutoff - SqliteRepository.EPOCH) // SqliteRepository.MICROSECOND
+            for i in range(self.MAX_EVICTION_ROUNDS):
+                with conn:
+                    n = conn.execute(SqliteRepository.SQL_EVICT_EXPIRED,
+                                     (cutoff_time, self._get_delivered_id(conn), self.eviction_batch_size)).rowcount
+                evicted += n
+                if n < self.eviction_batch_size:
+                    break
+        if self._over_budget(conn):
+            # Delivered observations go before anything is evicted
+            self.compact()
+        for i in range(self.MAX_EVICTION_ROUNDS):
+            if not self._over_budget(conn):
+                break
+            with conn:
+                n = self._evict(conn)
+            if n == 0:
+                break
+            evicted += n
+        if evicted > 0:
+            # incremental_vacuum frees one page per step, executescript() runs it to completion
+            conn.executescript("PRAGMA incremental_vacuum;")
+            self.logger.warn("Spooler: evicted {0} observations to keep spool within budget.".format(evicted))
+        return evicted
+
+    def _over_budget(self, conn):
+        if self.max_rows is not None:
+            if self.get_observation_count() > self.max_rows:
+                return True
+        if self.max_bytes is not None:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            used_pages = (conn.execute("PRAGMA page_count").fetchone()[0] -
+                          conn.execute("PRAGMA freelist_count").fetchone()[0])
+            if used_pages * page_size > self.max_bytes:
+                return True
+        return False
+
+    def _evict(self, conn):
+        if self.eviction_policy == CFG_SPOOLER_EVICTION_POLICY_DROP_ERRORS_FIRST:
+            n = conn.execute(SqliteRepository.SQL_EVICT_ERRORS, (self.eviction_batch_size,)).rowcount
+            if n > 0:
+                return n
+        elif self.eviction_policy == CFG_SPOOLER_EVICTION_POLICY_THIN:
+            return self._evict_thin(conn)
+        return conn.execute(SqliteRepository.SQL_EVICT_OLDEST, (self.eviction_batch_size,)).rowcount
+
+    def _evict_thin(self, conn):
+        """Keep every thin_factor-th of the oldest observations of each datastream.
+        Repeated rounds thin the oldest data ever more coarsely.
+        """
+        ids_by_datastream = OrderedDict()
+        for (obs_id, datastream_id) in conn.execute(SqliteRepository.SQL_GET_OLDEST_IDS,
+                                                    (self.eviction_batch_size,)):
+            ids_by_datastream.setdefault(datastream_id, []).append(obs_id)
+        ids_to_delete = []
+        for ids in ids_by_datastream.values():
+            ids_to_delete.extend([(obs_id,) for (i, obs_id) in enumerate(ids) if i % self.thin_factor != 0])
+        conn.executemany(SqliteRepository.SQL_DELETE_OBS_BY_ID, ids_to_delete)
+        return len(ids_to_delete)
+
+    @staticmethod
+    def _get_row(o):
+        if isinstance(o, Observation):
+            return SqliteRepository._get_row_from_observation(o)
+        elif isinstance(o, MultiObservation):
+            return SqliteRepository._get_row_from_multiobservation(o)
+        else:
+            raise TypeError("Observation of type {0} is unknown".format(o.__class__.__name__))
+
+    @staticmethod
+    def _get_row_from_observation(o):
+        return (o.featureOfInterestId, o.datastreamId,
+                SqliteRepository._encode_phenomenon_time(o.phenomenonTime), o.result, SqliteRepository._encode_parameters(o.parameters), 0)
+
+    @staticmethod
+    def _get_row_from_multiobservation(mo):
+        return (mo.featureOfInterestId, mo.multidatastreamId,
+                SqliteRepository._encode_phenomenon_time(mo.phenomenonTime), SqliteRepository._pack_results(mo.result),
+                SqliteRepository._encode_parameters(mo.parameters), 1)
+
+    def get_observations(self, limit="360", after_id=0, transport=None):
+        """Read pending observations oldest-first.
+
+        :param limit: Maximum number of observations to return
+        :param after_id: Only return observations whose id is greater than this, which allows
+            a caller to page through the spool by passing the id of the last observation read.
+        :param transport: Identifier of the transport reading.  If given, only observations
+            the transport has not yet acknowledged are returned.
+        :return: List of observations, or None if the database could not be read
+        """
         observations = []
 
         attempts = 1
-        with sqlite3.connect(self.db_path) as conn:
-            while attempts < self.MAX_RETRIES:
-                attempts += 1
-                try:
-                    for r in conn.execute(SqliteRepository.SQL_GET_OBS, (limit,)):
-                        observations.append(self._get_observation_from_row(r))
+        conn = self._get_connection()
+        if transport is not None:
+            after_id = max(after_id, self._get_transport_cursor(conn, transport))
+        else:
+            after_id = max(after_id, self._get_delivered_id(conn))
+        while attempts < self.MAX_RETRIES:
+            attempts += 1
+            try:
+                for r in conn.execute(SqliteRepository.SQL_GET_OBS, (after_id, limit)):
+                    observations.append(self._get_observation_from_row(r))
+                break
+            except sqlite3.OperationalError as e:
+                self.logger.warn("Error encountered reading observations from SQLite database, error was: {0}"
+                                 ", will re-try {1} times...".
+                                 format(str(e), self.MAX_RETRIES))
+                observations = []
+                if attempts >= self.MAX_RETRIES:
+                    observations = None
                     break
-                except sqlite3.OperationalError as e:
-                    self.logger.warn("Error encountered reading observations from SQLite database, error was: {0}"
-                                     ", will re-try {1} times...".
-                                     format(str(e), self.MAX_RETRIES))
-                    if attempts >= self.MAX_RETRIES:
-                        observations = None
-                        break
 
         return observations
 
-    def delete_observations(self, ids):
-        with sqlite3.connect(self.db_path) as conn:
-            id_str = ",".join([str(i) for i in ids])
-            # We control the input, so it is not so un-safe to forgo binding parameters
-            conn.execute(SqliteRepository.SQL_DELETE_OBS.format(id_str))
-            conn.commit()
+    def get_observations_by_datastream(self, limit="360", after_id=0, transport=None):
+        """The observations get_observations() would return, ordered by datastream then
+        multidatastream and oldest-first within each, so that a transport can encode them as
+        they are read.  Rows are sorted by SQLite and turned into observations one at a time.
 
-    def update_observation_status(self, ids, status=STATUS_ERROR):
-        with sqlite3.connect(self.db_path) as conn:
-            id_str = ",".join([str(i) for i in ids])
-            # We control the input, so it is not so un-safe to forgo binding parameters
-            conn.execute(SqliteRepository.SQL_UPDATE_STATUS.format(status, id_str))
-            conn.commit()
+        :return: Iterator of observations, or None if the database could not be read
+        """
+        conn = self._get_connection()
+        if transport is not None:
+            after_id = max(after_id, self._get_transport_cursor(conn, transport))
+        else:
+            after_id = max(after_id, self._get_delivered_id(conn))
+        try:
+            rows = conn.execute(SqliteRepository.SQL_GET_OBS_BY_DATASTREAM, (after_id, limit))
+        except sqlite3.OperationalError as e:
+            self.logger.warn("Error encountered reading observations from SQLite database, error was: {0}".
+                             format(str(e)))
+            return None
+        return (self._get_observation_from_row(r) for r in rows)
 
-    def get_all_observations(self):
-        observations = []
+    def iter_observations(self, page_size=360, after_id=0, transport=None):
+        """Generator yielding all pending observations oldest-first, reading page_size
+        rows at a time so that the whole backlog is never held in memory.
+        """
+        while True:
+            observations = self.get_observations(limit=page_size, after_id=after_id, transport=transport)
+            if not observations:
+                break
+            for o in observations:
+                yield o
+            after_id = observations[-1].id
 
-        with sqlite3.connect(self.db_path) as conn:
-            for r in conn.execute(SqliteRepository.SQL_GET_ALL_OBS):
-                observations.append(self._get_observation_from_row(r))
-            conn.commit()
+    def claim_observations(self, limit=360, lease_seconds=300, transport=None):
+        """Atomically mark up to limit pending observations, oldest-first, as IN_FLIGHT and
+        return them, so that concurrent senders never send the same observation twice.
 
-        return observations
+        A claim is settled with delete_observations() or update_observation_status(), or given
+        up with release_observations().  Leases that are not settled within lease_seconds
+        (e.g. because the sender died) expire, and the observations are claimed again.
+
+        :param transport: Identifier of the transport the observations are claimed for.  If
+            given, only observations the transport has not yet acknowledged are claimed.
+        :return: List of observations, or None if the database could not be written
+        """
+        now = int(time.time())
+
+        def claim(conn):
+            # Take the write lock before reading so that no other sender can claim the same rows
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(SqliteRepository.SQL_RELEASE_EXPIRED_LEASES, (now,))
+            if transport is None:
+                after_id = self._get_delivered_id(conn)
+                self._prepare_claim(conn, after_id, limit)
+                rows = conn.execute(SqliteRepository.SQL_GET_OBS_TO_CLAIM, (after_id, limit)).fetchall()
+            else:
+                after_id = self._get_transport_cursor(conn, transport)
+                self._prepare_claim(conn, after_id, limit)
+                rows = conn.execute(SqliteRepository.SQL_GET_OBS_TO_CLAIM_FOR_TRANSPORT,
+                                    (after_id, transport, limit)).fetchall()
+            conn.executemany(SqliteRepository.SQL_CLAIM_OBS, [(now + lease_seconds, r[0]) for r in rows])
+            return [self._get_observation_from_row(r) for r in rows]
+
+        try:
+            return self._perform_action_with_connection(claim)
+        except sqlite3.OperationalError as e:
+            self.logger.warn("Error encountered claiming observations from SQLite database, error was: {0}".
+                             format(str(e)))
+            return None
+
+    def _prepare_claim(self, conn, after_id, limit):
+        """Called by claim_observations() within its transaction, before observations are claimed"""
+        pass
+
+    def release_observations(self, ids):
+        """Return claimed observations to PENDING before their lease expires, e.g. after a
+        failed attempt to send them."""
+        self._perform_action_with_connection(
+            lambda c: c.executemany(SqliteRepository.SQL_RELEASE_OBS, [(i,) for i in ids]))
+
+    def _archive_and_purge(self, conn):
+        """Archive a batch of delivered observations, streaming them from the database, then
+        purge them.  Observations are archived at least once: if the transaction is not
+        committed, they are archived again by the next compaction.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        last_id = [None]
+
+        def delivered():
+            for r in conn.execute(SqliteRepository.SQL_GET_DELIVERED,
+                                  (self._get_delivered_id(conn), self.compaction_batch_size)):
+                last_id[0] = r[0]
+                yield self._get_observation_from_row(r)
+
+        n = self.archive.write(delivered())
+        if n > 0:
+            conn.execute(SqliteRepository.SQL_PURGE_DELIVERED_UP_TO, (last_id[0],))
+        return n
+
+    def _archive_rows(self, rows):
+        if self.archive is not None:
+            self.archive.write(self._get_observation_from_row(r) for r in rows)
+
+    def delete_observations(self, ids, transport=None):
+        """Remove delivered observations.
+
+        :param transport: Identifier of the transport that delivered the observations.  If
+            given, the observations are only removed once every configured transport has
+            acknowledged them.
+        """
+        if transport is not None:
+            self._acknowledge_observations(ids, transport)
+            return
+
+        def delete(conn):
+            if self.archive is not None:
+                chunks = list(self._id_chunks(ids))
+                self._archive_rows(r for chunk in chunks for r in conn.execute(SqliteRepository.SQL_GET_OBS_BY_IDS,
+                                                                                chunk))
+            else:
+                chunks = self._id_chunks(ids)
+            conn.executemany(SqliteRepository.SQL_DELETE_OBS, chunks)
+
+        self._perform_action_with_connection(delete)
+
+    def update_observation_status(self, ids, status=STATUS_ERROR, transport=None):
+        """Set the status of observations, typically to STATUS_ERROR when the server rejected them.
+
+        Observations set to STATUS_ERROR are retried by retry_observations() after an exponential
+        backoff, and moved to the dead_letter table once they have failed retry_max_attempts times.
+
+        :param transport: Identifier of the transport that the observations were rejected by.
+            If given, the status only changes once every configured transport has acknowledged
+            the observations, so that the other transports still get to deliver them.
+        """
+        if transport is not None and status == self.STATUS_ERROR:
+            self._acknowledge_observations(ids, transport, rejected=True)
+            return
+        if status == self.STATUS_ERROR:
+            def fail(conn):
+                backoff = self._backoff_params()
+                conn.executemany(SqliteRepository.SQL_FAIL_OBS, (backoff + c for c in self._id_chunks(ids)))
+                self._bury_observations(conn, backoff[0])
+
+            self._perform_action_with_connection(fail)
+            return
+        self._perform_action_with_connection(
+            lambda c: c.executemany(SqliteRepository.SQL_UPDATE_STATUS,
+                                    ((status,) + chunk for chunk in self._id_chunks(ids))))
+
+    @staticmethod
+    def _id_chunks(ids):
+        """Generator of tuples of exactly ID_CHUNK_SIZE ids, the last one padded by repeating its
+        last id.  A bulk operation is then a number of executions of one prepared statement,
+        within SQLite's limit on bound parameters, whatever the number of ids.
+        """
+        chunk = []
+        for i in ids:
+            chunk.append(i)
+            if len(chunk) == SqliteRepository.ID_CHUNK_SIZE:
+                yield tuple(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            yield tuple(chunk + [chunk[-1]] * (SqliteRepository.ID_CHUNK_SIZE - len(chunk)))
+
+    @staticmethod
+    def _get_transport_cursor(conn, transport):
+        for (t, last_id) in conn.execute(SqliteRepository.SQL_GET_TRANSPORT_CURSORS):
+            if t == transport:
+                return last_id
+        return 0
+
+    def _get_delivered_id(self, conn, transport=None):
+        """Largest id that every configured transport (or, if none are configured, transport or
+        every transport that has acknowledged anything) has acknowledged"""
+        cursors = dict(conn.execute(SqliteRepository.SQL_GET_TRANSPORT_CURSORS).fetchall())
+        if len(self.transports) > 0:
+            transports = self.transports
+        elif transport is not None:
+            transports = [transport]
+        else:
+            transports = cursors.keys()
+        return min([cursors.get(t, 0) for t in transports], default=0)
+
+    def _acknowledge_observations(self, ids, transport, rejected=False):
+        """Advance the cursor of a transport past ids, then mark as ERROR observations rejected by
+        a transport once every configured transport has moved past them.  Transports read
+        oldest-first and acknowledge every observation of a batch, so a cursor is simply the
+        largest id acknowledged, unless concurrent senders claimed observations: see
+        _advance_transport_cursor().
+
+        Delivered observations are not deleted here, which would put a burst of random deletes
+        on the path of every transmission: they are hidden by the cursors, and purged in
+        batches by compact().
+        """
+        if len(ids) == 0:
+            return
+
+        def acknowledge(conn):
+            if rejected:
+                conn.executemany(SqliteRepository.SQL_CREATE_DELIVERY_ERROR, [(i, transport) for i in ids])
+            conn.execute(SqliteRepository.SQL_INIT_TRANSPORT_CURSOR, (transport,))
+            conn.executemany(SqliteRepository.SQL_SETTLE_CLAIMS, self._id_chunks(ids))
+            self._advance_transport_cursor(conn, ids, transport)
+            self._update_delivered_count(conn)
+            delivered_id = self._get_delivered_id(conn, transport)
+            backoff = self._backoff_params()
+            conn.execute(SqliteRepository.SQL_MARK_DELIVERY_ERRORS, backoff + (delivered_id,))
+            self._bury_observations(conn, backoff[0])
+            conn.execute(SqliteRepository.SQL_DELETE_DELIVERY_ERRORS, (delivered_id,))
+
+        self._perform_action_with_connection(acknowledge)
+
+    @staticmethod
+    def _advance_transport_cursor(conn, ids, transport):
+        """Move the cursor of a transport past ids, but never past an observation that the
+        transport has not acknowledged, e.g. one still claimed by another sender.  Ids beyond
+        such an observation are recorded in acknowledged_ahead, so that they are not claimed
+        again, and the cursor moves over them once the observations before them are acknowledged.
+        """
+        cursor = SqliteRepository._get_transport_cursor(conn, transport)
+        acked = set(ids)
+        if not conn.execute(SqliteRepository.SQL_HAS_ACKED_AHEAD, (transport,)).fetchone()[0] and \
+                all(r[0] in acked for r in conn.execute(SqliteRepository.SQL_GET_IDS_IN_RANGE, (cursor, max(ids)))):
+            conn.execute(SqliteRepository.SQL_ADVANCE_TRANSPORT_CURSOR, (max(ids), transport))
+            return
+        conn.executemany(SqliteRepository.SQL_CREATE_ACKED_AHEAD, [(transport, i) for i in ids if i > cursor])
+        first = conn.execute(SqliteRepository.SQL_GET_FIRST_UNACKED, (cursor, transport)).fetchone()
+        last_id = conn.execute(SqliteRepository.SQL_GET_LAST_ACKED_AHEAD,
+                               (transport, sys.maxsize if first is None else first[0])).fetchone()[0]
+        if last_id is not None:
+            conn.execute(SqliteRepository.SQL_ADVANCE_TRANSPORT_CURSOR, (last_id, transport))
+            conn.execute(SqliteRepository.SQL_DELETE_ACKED_AHEAD, (transport, last_id))
+
+    def _update_delivered_count(self, conn):
+        """Count the observations that became delivered since the count was last updated, or that
+        no longer are if a new transport holds back the delivered id.  Only observations between
+        the old and the new delivered id are counted.
+        """
+        delivered_id = self._get_delivered_id(conn)
+        conn.execute(SqliteRepository.SQL_RECOUNT_DELIVERED, (delivered_id,) * 2)
+        conn.execute(SqliteRepository.SQL_ADVANCE_DELIVERED_COUNT, (delivered_id,) * 3)
+        conn.execute(SqliteRepository.SQL_RETREAT_DELIVERED_COUNT, (delivered_id,) * 3)
+
+    def _backoff_params(self):
+        return (int(time.time()), self.retry_max_backoff_seconds, self.retry_backoff_seconds)
+
+    def _bury_observations(self, conn, now):
+        """Move observations that have failed retry_max_attempts times to the dead_letter table"""
+        conn.execute(SqliteRepository.SQL_BURY_OBS, (now, self.retry_max_attempts))
+        n = conn.execute(SqliteRepository.SQL_DELETE_BURIED_OBS, (self.retry_max_attempts,)).rowcount
+        if n > 0:
+            self.logger.warn("Spooler: moved {0} observations to dead letters after {1} failed attempts.".
+                             format(n, self.retry_max_attempts))
+
+    def retry_observations(self):
+        """Return observations whose retry backoff has elapsed to PENDING.  They are given a new
+        id, so that every transport reads them again.
+
+        :return: Number of observations requeued
+        """
+        def retry(conn):
+            rows = conn.execute(SqliteRepository.SQL_GET_DUE_RETRIES, (int(time.time()),)).fetchall()
+            # Delete before re-inserting, the unique index would reject the copy otherwise
+            conn.executemany(SqliteRepository.SQL_DELETE_OBS_BY_ID, [(r[0],) for r in rows])
+            conn.executemany(SqliteRepository.SQL_REQUEUE_OBS, [r[1:] for r in rows])
+            return len(rows)
+
+        n = self._perform_action_with_connection(retry)
+        if n > 0:
+            self.logger.info("Spooler: retrying {0} observations.".format(n))
+        return n
+
+    def get_dead_letters(self):
+        """Observations that were given up on, oldest first.
+
+        :return: List of (observation, attempts, dead_since) tuples, dead_since being seconds
+            since the epoch
+        """
+        return [(self._get_observation_from_row(r), r[8], r[9])
+                for r in self._get_connection().execute(SqliteRepository.SQL_GET_DEAD_LETTERS)]
+
+    def has_dead_letters(self):
+        return bool(self._get_connection().execute(SqliteRepository.SQL_HAS_DEAD_LETTERS).fetchone()[0])
+
+    def _dead_letter_ids(self, conn, ids):
+        if ids is None:
+            return [(r[0],) for r in conn.execute(SqliteRepository.SQL_GET_DEAD_LETTER_IDS)]
+        return [(i,) for i in ids]
+
+    def requeue_dead_letters(self, ids=None):
+        """Move dead letters back to the spool as new PENDING observations.
+
+        :param ids: Ids of the dead letters to requeue, or None for all of them
+        :return: Number of dead letters requeued
+        """
+        def requeue(conn):
+            ids_to_requeue = self._dead_letter_ids(conn, ids)
+            n = sum([conn.execute(SqliteRepository.SQL_REQUEUE_DEAD_LETTER, i).rowcount for i in ids_to_requeue])
+            conn.executemany(SqliteRepository.SQL_DELETE_DEAD_LETTER, ids_to_requeue)
+            return n
+
+        return self._perform_action_with_connection(requeue)
+
+    def purge_dead_letters(self, ids=None):
+        """Delete dead letters.
+
+        :param ids: Ids of the dead letters to delete, or None for all of them
+        :return: Number of dead letters deleted
+        """
+        def purge(conn):
+            return sum([conn.execute(SqliteRepository.SQL_DELETE_DEAD_LETTER, i).rowcount
+                        for i in self._dead_letter_ids(conn, ids)])
+
+        return self._perform_action_with_connection(purge)
+
+    def get_observation_count(self):
+        """Number of observations in the spool, regardless of status.  Delivered observations are
+        counted as the delivered id advances, so this is a single read of observation_count."""
+        return self._get_connection().execute(SqliteRepository.SQL_GET_OBS_COUNT).fetchone()[0]
+
+    def compact(self, max_seconds=None):
+        """Purge delivered observations, compaction_batch_size of the oldest at a time, each
+        batch in its own transaction.  Meant to be called when the transmitter is idle.
+
+        Chunks of online migrations that are still in progress are run first, within the same
+        max_seconds, so that opening a large spool never waits for them.
+
+        :param max_seconds: Stop after the batch during which this many seconds have passed
+        :return: Number of observations purged
+        """
+        conn = self._get_connection()
+        start = time.monotonic()
+        migration.run_online_migrations(conn, self._get_migrations(), self.MIGRATION_CHUNK_SIZE,
+                                        max_seconds=max_seconds)
+        purged = 0
+        while True:
+            with conn:
+                if self.archive is None:
+                    n = conn.execute(SqliteRepository.SQL_PURGE_DELIVERED,
+                                     (self._get_delivered_id(conn), self.compaction_batch_size)).rowcount
+                else:
+                    n = self._archive_and_purge(conn)
+            purged += n
+            if n < self.compaction_batch_size or \
+                    (max_seconds is not None and time.monotonic() - start >= max_seconds):
+                break
+        if purged > 0:
+            if self.max_bytes is not None:
+                conn.executescript("PRAGMA incremental_vacuum;")
+            self.logger.debug("Spooler: purged {0} delivered observations in {1:.3f} seconds.".
+                              format(purged, time.monotonic() - start))
+        return purged
+
+    def stats(self):
+        """Counts of spooled observations by status and datastream, the range of their phenomenon
+        times and the size of the database.  Counts are read from the observation_counter table,
+        which triggers keep up to date, so this is cheap however large the spool is.
+
+        :return: dict with observations (total), by_status, by_datastream ({datastream id:
+          {status: count}}, dead letters having status DEAD_LETTER), dead_letters,
+          awaiting_compaction (delivered observations not yet purged, which are not counted
+          otherwise), oldest_phenomenon_time, newest_phenomenon_time and db_size_bytes
+        """
+        stats = self._stats()
+        stats['oldest_phenomenon_time'] = self._decode_phenomenon_time(stats['oldest_phenomenon_time'])
+        stats['newest_phenomenon_time'] = self._decode_phenomenon_time(stats['newest_phenomenon_time'])
+        return stats
+
+    def _stats(self):
+        """stats(), with phenomenon times as stored"""
+        conn = self._get_connection()
+        by_datastream = {}
+        for (datastream_id, status, count) in conn.execute(SqliteRepository.SQL_GET_OBS_COUNTERS):
+            by_datastream.setdefault(datastream_id, {})[status] = count
+        delivered = 0
+        for (datastream_id, count) in conn.execute(SqliteRepository.SQL_COUNT_DELIVERED_BY_DATASTREAM,
+                                                   (self._get_delivered_id(conn),)).fetchall():
+            counts = by_datastream[datastream_id]
+            counts[SqliteRepository.STATUS_PENDING] -= count
+            if counts[SqliteRepository.STATUS_PENDING] == 0:
+                del counts[SqliteRepository.STATUS_PENDING]
+            delivered += count
+        times = []
+        for datastream_id in by_datastream:
+            # Each is a single lookup in observation_datastream_time_idx
+            for sql in (SqliteRepository.SQL_GET_OLDEST_PHENOMENON_TIME,
+                        SqliteRepository.SQL_GET_NEWEST_PHENOMENON_TIME):
+                times.append(conn.execute(sql, (datastream_id,)).fetchone()[0])
+        stats = {'by_datastream': by_datastream,
+                 'awaiting_compaction': delivered,
+                 'db_size_bytes': self._db_size()}
+        stats.update(self._time_range(times))
+        return self._summarize_stats(stats)
+
+    @staticmethod
+    def _time_range(times):
+        """Oldest and newest of encoded phenomenon times, ignoring those that couldn't be parsed"""
+        times = [t for t in times if isinstance(t, int)]
+        return {'oldest_phenomenon_time': min(times) if len(times) > 0 else None,
+                'newest_phenomenon_time': max(times) if len(times) > 0 else None}
+
+    @staticmethod
+    def _summarize_stats(stats):
+        """Fill in the totals of stats from stats['by_datastream']"""
+        by_status = {}
+        dead_letters = 0
+        for counts in stats['by_datastream'].values():
+            for (status, count) in counts.items():
+                if status == SqliteRepository.STATUS_DEAD_LETTER:
+                    dead_letters += count
+                else:
+                    by_status[status] = by_status.get(status, 0) + count
+        stats['observations'] = sum(by_status.values())
+        stats['by_status'] = by_status
+        stats['dead_letters'] = dead_letters
+        return stats
+
+    def _db_size(self):
+        size = 0
+        for p in (self.db_path, self.db_path + '-wal'):
+            try:
+                size += os.path.getsize(p)
+            except FileNotFoundError:
+                pass
+        return size
+
+    @staticmethod
+    def _encode_query_time(t):
+        """Encoded phenomenon time for a datetime, which is taken to be in UTC if it is naive,
+        an ISO 8601 string, or None"""
+        if t is None:
+            return None
+        if isinstance(t, datetime):
+            if t.tzinfo is None:
+                t = t.replace(tzinfo=timezone.utc)
+            return (t - SqliteRepository.EPOCH) // SqliteRepository.MICROSECOND
+        encoded = SqliteRepository._encode_phenomenon_time(t)
+        if not isinstance(encoded, int):
+            raise ValueError("Can't parse query time {0}".format(t))
+        return encoded
+
+    @staticmethod
+    def _merge_by_time(streams, limit=None):
+        """Generator merging iterables of (encoded phenomenon time, observation), each in order
+        of time, into observations in order of time.  An observation with the same time as the
+        one before is a copy, e.g. archived twice, and is dropped."""
+        if limit is not None and limit <= 0:
+            return
+        n = 0
+        last = None
+        for (t, o) in heapq.merge(*streams, key=lambda s: s[0]):
+            if t == last:
+                continue
+            last = t
+            yield o
+            n += 1
+            if limit is not None and n >= limit:
+                return
+
+    def query(self, datastream_id, start=None, end=None, limit=None):
+        """Observations of a datastream or multidatastream whose phenomenon time is from start
+        (inclusive) to end (exclusive), oldest first, whether delivered or not, from the spool
+        and the archive files, if any.  Observations are read as the iterator is consumed, so
+        a query can span more than fits in memory.
+
+        :param start: datetime or ISO 8601 string, or None for no lower bound
+        :param end: datetime or ISO 8601 string, or None for no upper bound
+        :param limit: Maximum number of observations, or None
+        :return: Iterator of observations
+        """
+        start = self._encode_query_time(start)
+        end = self._encode_query_time(end)
+        streams = [self._query_spool(datastream_id, start, end)]
+        if self.archive is not None:
+            streams.append(self.archive.query(datastream_id, start, end, limit=limit))
+        return self._merge_by_time(streams, limit)
+
+    def _query_spool(self, datastream_id, start, end):
+        """Generator of (encoded phenomenon time, observation) for query(), from the spool only.
+        Phenomenon times that could not be parsed are never matched."""
+        params = (datastream_id, self.MIN_TIME if start is None else start, self.MAX_TIME if end is None else end)
+        for r in self._get_connection().execute(SqliteRepository.SQL_QUERY_OBS, params):
+            yield (r[3], self._get_observation_from_row(r))
+
+    def get_all_observations(self):
+        conn = self._get_connection()
+        return [self._get_observation_from_row(r)
+                for r in conn.execute(SqliteRepository.SQL_GET_ALL_OBS, (self._get_delivered_id(conn),))]
 
     @staticmethod
     def _get_observation_from_row(r):
@@ -125,9 +1295,9 @@ class SqliteRepository:
             o.id = r[0]
             o.featureOfInterestId = r[1]
             o.datastreamId = r[2]
-            o.phenomenonTime = r[3]
+            o.phenomenonTime = SqliteRepository._decode_phenomenon_time(r[3])
             o.result = r[4]
-            o.set_parameters_from_str(r[5])
+            o.parameters = SqliteRepository._decode_parameters(r[5])
             return o
         else:
             # is_multiobservation is False, this is a MultiObservation
@@ -135,7 +1305,7 @@ class SqliteRepository:
             mo.id = r[0]
             mo.featureOfInterestId = r[1]
             mo.multidatastreamId = r[2]
-            mo.phenomenonTime = r[3]
-            mo.result = [float(s) for s in r[4].split(SqliteRepository.MULTI_OBS_SEP)]
-            mo.set_parameters_from_str(r[5])
+            mo.phenomenonTime = SqliteRepository._decode_phenomenon_time(r[3])
+            mo.result = SqliteRepository._unpack_results(r[4])
+            mo.parameters = SqliteRepository._decode_parameters(r[5])
             return mo
@@ -29,6 +29,8 @@ class TestConfiguration(unittest.TestCase):
         # Spooler
         self.assertTrue(CFG_SPOOLER_DB_PATH in c)
         self.assertEqual(c[CFG_SPOOLER_DB_PATH], '/var/spool/mqueue/sensor.sqlite')
+        self.assertEqual(c[CFG_SPOOLER_SYNCHRONOUS], DEFAULT_DB_SYNCHRONOUS)
+        self.assertEqual(c[CFG_SPOOLER_BUSY_TIMEOUT_MS], DEFAULT_DB_BUSY_TIMEOUT_MS)
         # Thing
         self.assertTrue(CFG_THING in c)
         t = c[CFG_THING]
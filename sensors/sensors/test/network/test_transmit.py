@@ -0,0 +1,58 @@
+import os
+import time
+import unittest
+
+from sensors.common.logging import configure_logger
+from sensors.common.constants import *
+from sensors.config import Config
+from sensors.config.util import ConfigurationError
+from sensors.domain.transport import Transport
+from sensors.network import transmit
+
+
+class FakeTransport(Transport):
+    BATCH_SIZE = 10
+
+    def __init__(self, batches, **kwargs):
+        super().__init__(CFG_TRANSPORT_TYPE_HTTPS, **kwargs)
+        self.batches = list(batches)
+        self.calls = 0
+
+    def identifier(self):
+        return "fake"
+
+    def transmit(self, repo):
+        self.calls += 1
+        n = self.batches.pop(0)
+        return (n, n >= self.BATCH_SIZE)
+
+
+class TestTransmit(unittest.TestCase):
+
+    def setUp(self):
+        os.environ[ENV_YAML_PATH] = '../persistence/test_sqlite.yml'
+        transmit.logger = configure_logger(Config(unittest=True).config)
+
+    def test_drain(self):
+        # Full batches are followed by the next one straight away, until one is not full
+        t = FakeTransport([10, 10, 10, 3, 10])
+        transmit.transmit(t, None)
+        self.assertEqual(4, t.calls)
+
+        t = FakeTransport([10, 10, 3], drain=False)
+        transmit.transmit(t, None)
+        self.assertEqual(1, t.calls)
+
+        # Quoted in YAML
+        self.assertFalse(FakeTransport([], drain="false").drain())
+        self.assertTrue(FakeTransport([], drain="Yes").drain())
+        self.assertRaises(ConfigurationError, FakeTransport([], drain="sometimes").drain)
+
+        t = FakeTransport([10, 10, 10, 0], drain_max_observations_per_second=100)
+        start = time.monotonic()
+        self.assertEqual(30, transmit.drain(t, None))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
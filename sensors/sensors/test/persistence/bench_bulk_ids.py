@@ -0,0 +1,79 @@
+"""Time delete_observations() and update_observation_status() on 100 to 1M ids.
+
+Run from this directory: python bench_bulk_ids.py [--sizes 100 1000 ...]
+
+Each size is timed with consecutive ids, as acknowledged by a transport, and with every
+other id.  Deleting with a single IN (...) list of every id, as the repository used to,
+is timed for comparison.
+"""
+import os
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from sensors.common.constants import *
+from sensors.config import Config
+from sensors.domain.observation import Observation
+from sensors.persistence.sqlite import SqliteRepository
+
+DEFAULT_SIZES = (100, 1000, 10000, 100000, 1000000)
+START = datetime(2017, 4, 11, 15, 29, 55, tzinfo=timezone.utc)
+
+
+def make_repo(config, count):
+    try:
+        os.unlink(config[CFG_SPOOLER_DB_PATH])
+    except FileNotFoundError:
+        pass
+    repo = SqliteRepository(config)
+    batch = []
+    for i in range(count):
+        o = Observation()
+        o.datastreamId = "54321"
+        o.phenomenonTime = (START + timedelta(seconds=i)).isoformat()
+        o.result = str(i)
+        o.set_parameters()
+        batch.append(o)
+        if len(batch) == 10000:
+            repo.create_observations(batch)
+            batch = []
+    repo.create_observations(batch)
+    return repo
+
+
+def in_list_delete(repo, ids):
+    conn = repo._get_connection()
+    with conn:
+        conn.execute("DELETE FROM observation WHERE id IN ({0})".format(",".join([str(i) for i in ids])))
+
+
+def timed(action):
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bulk id operations of the SQLite spool')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    args = parser.parse_args()
+
+    os.environ[ENV_YAML_PATH] = './test_sqlite.yml'
+    config = Config(unittest=True).config
+
+    print("{0:>9} {1:>10} {2:>12} {3:>12} {4:>12}".format("ids", "pattern", "delete s", "update s", "IN list s"))
+    for size in args.sizes:
+        for (pattern, step) in (("run", 1), ("gaps", 2)):
+            repo = make_repo(config, size * step)
+            ids = list(range(1, size * step + 1, step))
+            update = timed(lambda: repo.update_observation_status(ids, status=SqliteRepository.STATUS_IN_FLIGHT))
+            delete = timed(lambda: repo.delete_observations(ids))
+            repo.close()
+            repo = make_repo(config, size * step)
+            legacy = timed(lambda: in_list_delete(repo, ids))
+            repo.close()
+            print("{0:>9} {1:>10} {2:>12.4f} {3:>12.4f} {4:>12.4f}".format(size, pattern, delete, update, legacy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import os
+import csv
+import json
+import gzip
+import math
+import shutil
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from sensors.common.constants import *
+from sensors.config import Config
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.persistence.sqlite import SqliteRepository
+from sensors.persistence.archive import Archive
+
+
+class TestArchive(unittest.TestCase):
+
+    config = None
+
+    def setUp(self):
+        os.environ[ENV_YAML_PATH] = './test_sqlite.yml'
+        global config
+        config = Config(unittest=True).config
+        config[CFG_SPOOLER_ARCHIVE_PATH] = '/tmp/sensor.archive'
+
+        try:
+            os.unlink(config[CFG_SPOOLER_DB_PATH])
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(config[CFG_SPOOLER_ARCHIVE_PATH], ignore_errors=True)
+
+    @staticmethod
+    def _make_observations(count):
+        observations = []
+        start = datetime(2017, 4, 11, 15, 29, 55, tzinfo=timezone.utc)
+        for i in range(count):
+            o = Observation()
+            o.datastreamId = "54321"
+            o.phenomenonTime = (start + timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            o.result = str(i)
+            o.set_parameters(n=str(i))
+            observations.append(o)
+        mo = MultiObservation()
+        mo.multidatastreamId = "1q2w3"
+        mo.phenomenonTime = start.strftime('%Y-%m-%dT%H:%M:%SZ')
+        mo.result = [0.1, float('nan')]
+        mo.set_parameters()
+        return observations + [mo]
+
+    def test_archive_delivered(self):
+        repo = SqliteRepository(config)
+        repo.create_observations(self._make_observations(5))
+        obs = repo.get_observations()
+        transport = config[CFG_TRANSPORTS][0].identifier()
+        repo.delete_observations([o.id for o in obs[:4]], transport=transport)
+        # Only compaction writes to the archive
+        self.assertEqual([], repo.archive.files())
+        self.assertEqual(4, repo.compact())
+        repo.delete_observations([obs[5].id])
+
+        files = repo.archive.files()
+        self.assertEqual([repo.archive.path_for(datetime.now(timezone.utc))], files)
+        with gzip.open(files[0], 'rt') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([o.id for o in obs[:4]] + [obs[5].id], [r['id'] for r in records])
+        self.assertEqual({"id": obs[0].id, "featureOfInterestId": None, "datastreamId": "54321",
+                          "multidatastreamId": None, "phenomenonTime": "2017-04-11T15:29:55Z",
+                          "result": "0", "parameters": {"n": "0"}}, records[0])
+        self.assertEqual([0.1, None], records[4]['result'])
+        self.assertEqual(1, repo.get_observation_count())
+
+    def test_archive_expired(self):
+        repo = SqliteRepository(config)
+        repo.create_observations(self._make_observations(5))
+        obs = repo.get_observations()
+        repo.delete_observations([o.id for o in obs[:2]], transport=config[CFG_TRANSPORTS][0].identifier())
+        # Expired observations are evicted, except the delivered ones which are archived first
+        repo.max_age_hours = 24
+        self.assertEqual(4, repo.enforce_spool_budget())
+        self.assertEqual([], repo.archive.files())
+        self.assertEqual(2, repo.compact())
+        with gzip.open(repo.archive.files()[0], 'rt') as f:
+            self.assertEqual([o.id for o in obs[:2]], [json.loads(line)['id'] for line in f])
+        self.assertEqual([], repo.get_all_observations())
+
+    def test_query(self):
+        for archive_format in (CFG_SPOOLER_ARCHIVE_FORMAT_NDJSON, CFG_SPOOLER_ARCHIVE_FORMAT_CSV):
+            self.setUp()
+            config[CFG_SPOOLER_ARCHIVE_FORMAT] = archive_format
+            repo = SqliteRepository(config)
+            observations = self._make_observations(5)
+            repo.create_observations(observations)
+            obs = repo.get_observations()
+            # Archived twice, as after a compaction that wasn't committed
+            repo.archive.write(obs[1:3])
+            repo.delete_observations([o.id for o in obs[:3]] + [obs[5].id])
+
+            self.assertEqual(["0", "1", "2", "3", "4"], [o.result for o in repo.query("54321")])
+            self.assertEqual([obs[1].id, obs[2].id], [o.id for o in repo.query("54321", start="2017-04-11T15:30:55Z",
+                                                                              limit=2)])
+            self.assertEqual({"n": "1"}, next(repo.query("54321", start="2017-04-11T15:30:55Z")).parameters)
+            (mo,) = repo.query("1q2w3")
+            self.assertEqual("2017-04-11T15:29:55Z", mo.phenomenonTime)
+            self.assertEqual(0.1, mo.result[0])
+            self.assertTrue(math.isnan(mo.result[1]))
+            # Archive files from before the day of start are not read
+            self.assertEqual([], list(repo.archive.query("54321", start=repo._encode_query_time(
+                datetime.now(timezone.utc) + timedelta(days=1)))))
+            repo.close()
+
+    def test_query_limit(self):
+        archive = Archive(config)
+        observations = self._make_observations(5)[:5]
+        for (i, o) in enumerate(observations):
+            o.id = i + 1
+        # Out of order of time, with some archived twice
+        archive.write(observations[3:] + observations[:3])
+        archive.write(observations[:2])
+
+        self.assertEqual(["0", "1", "2"], [o.result for (t, o) in archive.query("54321", limit=3)])
+        self.assertEqual(["3", "4"], [o.result for (t, o) in archive.query(
+            "54321", start=SqliteRepository._encode_query_time("2017-04-11T15:32:55Z"), limit=5)])
+        self.assertEqual([], list(archive.query("54321", limit=0)))
+        self.assertEqual(["0", "1", "2", "3", "4"], [o.result for (t, o) in archive.query("54321")])
+
+    def test_csv_and_max_bytes(self):
+        config[CFG_SPOOLER_ARCHIVE_FORMAT] = CFG_SPOOLER_ARCHIVE_FORMAT_CSV
+        config[CFG_SPOOLER_ARCHIVE_MAX_BYTES] = 1
+        archive = Archive(config)
+        old = archive.path_for(datetime(2018, 6, 10, tzinfo=timezone.utc))
+        with open(old, 'wb') as f:
+            f.write(b'old')
+
+        self.assertEqual(2, archive.write(self._make_observations(2)[:2]))
+        self.assertEqual(1, archive.write(iter(self._make_observations(3)[2:3])))
+        self.assertEqual(0, archive.write([]))
+        # The oldest file goes, the current one is kept even if over budget
+        files = archive.files()
+        self.assertEqual([archive.path_for(datetime.now(timezone.utc))], files)
+        with gzip.open(files[0], 'rt', newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(list(Archive.CSV_FIELDS), rows[0])
+        self.assertEqual(["0", "1", "2"], [r[5] for r in rows[1:]])
+        self.assertEqual('{"n": "2"}', rows[3][6])
@@ -0,0 +1,142 @@
+import os
+import math
+import random
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from sensors.common.constants import *
+from sensors.config import Config
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.persistence import get_repository_instance, gorilla
+from sensors.persistence.blocks import BlockSqliteRepository
+
+
+class TestBlockSqliteRepository(unittest.TestCase):
+
+    config = None
+
+    def setUp(self):
+        os.environ[ENV_YAML_PATH] = './test_sqlite.yml'
+        global config
+        config = Config(unittest=True).config
+        config[CFG_SPOOLER_COMPRESSION] = CFG_SPOOLER_COMPRESSION_GORILLA
+        config[CFG_SPOOLER_BLOCK_SIZE] = 10
+
+        try:
+            os.unlink(config[CFG_SPOOLER_DB_PATH])
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _make_observations(count, first=0):
+        observations = []
+        start = datetime(2017, 4, 11, 15, 29, 55, tzinfo=timezone.utc)
+        for i in range(first, first + count):
+            o = Observation()
+            o.datastreamId = "54321"
+            o.phenomenonTime = (start + timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            o.result = str(20.0 + i / 4)
+            o.set_parameters(n=str(i))
+            mo = MultiObservation()
+            mo.multidatastreamId = "1q2w3"
+            mo.phenomenonTime = o.phenomenonTime
+            mo.result = [0.1 * i, 22.5]
+            mo.set_parameters()
+            observations.extend([o, mo])
+        return observations
+
+    def test_gorilla_round_trip(self):
+        start = 1491924595000000
+        ids = list(range(1, 3000, 2))
+        times = [start + i * 60000000 + random.randint(-1000, 1000) for i in range(len(ids))]
+        values = [(round(20 + math.sin(i / 100), 1), math.nan if i % 5 == 0 else -1e300 * i) for i in range(len(ids))]
+        data = gorilla.encode_block(ids, times, values)
+        decoded = list(gorilla.decode_block(data))
+        self.assertEqual(ids, [d[0] for d in decoded])
+        self.assertEqual(times, [d[1] for d in decoded])
+        self.assertEqual([v[0] for v in values], [d[2][0] for d in decoded])
+        self.assertTrue(math.isnan(decoded[0][2][1]))
+        self.assertEqual(values[1][1], decoded[1][2][1])
+
+        # A slowly changing reading at a regular interval takes a couple of bytes per sample
+        ids = list(range(1, 1001))
+        times = [start + i * 60000000 for i in range(len(ids))]
+        values = [(round(20 + math.sin(i / 100), 1),) for i in range(len(ids))]
+        self.assertLess(len(gorilla.encode_block(ids, times, values)), 2 * len(ids))
+
+    def test_packed_observations(self):
+        repo = get_repository_instance(config)
+        self.assertIsInstance(repo, BlockSqliteRepository)
+        observations = self._make_observations(12)
+        repo.create_observations(observations)
+
+        conn = repo._get_connection()
+        self.assertEqual(2, conn.execute("SELECT count(*) FROM observation_block").fetchone()[0])
+        self.assertEqual(4, conn.execute("SELECT count(*) FROM observation").fetchone()[0])
+        self.assertEqual(24, repo.get_observation_count())
+
+        obs = repo.get_all_observations()
+        self.assertEqual(observations[0], obs[0])
+        self.assertEqual(observations, obs)
+        self.assertEqual({"n": "0"}, obs[0].parameters)
+        # Queries merge packed observations with the others in time order
+        self.assertEqual(obs[17:24:2], list(repo.query("1q2w3", start="2017-04-11T15:37:55Z")))
+        self.assertEqual(obs[2:6:2], list(repo.query("54321", start="2017-04-11T15:30:55Z",
+                                                     end="2017-04-11T15:32:55Z")))
+        # Paging merges packed observations with the others in id order
+        self.assertEqual(obs[5:12], repo.get_observations(limit=7, after_id=obs[4].id))
+
+        repo.delete_observations([o.id for o in obs[:5]])
+        repo.update_observation_status([obs[6].id])
+        self.assertEqual(19, repo.get_observation_count())
+        self.assertEqual([obs[5]] + obs[7:], repo.get_observations(limit=100))
+        # Rejected observations are unpacked so that they can have a status
+        self.assertEqual(5, conn.execute("SELECT count(*) FROM observation").fetchone()[0])
+
+        transport = config[CFG_TRANSPORTS][0].identifier()
+        repo.delete_observations([o.id for o in obs[5:20]], transport=transport)
+        self.assertEqual(obs[20:], repo.get_observations(transport=transport))
+        self.assertEqual(5, repo.get_observation_count())
+        self.assertEqual(0, conn.execute("SELECT count(*) FROM observation_block").fetchone()[0])
+
+    def test_duplicates_of_packed_observations(self):
+        config[CFG_SPOOLER_BLOCK_SIZE] = 4
+        repo = get_repository_instance(config)
+        observations = self._make_observations(4)
+        self.assertEqual(8, len(repo.create_observations(observations)))
+        conn = repo._get_connection()
+        self.assertEqual(0, conn.execute("SELECT count(*) FROM observation").fetchone()[0])
+
+        # Packed observations are not stored again
+        self.assertEqual([], repo.create_observations(observations))
+        self.assertEqual(8, repo.get_observation_count())
+        self.assertEqual(8, len(repo.get_all_observations()))
+
+        # Once out of their block, they can be
+        obs = repo.get_all_observations()
+        repo.delete_observations([obs[0].id])
+        self.assertEqual(observations[:1], repo.create_observations(observations[:1]))
+
+        # Unpacking merges with an observation spooled before the key of its block was kept
+        conn.execute("DELETE FROM observation_block_key")
+        conn.commit()
+        self.assertEqual(observations[2:3], repo.create_observations(observations[2:3]))
+        repo.update_observation_status([obs[2].id])
+        stored = repo.get_all_observations()
+        self.assertEqual(8, len(stored))
+        self.assertEqual(1, len([o for o in stored if isinstance(o, Observation) and
+                                 o.phenomenonTime == observations[2].phenomenonTime]))
+
+    def test_claim_packed_observations(self):
+        repo = get_repository_instance(config)
+        repo.create_observations(self._make_observations(12))
+        obs = repo.get_all_observations()
+
+        # Packed observations among the oldest are unpacked and claimed
+        claimed = repo.claim_observations(limit=5, lease_seconds=60)
+        self.assertEqual([o.id for o in obs[:5]], [o.id for o in claimed])
+        self.assertEqual(obs[5:], repo.get_observations(limit=100))
+        self.assertEqual(24, repo.get_observation_count())
+        repo.release_observations([o.id for o in claimed[1:]])
+        self.assertEqual([o.id for o in obs[1:4]], [o.id for o in repo.claim_observations(limit=3)])
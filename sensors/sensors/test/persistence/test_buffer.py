@@ -0,0 +1,82 @@
+import os
+import unittest
+
+from sensors.common.constants import *
+from sensors.config import Config
+from sensors.domain.observation import Observation
+from sensors.persistence import get_repository_instance
+from sensors.persistence.buffer import BufferedRepository
+from sensors.persistence.sqlite import SqliteRepository
+
+
+class TestBufferedRepository(unittest.TestCase):
+
+    config = None
+
+    def setUp(self):
+        os.environ[ENV_YAML_PATH] = './test_sqlite.yml'
+        global config
+        config = Config(unittest=True).config
+        config[CFG_SPOOLER_FLUSH_INTERVAL_SEC] = 60.0
+        config[CFG_SPOOLER_FLUSH_MAX_OBS] = 10
+
+        try:
+            os.unlink(config[CFG_SPOOLER_DB_PATH])
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _make_observations(count, first=0):
+        observations = []
+        for i in range(first, first + count):
+            o = Observation()
+            o.datastreamId = "54321"
+            o.phenomenonTime = "2017-04-11T15:29:{0:02d}Z".format(i)
+            o.result = str(i)
+            o.set_parameters()
+            observations.append(o)
+        return observations
+
+    def test_flush(self):
+        self.assertIsInstance(get_repository_instance(config), SqliteRepository)
+        repo = get_repository_instance(config, buffered=True)
+        self.assertIsInstance(repo, BufferedRepository)
+
+        repo.create_observations(self._make_observations(6))
+        self.assertEqual(0, repo.get_observation_count())
+        # Reaching flush_max_observations flushes
+        repo.create_observations(self._make_observations(6, first=6))
+        self.assertEqual(12, repo.get_observation_count())
+
+        repo.create_observations(self._make_observations(2, first=12))
+        self.assertGreater(repo.seconds_until_flush(), 0)
+        repo._oldest_buffered -= 60
+        self.assertEqual(0, repo.seconds_until_flush())
+        repo.create_observations([])
+        self.assertEqual(14, repo.get_observation_count())
+        self.assertIsNone(repo.seconds_until_flush())
+
+        repo.create_observations(self._make_observations(1, first=14))
+        repo.close()
+        self.assertEqual(15, SqliteRepository(config).get_observation_count())
+
+        stats = repo.get_buffer_stats()
+        self.assertEqual(0, stats['buffered'])
+        self.assertEqual(12, stats['max_buffered'])
+        self.assertEqual(3, stats['flushes'])
+        self.assertEqual(15, stats['flushed_observations'])
+
+    def test_reads_flushed_only(self):
+        repo = get_repository_instance(config, buffered=True)
+        repo.create_observations(self._make_observations(12))
+        repo.create_observations(self._make_observations(3, first=12))
+
+        # Reads are those of the repository, which only has what was flushed
+        self.assertEqual([str(i) for i in range(12)], [o.result for o in repo.get_observations()])
+        self.assertEqual(3, repo.stats()['buffered'])
+        repo.flush()
+        self.assertEqual(15, len(repo.get_observations()))
+        repo.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import time
+import unittest
+
+from sensors.common.constants import *
+from sensors.config import Config
+from sensors.domain.observation import Observation
+from sensors.persistence import get_repository_instance
+from sensors.persistence.partition import PartitionedSqliteRepository
+
+
+class TestPartitionedSqliteRepository(unittest.TestCase):
+
+    config = None
+
+    def setUp(self):
+        os.environ[ENV_YAML_PATH] = './test_sqlite.yml'
+        global config
+        config = Config(unittest=True).config
+        config[CFG_SPOOLER_PARTITION] = CFG_SPOOLER_PARTITION_HOUR
+
+        repo = PartitionedSqliteRepository(config)
+        for key in repo.partition_keys():
+            repo.drop_partition(key)
+
+    @staticmethod
+    def _make_observations(count, first=0):
+        observations = []
+        for i in range(first, first + count):
+            o = Observation()
+            o.datastreamId = "54321"
+            o.phenomenonTime = "2017-04-11T15:29:{0:02d}Z".format(i)
+            o.result = str(i)
+            o.set_parameters()
+            observations.append(o)
+        return observations
+
+    def _make_repo_with_old_partitions(self):
+        repo = get_repository_instance(config)
+        self.assertIsInstance(repo, PartitionedSqliteRepository)
+        current_key = repo._key_for_time(time.time())
+        # Two partitions from previous hours, plus the current one
+        repo._get_partition(current_key - 2, create=True).create_observations(self._make_observations(3, first=0))
+        repo._get_partition(current_key - 1, create=True).create_observations(self._make_observations(3, first=3))
+        repo.create_observations(self._make_observations(3, first=6))
+        return (repo, current_key)
+
+    def test_read_across_partitions(self):
+        (repo, current_key) = self._make_repo_with_old_partitions()
+        self.assertEqual([current_key - 2, current_key - 1, current_key], repo.partition_keys())
+        self.assertTrue(os.path.exists(repo._path_for_key(current_key)))
+
+        page = repo.get_observations(limit=4)
+        self.assertEqual(["0", "1", "2", "3"], [o.result for o in page])
+        page = repo.get_observations(limit=4, after_id=page[-1].id)
+        self.assertEqual(["4", "5", "6", "7"], [o.result for o in page])
+        self.assertEqual([str(i) for i in range(9)], [o.result for o in repo.iter_observations(page_size=2)])
+        self.assertEqual(9, len(set([o.id for o in repo.get_all_observations()])))
+        self.assertEqual([o.id for o in repo.get_all_observations()[2:5]],
+                         [o.id for o in repo.query("54321", start="2017-04-11T15:29:02Z", limit=3)])
+
+    def test_drop_delivered_partition(self):
+        (repo, current_key) = self._make_repo_with_old_partitions()
+        obs = repo.get_observations()
+        repo.update_observation_status([obs[3].id])
+        repo.delete_observations([o.id for o in obs if o.id != obs[3].id])
+
+        # Oldest partition was fully delivered, the second still holds an ERROR observation,
+        #   and the current partition may still be written to.
+        self.assertFalse(os.path.exists(repo._path_for_key(current_key - 2)))
+        self.assertEqual([current_key - 1, current_key], repo.partition_keys())
+        self.assertEqual(["3"], [o.result for o in repo.get_all_observations()])
+
+        # Late acknowledgements for the dropped partition don't bring its file back
+        repo.delete_observations([obs[0].id])
+        repo.update_observation_status([obs[1].id])
+        self.assertEqual([current_key - 1, current_key], repo.partition_keys())
+
+    def test_open_partitions_are_bounded(self):
+        repo = get_repository_instance(config)
+        current_key = repo._key_for_time(time.time())
+        n = PartitionedSqliteRepository.MAX_OPEN_PARTITIONS + 2
+        for i in range(n):
+            repo._get_partition(current_key - n + i, create=True).create_observations(self._make_observations(1, i))
+        self.assertEqual(PartitionedSqliteRepository.MAX_OPEN_PARTITIONS, len(repo.partitions))
+        # Evicted partitions are reopened when read
+        self.assertEqual([str(i) for i in range(n)], [o.result for o in repo.get_observations()])
+        self.assertEqual(n, len(list(repo.query("54321"))))
+        self.assertEqual(PartitionedSqliteRepository.MAX_OPEN_PARTITIONS, len(repo.partitions))
+
+    def test_keep_partition_with_dead_letters(self):
+        config[CFG_SPOOLER_RETRY_MAX_ATTEMPTS] = 1
+        (repo, current_key) = self._make_repo_with_old_partitions()
+        obs = [o for o in repo.get_observations() if o.id >> repo.PARTITION_ID_SHIFT == current_key - 2]
+        repo.update_observation_status([obs[0].id])
+        repo.delete_observations([o.id for o in obs[1:]])
+        repo.compact()
+
+        # The oldest partition holds nothing but a dead letter, which survives
+        self.assertIn(current_key - 2, repo.partition_keys())
+        self.assertEqual(["0"], [o.result for (o, attempts, dead_since) in repo.get_dead_letters()])
+
+        self.assertEqual(1, repo.purge_dead_letters())
+        repo.compact()
+        self.assertNotIn(current_key - 2, repo.partition_keys())
+
+    def test_partition_retention(self):
+        config[CFG_SPOOLER_MAX_AGE_HOURS] = 1.0
+        (repo, current_key) = self._make_repo_with_old_partitions()
+        self.assertEqual([current_key - 1, current_key], repo.partition_keys())
+
+        config[CFG_SPOOLER_MAX_AGE_HOURS] = None
+        config[CFG_SPOOLER_MAX_ROWS] = 4
+        repo = get_repository_instance(config)
+        repo.create_observations(self._make_observations(1))
+        self.assertEqual([current_key], repo.partition_keys())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import math
+import statistics
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from sensors.common.constants import *
+from sensors.config import Config
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.persistence.rollup import Rollups
+
+
+class TestRollups(unittest.TestCase):
+
+    config = None
+
+    def setUp(self):
+        os.environ[ENV_YAML_PATH] = './test_sqlite.yml'
+        global config
+        config = Config(unittest=True).config
+        config[CFG_SPOOLER_ROLLUP_PATH] = '/tmp/sensor.rollups.sqlite'
+        config[CFG_SPOOLER_ROLLUP_UPLOAD] = CFG_SPOOLER_ROLLUP_TIER_15MIN
+
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(config[CFG_SPOOLER_ROLLUP_PATH] + suffix)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _make_observations(start, count, minutes=1):
+        observations = []
+        for i in range(count):
+            t = (start + timedelta(minutes=i * minutes)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            o = Observation()
+            o.datastreamId = "54321"
+            o.phenomenonTime = t
+            o.result = str(i * i % 7)
+            o.set_parameters()
+            mo = MultiObservation()
+            mo.multidatastreamId = "1q2w3"
+            mo.phenomenonTime = t
+            mo.result = [float(i), math.nan if i % 2 == 0 else 20.0 + i]
+            mo.set_parameters()
+            observations.extend([o, mo])
+        return observations
+
+    @staticmethod
+    def _quarter_start(t):
+        return t.replace(minute=t.minute - t.minute % 15, second=0, microsecond=0)
+
+    def test_rollups(self):
+        rollups = Rollups(config)
+        start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        observations = self._make_observations(start, 60)
+        # Folding in several batches gives the same buckets as folding all at once
+        self.assertEqual(50, rollups.add(observations[:50]))
+        self.assertEqual(70, rollups.add(observations[50:]))
+
+        (hourly,) = rollups.query("54321", start=start)
+        values = [i * i % 7 for i in range(60)]
+        self.assertEqual(start.strftime('%Y-%m-%dT%H:%M:%SZ') + '/' +
+                         (start + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ'), hourly.phenomenonTime)
+        self.assertAlmostEqual(statistics.mean(values), hourly.result)
+        self.assertEqual({'rollup': 'hourly', 'count': 60, 'min': 0.0, 'max': 4.0},
+                         {k: v for (k, v) in hourly.parameters.items() if k != 'stddev'})
+        self.assertAlmostEqual(statistics.stdev(values), hourly.parameters['stddev'])
+
+        quarters = rollups.query("1q2w3", tier=CFG_SPOOLER_ROLLUP_TIER_15MIN)
+        self.assertEqual(4, len(quarters))
+        odd = [20.0 + i for i in range(15, 30) if i % 2 == 1]
+        self.assertEqual([15, 8], quarters[1].parameters['count'])
+        self.assertAlmostEqual(22.0, quarters[1].result[0])
+        self.assertAlmostEqual(statistics.mean(odd), quarters[1].result[1])
+        self.assertAlmostEqual(statistics.stdev(odd), quarters[1].parameters['stddev'][1])
+        self.assertEqual([15.0, min(odd)], quarters[1].parameters['min'])
+
+        # Buckets past retention are dropped
+        config[CFG_SPOOLER_ROLLUP_15MIN_RETENTION_DAYS] = 1 / 24
+        Rollups(config).add([])
+        self.assertEqual(0, len(rollups.query("1q2w3", tier=CFG_SPOOLER_ROLLUP_TIER_15MIN)))
+        self.assertEqual(1, len(rollups.query("1q2w3")))
+
+    def test_upload(self):
+        rollups = Rollups(config)
+        now = datetime.now(timezone.utc)
+        rollups.add(self._make_observations(now - timedelta(minutes=90), 4, minutes=15))
+        # Still in progress
+        rollups.add(self._make_observations(now + timedelta(minutes=30), 1))
+        transport = config[CFG_TRANSPORTS][0].identifier()
+
+        # The bucket in progress holds back any bucket created after it
+        ids = [o.id for o in rollups.get_observations(transport=transport)]
+        self.assertEqual(8, len(ids))
+        self.assertEqual(['15min'], list(set([o.parameters['rollup'] for o in rollups.get_observations()])))
+        rollups.delete_observations(ids[:5], transport=transport)
+        self.assertEqual(ids[5:], [o.id for o in rollups.get_observations(transport=transport)])
+        rollups.add(self._make_observations(now - timedelta(hours=3), 1))
+        self.assertEqual(ids[5:], [o.id for o in rollups.get_observations(transport=transport)])
+        self.assertEqual(ids, [o.id for o in rollups.get_observations()])
+
+        # A late observation in an uploaded bucket moves it past the cursor, to be uploaded again
+        late = self._make_observations(now - timedelta(minutes=90), 1)[0]
+        late.result = "100"
+        rollups.add([late])
+        (changed,) = rollups.query("54321", tier=CFG_SPOOLER_ROLLUP_TIER_15MIN,
+                                   start=self._quarter_start(now - timedelta(minutes=90)),
+                                   end=self._quarter_start(now - timedelta(minutes=75)))
+        self.assertNotIn(changed.id, ids)
+        self.assertGreater(changed.id, max(ids))
+        self.assertEqual(2, changed.parameters['count'])
+        self.assertEqual(100.0, changed.parameters['max'])
+        # ... while one that wasn't uploaded yet is changed in place
+        late = self._make_observations(now - timedelta(minutes=45), 1)[1]
+        rollups.add([late])
+        (waiting,) = rollups.query("1q2w3", tier=CFG_SPOOLER_ROLLUP_TIER_15MIN,
+                                   start=self._quarter_start(now - timedelta(minutes=45)),
+                                   end=self._quarter_start(now - timedelta(minutes=30)))
+        self.assertIn(waiting.id, ids[5:])
+        self.assertEqual(ids[5:], [o.id for o in rollups.get_observations(transport=transport)])
+
+if __name__ == '__main__':
+    unittest.main()
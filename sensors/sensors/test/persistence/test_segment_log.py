@@ -0,0 +1,203 @@
+import os
+import shutil
+import unittest
+
+from sensors.common.constants import *
+from sensors.config import Config
+from sensors.config.util import ConfigurationError
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.domain import get_transport_instance
+from sensors.persistence import get_repository_instance
+from sensors.persistence.segment_log import SegmentLogRepository
+
+
+class TestSegmentLogRepository(unittest.TestCase):
+
+    config = None
+
+    def setUp(self):
+        os.environ[ENV_YAML_PATH] = './test_sqlite.yml'
+        global config
+        config = Config(unittest=True).config
+        config[CFG_SPOOLER_BACKEND] = CFG_SPOOLER_BACKEND_SEGMENT_LOG
+        config[CFG_SPOOLER_SEGMENT_SIZE_BYTES] = 256
+        config[CFG_SPOOLER_RETRY_MAX_ATTEMPTS] = 1
+
+        shutil.rmtree(os.path.splitext(config[CFG_SPOOLER_DB_PATH])[0] + SegmentLogRepository.DIRECTORY_SUFFIX,
+                      ignore_errors=True)
+
+    @staticmethod
+    def _make_observations(count, first=0):
+        observations = []
+        for i in range(first, first + count):
+            o = Observation()
+            o.datastreamId = "54321"
+            o.phenomenonTime = "2017-04-11T15:29:55Z"
+            o.result = str(i)
+            o.set_parameters(n=str(i))
+            observations.append(o)
+        return observations
+
+    def test_rw_observations(self):
+        repo = get_repository_instance(config)
+        self.assertIsInstance(repo, SegmentLogRepository)
+
+        mo = MultiObservation()
+        mo.multidatastreamId = "1q2w3"
+        mo.phenomenonTime = "2017-04-11T15:35:55Z"
+        mo.result = [0.1, 0.2]
+        mo.set_parameters()
+        repo.create_observations(self._make_observations(20) + [mo])
+        # Records are spread over several segments
+        self.assertGreater(len(repo.segment_bases()), 1)
+
+        obs = repo.get_observations(limit=5)
+        self.assertEqual(["0", "1", "2", "3", "4"], [o.result for o in obs])
+        self.assertEqual({"n": "0"}, obs[0].parameters)
+        obs = repo.get_observations(limit=5, after_id=obs[-1].id)
+        self.assertEqual(["5", "6", "7", "8", "9"], [o.result for o in obs])
+        all_obs = list(repo.iter_observations(page_size=4))
+        self.assertEqual(21, len(all_obs))
+        self.assertEqual(mo, all_obs[-1])
+
+    def test_acknowledgement(self):
+        repo = SegmentLogRepository(config)
+        repo.create_observations(self._make_observations(20))
+        first_segment = repo.segment_bases()[0]
+
+        obs = repo.get_observations(limit=10)
+        # Out of order acknowledgement only advances the checkpoint over the contiguous prefix
+        repo.delete_observations([o.id for o in obs[5:]])
+        self.assertEqual(0, repo.get_checkpoint())
+        repo.update_observation_status([obs[0].id])
+        repo.delete_observations([o.id for o in obs[1:5]])
+        # The checkpoint is now at the start of the first unacknowledged observation
+        self.assertEqual(repo.get_observations(limit=1)[0].id - 1, repo.get_checkpoint())
+        self.assertNotIn(first_segment, repo.segment_bases())
+
+        # The checkpoint is durable
+        repo = SegmentLogRepository(config)
+        self.assertEqual([str(i) for i in range(10, 20)], [o.result for o in repo.get_observations()])
+        errors = repo.get_error_observations()
+        self.assertEqual(["0"], [o.result for o in errors])
+
+    def test_claim_observations(self):
+        repo = SegmentLogRepository(config)
+        repo.create_observations(self._make_observations(10))
+
+        claimed = repo.claim_observations(limit=4, lease_seconds=60)
+        self.assertEqual(["0", "1", "2", "3"], [o.result for o in claimed])
+        # Claimed observations are neither read nor claimed again while the lease holds, by any claimant
+        other = SegmentLogRepository(config)
+        self.assertEqual(["4", "5", "6"], [o.result for o in other.claim_observations(limit=3, lease_seconds=60)])
+        self.assertEqual(["7", "8", "9"], [o.result for o in repo.get_observations()])
+
+        # Settling by another claimant still advances the checkpoint over the contiguous prefix
+        other.delete_observations([o.id for o in claimed[:2]])
+        self.assertEqual(claimed[2].id - 1, repo._read_checkpoint(repo.DEFAULT_CONSUMER))
+        repo.release_observations([o.id for o in claimed[2:]])
+        self.assertEqual(["2", "3", "7", "8", "9"], [o.result for o in repo.claim_observations(lease_seconds=0)])
+        # Expired leases can be claimed again
+        self.assertEqual(["2", "3", "7", "8", "9"], [o.result for o in repo.claim_observations(lease_seconds=60)])
+
+    def test_transport_consumers(self):
+        config[CFG_TRANSPORTS] = [get_transport_instance(CFG_TRANSPORT_TYPE_HTTPS, url=url, auth_url=url,
+                                                         jwt_id="id", jwt_key="key")
+                                  for url in ("https://a.example.com/", "https://b.example.com/")]
+        (a, b) = [t.identifier() for t in config[CFG_TRANSPORTS]]
+        repo = SegmentLogRepository(config)
+        repo.create_observations(self._make_observations(20))
+        first_segment = repo.segment_bases()[0]
+
+        repo.delete_observations([o.id for o in repo.get_observations(limit=10, transport=a)], transport=a)
+        self.assertEqual("10", repo.get_observations(transport=a)[0].result)
+        self.assertEqual("0", repo.get_observations(transport=b)[0].result)
+        self.assertIn(first_segment, repo.segment_bases())
+
+        repo.delete_observations([o.id for o in repo.get_observations(limit=10, transport=b)], transport=b)
+        self.assertNotIn(first_segment, repo.segment_bases())
+
+    def test_torn_record_recovery(self):
+        repo = SegmentLogRepository(config)
+        repo.create_observations(self._make_observations(2))
+        repo.close()
+        path = repo._segment_path(repo.segment_bases()[-1])
+        with open(path, 'ab') as f:
+            f.write(SegmentLogRepository.LENGTH_PREFIX.pack(100) + b'[0,')
+
+        repo = SegmentLogRepository(config)
+        self.assertEqual(2, len(repo.get_observations()))
+        repo.create_observations(self._make_observations(1, first=2))
+        self.assertEqual(["0", "1", "2"], [o.result for o in repo.get_observations()])
+
+    def test_spool_budget(self):
+        config[CFG_SPOOLER_MAX_BYTES] = 512
+        repo = SegmentLogRepository(config)
+        repo.create_observations(self._make_observations(40))
+        total = sum([os.path.getsize(repo._segment_path(b)) for b in repo.segment_bases()])
+        self.assertLessEqual(total, 512)
+        self.assertEqual("39", repo.get_observations()[-1].result)
+
+    def test_retries_rejected(self):
+        config[CFG_SPOOLER_RETRY_MAX_ATTEMPTS] = 10
+        with self.assertRaises(ConfigurationError):
+            get_repository_instance(config)
+
+    def test_stats(self):
+        repo = SegmentLogRepository(config)
+        obs = self._make_observations(5)
+        obs[4].datastreamId = "12345"
+        obs[4].phenomenonTime = "2017-04-12T15:29:55Z"
+        repo.create_observations(obs)
+        obs = repo.get_observations()
+        repo.delete_observations([obs[0].id])
+        repo.update_observation_status([obs[1].id])
+
+        stats = repo.stats()
+        self.assertEqual(3, stats['observations'])
+        self.assertEqual({SegmentLogRepository.STATUS_PENDING: 3}, stats['by_status'])
+        self.assertEqual(1, stats['dead_letters'])
+        self.assertEqual({"54321": {SegmentLogRepository.STATUS_PENDING: 2, SegmentLogRepository.STATUS_DEAD_LETTER: 1},
+                          "12345": {SegmentLogRepository.STATUS_PENDING: 1}}, stats['by_datastream'])
+        self.assertEqual("2017-04-11T15:29:55Z", stats['oldest_phenomenon_time'])
+        self.assertEqual("2017-04-12T15:29:55Z", stats['newest_phenomenon_time'])
+        self.assertGreater(stats['db_size_bytes'], 0)
+
+    def test_query(self):
+        repo = SegmentLogRepository(config)
+        obs = self._make_observations(6)
+        for (i, o) in enumerate(obs):
+            # Arrive out of order of time
+            o.phenomenonTime = "2017-04-11T15:29:5{0}Z".format(5 - i)
+        obs[0].datastreamId = "12345"
+        repo.create_observations(obs)
+        # Delivered observations are still found
+        repo.delete_observations([o.id for o in repo.get_observations(limit=2)])
+
+        self.assertEqual(["5", "4", "3", "2", "1"], [o.result for o in repo.query("54321")])
+        self.assertEqual(["4", "3"], [o.result for o in repo.query("54321", start="2017-04-11T15:29:51Z",
+                                                                   end="2017-04-11T15:29:53Z")])
+        self.assertEqual(["5", "4"], [o.result for o in repo.query("54321", limit=2)])
+        self.assertEqual(["0"], [o.result for o in repo.query("12345")])
+
+    def test_dead_letters(self):
+        repo = SegmentLogRepository(config)
+        self.assertFalse(repo.has_dead_letters())
+        repo.create_observations(self._make_observations(3))
+        repo.update_observation_status([o.id for o in repo.get_observations()])
+        self.assertTrue(repo.has_dead_letters())
+
+        dead_letters = repo.get_dead_letters()
+        self.assertEqual(["0", "1", "2"], [o.result for (o, attempts, dead_since) in dead_letters])
+        self.assertEqual([1, 1, 1], [attempts for (o, attempts, dead_since) in dead_letters])
+        self.assertEqual(3, len(repo.get_error_observations()))
+
+        self.assertEqual(1, repo.purge_dead_letters([dead_letters[1][0].id]))
+        self.assertEqual(["0", "2"], [o.result for (o, attempts, dead_since) in repo.get_dead_letters()])
+        self.assertEqual(2, repo.purge_dead_letters())
+        self.assertFalse(repo.has_dead_letters())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import queue
+import time
+import logging
+import unittest
+
+from sensors.domain.observation import Observation
+from sensors.persistence.spool import get_batch, _spool_loop, _store_remaining
+
+
+class _ExitingRepository:
+    """Stores observations, exiting as on SIGTERM the first time it is called"""
+
+    def __init__(self):
+        self.observations = []
+        self.calls = 0
+
+    def create_observations(self, observations):
+        self.calls += 1
+        if self.calls == 1:
+            raise SystemExit(0)
+        self.observations.extend(observations)
+        return observations
+
+
+class TestSpool(unittest.TestCase):
+
+    def test_get_batch_max_count(self):
+        q = queue.Queue()
+        for i in range(10):
+            q.put(i)
+        self.assertEqual([0, 1, 2, 3], get_batch(q, 4, 10.0))
+        self.assertEqual([4, 5, 6, 7], get_batch(q, 4, 10.0))
+        self.assertEqual([8, 9], get_batch(q, 4, 0.1))
+
+    def test_get_batch_max_wait(self):
+        q = queue.Queue()
+        q.put(1)
+        start = time.monotonic()
+        self.assertEqual([1], get_batch(q, 100, 0.2))
+        self.assertLess(time.monotonic() - start, 1.0)
+
+
+    def test_get_batch_first_wait(self):
+        q = queue.Queue()
+        self.assertEqual([], get_batch(q, 100, 0.2, first_wait_seconds=0.1))
+        q.put(1)
+        self.assertEqual([1], get_batch(q, 100, 0.1, first_wait_seconds=0.1))
+
+    def test_store_remaining_on_exit(self):
+        q = queue.Queue()
+        for i in range(5):
+            o = Observation()
+            o.datastreamId = "54321"
+            o.result = str(i)
+            q.put(o)
+        repo = _ExitingRepository()
+        logger = logging.getLogger(__name__)
+        received = []
+        with self.assertRaises(SystemExit):
+            _spool_loop(q, repo, 3, 10.0, logger, received=received)
+        # The batch read before exiting is kept, the rest is still in the queue
+        self.assertEqual(3, len(received))
+
+        _store_remaining(q, received, repo, logger)
+        self.assertEqual(["0", "1", "2", "3", "4"], [o.result for o in repo.observations])
+        self.assertEqual([], received)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,15 @@
 import os
+import math
+import sqlite3
 import unittest
+from datetime import datetime, timedelta, timezone
 
 from sensors.common.constants import *
 from sensors.config import Config
 from sensors.domain.observation import Observation
 from sensors.domain.multiobservation import MultiObservation
 from sensors.persistence.sqlite import SqliteRepository
+from sensors.domain import get_transport_instance
 
 
 class TestSqliteRepository(unittest.TestCase):
@@ -85,6 +89,470 @@ class TestSqliteRepository(unittest.TestCase):
         obs = repo.get_all_observations()
         self.assertEqual(2, len(obs))
 
+    def test_create_observations_bulk(self):
+        repo = SqliteRepository(config)
+
+        o1 = Observation()
+        o1.featureOfInterestId = "12345"
+        o1.datastreamId = "54321"
+        o1.phenomenonTime = "2017-04-11T15:29:55Z"
+        o1.result = "42.24"
+        o1.set_parameters(one="1")
+
+        mo1 = MultiObservation()
+        mo1.featureOfInterestId = "abcde"
+        mo1.multidatastreamId = "1q2w3"
+        mo1.phenomenonTime = "2017-04-11T15:35:55Z"
+        mo1.result = [0.1, 0.2, 0.3]
+        mo1.set_parameters(five="5")
+
+        self.assertEqual([o1, mo1], repo.create_observations(iter([o1, mo1])))
+        self.assertEqual([], repo.create_observations([]))
+
+        obs = repo.get_observations()
+        self.assertEqual(2, len(obs))
+        self.assertEqual(o1, obs[0])
+        self.assertEqual(mo1, obs[1])
+
+        with self.assertRaises(TypeError):
+            repo.create_observations([o1, "not an observation"])
+        # The whole batch is rolled back
+        self.assertEqual(2, len(repo.get_all_observations()))
+
+    def test_get_observations_paginated(self):
+        repo = SqliteRepository(config)
+
+        observations = []
+        for i in range(10):
+            o = Observation()
+            o.datastreamId = "54321"
+            o.phenomenonTime = "2017-04-11T15:{0:02d}:00Z".format(i)
+            o.result = str(i)
+            o.set_parameters()
+            observations.append(o)
+        repo.create_observations(observations)
+
+        page = repo.get_observations(limit=4)
+        self.assertEqual(["0", "1", "2", "3"], [o.result for o in page])
+        page = repo.get_observations(limit=4, after_id=page[-1].id)
+        self.assertEqual(["4", "5", "6", "7"], [o.result for o in page])
+
+        repo.update_observation_status([page[0].id])
+        self.assertEqual([str(i) for i in range(10) if i != 4],
+                         [o.result for o in repo.iter_observations(page_size=3)])
+
+        plan = repo._get_connection().execute("EXPLAIN QUERY PLAN " + SqliteRepository.SQL_GET_OBS,
+                                              (0, 10)).fetchall()
+        self.assertIn("observation_pending_idx", str(plan))
+
+    def test_typed_storage(self):
+        repo = SqliteRepository(config)
+
+        mo = MultiObservation()
+        mo.multidatastreamId = "1q2w3"
+        mo.phenomenonTime = "2017-04-11T15:35:55Z"
+        mo.result = [0.1, 22.5, None]
+        mo.set_parameters(**{"a,b": "c:d", "n": 1})
+        repo.create_observations([mo])
+
+        (result, parameters) = repo._get_connection().execute(
+            "SELECT result, parameters FROM observation").fetchone()
+        self.assertIsInstance(result, bytes)
+        self.assertEqual(3 * SqliteRepository.RESULT_STRUCT_SIZE, len(result))
+        self.assertEqual('{"a,b":"c:d","n":1}', parameters)
+
+        mo_read = repo.get_observations()[0]
+        self.assertEqual([0.1, 22.5], mo_read.result[:2])
+        self.assertTrue(math.isnan(mo_read.result[2]))
+        self.assertEqual({"a,b": "c:d", "n": 1}, mo_read.parameters)
+
+    def test_migrate_v1(self):
+        with sqlite3.connect(config[CFG_SPOOLER_DB_PATH]) as conn:
+            conn.execute(SqliteRepository.SQL_CREATE_OBS_TABLE)
+            conn.execute(SqliteRepository.SQL_CREATE_OBS, ("12345", "54321", "2017-04-11T15:29:55Z",
+                                                           "42.24", '"one":"1","two":"2"'))
+            conn.execute(SqliteRepository.SQL_CREATE_MULT_OBS, ("abcde", "1q2w3", "2017-04-11T15:35:55Z",
+                                                                "0.1,0.2,0.3", '"five":"5"'))
+        conn.close()
+
+        repo = SqliteRepository(config)
+        conn = repo._get_connection()
+        self.assertEqual(SqliteRepository.SCHEMA_VERSION, conn.execute("PRAGMA user_version").fetchone()[0])
+
+        obs = repo.get_observations()
+        self.assertEqual("42.24", obs[0].result)
+        self.assertEqual({"one": "1", "two": "2"}, obs[0].parameters)
+        self.assertEqual([0.1, 0.2, 0.3], obs[1].result)
+        self.assertEqual({"five": "5"}, obs[1].parameters)
+        # Counters are populated from the existing observations
+        self.assertEqual({"54321": {"PENDING": 1}, "1q2w3": {"PENDING": 1}}, repo.stats()['by_datastream'])
+
+        # Opening an up-to-date database does not migrate again
+        repo.close()
+        self.assertEqual([0.1, 0.2, 0.3], SqliteRepository(config).get_observations()[1].result)
+
+    def test_migration_resumes(self):
+        with sqlite3.connect(config[CFG_SPOOLER_DB_PATH]) as conn:
+            conn.execute(SqliteRepository.SQL_CREATE_OBS_TABLE)
+            for i in range(5):
+                conn.execute(SqliteRepository.SQL_CREATE_OBS, ("12345", "54321", "2017-04-11T15:29:5{0}Z".format(i),
+                                                               str(i), '"n":"{0}"'.format(i)))
+        conn.close()
+
+        def interrupt(cursor):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        chunk_size = SqliteRepository.MIGRATION_CHUNK_SIZE
+        finish = SqliteRepository._finish_migrate_v6
+        SqliteRepository.MIGRATION_CHUNK_SIZE = 2
+        try:
+            # Opening the spool only starts the online migration of phenomenon times
+            repo = SqliteRepository(config)
+            conn = repo._get_connection()
+            self.assertEqual(SqliteRepository.SCHEMA_VERSION, conn.execute("PRAGMA user_version").fetchone()[0])
+            self.assertEqual(0, conn.execute("SELECT last_id FROM migration_progress WHERE version = 6").fetchone()[0])
+            # ... and the spool can be read and written meanwhile
+            self.assertEqual("2017-04-11T15:29:54Z", repo.get_observations()[4].phenomenonTime)
+            new = self._make_observations(2)
+            new[1].phenomenonTime = "2017-04-11T15:29:50Z"
+            new[1].datastreamId = "54321"
+            self.assertEqual(2, len(repo.create_observations(new)))
+
+            # Chunks are run by compact()
+            repo.compact(max_seconds=0)
+            self.assertEqual(2, conn.execute("SELECT last_id FROM migration_progress WHERE version = 6").fetchone()[0])
+            SqliteRepository._finish_migrate_v6 = staticmethod(interrupt)
+            self.assertRaises(sqlite3.OperationalError, repo.compact)
+            repo.close()
+        finally:
+            SqliteRepository.MIGRATION_CHUNK_SIZE = chunk_size
+            SqliteRepository._finish_migrate_v6 = finish
+
+        # Every chunk of the interrupted migration was committed
+        with sqlite3.connect(config[CFG_SPOOLER_DB_PATH]) as conn:
+            self.assertEqual(7, conn.execute("SELECT last_id FROM migration_progress WHERE version = 6").fetchone()[0])
+            self.assertEqual(0, conn.execute("SELECT count(*) FROM observation "
+                                             "WHERE typeof(phenomenonTime) = 'text'").fetchone()[0])
+        conn.close()
+
+        repo = SqliteRepository(config)
+        repo.compact()
+        conn = repo._get_connection()
+        self.assertEqual(0, conn.execute("SELECT count(*) FROM migration_progress").fetchone()[0])
+        # The duplicate written during the migration was dropped, and the unique index created
+        obs = repo.get_observations()
+        self.assertEqual(["0", "1", "2", "3", "4", "0"], [o.result for o in obs])
+        self.assertEqual({"n": "4"}, obs[4].parameters)
+        self.assertEqual("2017-04-11T15:29:54Z", obs[4].phenomenonTime)
+        self.assertEqual(6, repo.get_observation_count())
+        self.assertEqual({"PENDING": 6}, repo.stats()['by_status'])
+        self.assertEqual([], repo.create_observations([new[1]]))
+
+    @staticmethod
+    def _make_observations(count, datastream_ids=("54321",),
+                           phenomenon_time=datetime(2017, 4, 11, 15, 29, 55, tzinfo=timezone.utc), first=0):
+        observations = []
+        for i in range(first, first + count):
+            o = Observation()
+            o.datastreamId = datastream_ids[i % len(datastream_ids)]
+            # One second apart, so that observations are not dropped as duplicates
+            o.phenomenonTime = (phenomenon_time + timedelta(seconds=i)).isoformat()
+            o.result = str(i)
+            o.set_parameters()
+            observations.append(o)
+        return observations
+
+    def _budget_config(self, **budget):
+        c = dict(config)
+        c[CFG_SPOOLER_EVICTION_BATCH_SIZE] = 10
+        c.update(budget)
+        return c
+
+    def test_spool_budget_max_rows(self):
+        repo = SqliteRepository(self._budget_config(**{CFG_SPOOLER_MAX_ROWS: 25}))
+        self.assertEqual(2, repo._get_connection().execute("PRAGMA auto_vacuum").fetchone()[0])
+
+        repo.create_observations(self._make_observations(40))
+        obs = repo.get_all_observations()
+        # Oldest observations are dropped in batches of 10
+        self.assertEqual(20, len(obs))
+        self.assertEqual("20", obs[0].result)
+
+    def test_spool_budget_drop_errors_first(self):
+        repo = SqliteRepository(self._budget_config(**{CFG_SPOOLER_MAX_ROWS: 25,
+                                                       CFG_SPOOLER_EVICTION_POLICY:
+                                                           CFG_SPOOLER_EVICTION_POLICY_DROP_ERRORS_FIRST}))
+        repo.create_observations(self._make_observations(20))
+        obs = repo.get_observations(limit=20)
+        repo.update_observation_status([o.id for o in obs[10:15]])
+
+        repo.create_observations(self._make_observations(10, first=20))
+        self.assertEqual(25, len(repo.get_all_observations()))
+        self.assertEqual(25, len(repo.get_observations(limit=100)))
+
+    def test_spool_budget_thin(self):
+        repo = SqliteRepository(self._budget_config(**{CFG_SPOOLER_MAX_ROWS: 17,
+                                                       CFG_SPOOLER_EVICTION_POLICY: CFG_SPOOLER_EVICTION_POLICY_THIN}))
+        repo.create_observations(self._make_observations(20, datastream_ids=("a", "b")))
+        obs = repo.get_all_observations()
+        self.assertEqual(16, len(obs))
+        # Every other of the five oldest observations of each datastream is kept
+        self.assertEqual(["0", "1", "4", "5", "8", "9"], [o.result for o in obs[:6]])
+
+    def test_spool_budget_max_age(self):
+        repo = SqliteRepository(self._budget_config(**{CFG_SPOOLER_MAX_AGE_HOURS: 24}))
+        repo.create_observations(self._make_observations(25))
+        self.assertEqual(0, len(repo.get_all_observations()))
+        recent = datetime.now(timezone.utc)
+        repo.create_observations(self._make_observations(5, phenomenon_time=recent))
+        self.assertEqual(5, len(repo.get_all_observations()))
+        plan = repo._get_connection().execute("EXPLAIN QUERY PLAN " + SqliteRepository.SQL_EVICT_EXPIRED,
+                                              (0, 0, 10)).fetchall()
+        self.assertIn("observation_time_idx", str(plan))
+
+    def test_spool_budget_max_bytes(self):
+        repo = SqliteRepository(self._budget_config(**{CFG_SPOOLER_MAX_BYTES: 144 * 1024,
+                                                       CFG_SPOOLER_EVICTION_BATCH_SIZE: 500}))
+        for i in range(20):
+            repo.create_observations(self._make_observations(1000, first=i * 1000))
+        conn = repo._get_connection()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.assertLessEqual(os.path.getsize(config[CFG_SPOOLER_DB_PATH]), 144 * 1024)
+        self.assertGreater(len(repo.get_all_observations()), 0)
+
+    def test_transport_cursors(self):
+        c = dict(config)
+        c[CFG_TRANSPORTS] = [get_transport_instance(CFG_TRANSPORT_TYPE_HTTPS, url=url, auth_url=url,
+                                                    jwt_id="id", jwt_key="key")
+                             for url in ("https://a.example.com/", "https://b.example.com/")]
+        (a, b) = [t.identifier() for t in c[CFG_TRANSPORTS]]
+        repo = SqliteRepository(c)
+        repo.create_observations(self._make_observations(10))
+
+        obs = repo.get_observations(limit=5, transport=a)
+        repo.update_observation_status([obs[0].id], transport=a)
+        repo.delete_observations([o.id for o in obs[1:]], transport=a)
+        # Transport a has moved on, b has not seen anything yet
+        self.assertEqual([str(i) for i in range(5, 10)], [o.result for o in repo.get_observations(transport=a)])
+        self.assertEqual(10, len(repo.get_observations(transport=b)))
+        self.assertEqual(10, repo.get_observation_count())
+
+        obs = repo.get_observations(limit=7, transport=b)
+        repo.delete_observations([o.id for o in obs], transport=b)
+        # The first five were acknowledged by both: one rejected by a is kept as ERROR
+        self.assertEqual(6, repo.get_observation_count())
+        self.assertEqual(5, len(repo.get_observations()))
+        self.assertEqual(["0"], [o.result for o in repo.get_all_observations() if o.id == obs[0].id])
+        self.assertEqual(3, len(repo.get_observations(transport=b)))
+
+        # Delivered observations are hidden until compacted
+        self.assertEqual(10, repo._get_connection().execute("SELECT count(*) FROM observation").fetchone()[0])
+        self.assertEqual(4, repo.stats()['awaiting_compaction'])
+
+        # A transport added to the configuration has not delivered anything yet
+        more = dict(c)
+        more[CFG_TRANSPORTS] = c[CFG_TRANSPORTS] + [get_transport_instance(
+            CFG_TRANSPORT_TYPE_HTTPS, url="https://c.example.com/", auth_url="https://c.example.com/",
+            jwt_id="id", jwt_key="key")]
+        self.assertEqual(10, SqliteRepository(more).get_observation_count())
+        repo = SqliteRepository(c)
+        self.assertEqual(6, repo.get_observation_count())
+
+        self.assertEqual(4, repo.compact())
+        self.assertEqual(6, repo._get_connection().execute("SELECT count(*) FROM observation").fetchone()[0])
+        self.assertEqual(6, repo.get_observation_count())
+        self.assertEqual(0, repo.compact())
+
+        # Ids are never re-used, even once the spool is empty
+        last_id = repo.get_all_observations()[-1].id
+        repo.delete_observations([o.id for o in repo.get_all_observations()])
+        repo.create_observations(self._make_observations(1))
+        self.assertGreater(repo.get_all_observations()[0].id, last_id)
+
+    def test_bulk_id_operations(self):
+        chunks = list(SqliteRepository._id_chunks(range(1, SqliteRepository.ID_CHUNK_SIZE + 3)))
+        self.assertEqual(2, len(chunks))
+        self.assertEqual((SqliteRepository.ID_CHUNK_SIZE + 1, SqliteRepository.ID_CHUNK_SIZE + 2) +
+                         (SqliteRepository.ID_CHUNK_SIZE + 2,) * (SqliteRepository.ID_CHUNK_SIZE - 2), chunks[1])
+        self.assertEqual([], list(SqliteRepository._id_chunks([])))
+
+        repo = SqliteRepository(config)
+        repo.create_observations(self._make_observations(3000))
+        ids = [o.id for o in repo.get_all_observations()]
+        repo.update_observation_status([i for i in ids if i % 3 == 0], status=SqliteRepository.STATUS_IN_FLIGHT)
+        repo.delete_observations([i for i in ids if i % 7 != 0])
+        obs = repo.get_all_observations()
+        self.assertEqual([i for i in ids if i % 7 == 0], [o.id for o in obs])
+        self.assertEqual(len([i for i in ids if i % 21 == 0]), repo.stats()['by_status']['IN_FLIGHT'])
+
+    def test_claim_observations(self):
+        repo = SqliteRepository(config)
+        repo.create_observations(self._make_observations(10))
+
+        claimed = repo.claim_observations(limit=4, lease_seconds=60)
+        self.assertEqual(["0", "1", "2", "3"], [o.result for o in claimed])
+        # Claimed observations are neither read nor claimed again while the lease holds
+        self.assertEqual(["4", "5", "6"], [o.result for o in repo.claim_observations(limit=3, lease_seconds=60)])
+        self.assertEqual(["7", "8", "9"], [o.result for o in repo.get_observations()])
+
+        repo.delete_observations([o.id for o in claimed[:2]])
+        repo.release_observations([o.id for o in claimed[2:]])
+        self.assertEqual(["2", "3", "7", "8", "9"], [o.result for o in repo.claim_observations(lease_seconds=0)])
+        # Expired leases go back to PENDING
+        self.assertEqual(["2", "3", "7", "8", "9"], [o.result for o in repo.claim_observations(lease_seconds=60)])
+        self.assertEqual(8, repo.get_observation_count())
+
+    def test_claim_observations_for_transport(self):
+        repo = SqliteRepository(config)
+        repo.create_observations(self._make_observations(10))
+        transport = config[CFG_TRANSPORTS][0].identifier()
+
+        first = repo.claim_observations(limit=4, transport=transport)
+        second = repo.claim_observations(limit=3, transport=transport)
+        # A later batch is acknowledged while the first one is still claimed
+        repo.delete_observations([o.id for o in second], transport=transport)
+        self.assertEqual(["7", "8", "9"], [o.result for o in repo.claim_observations(transport=transport)])
+        repo.release_observations([o.id for o in first])
+        # The cursor did not move past the released observations, which are claimed again
+        self.assertEqual(["0", "1", "2", "3"], [o.result for o in repo.claim_observations(transport=transport)])
+        repo.delete_observations([o.id for o in first], transport=transport)
+        self.assertEqual([], repo.claim_observations(transport=transport))
+        self.assertEqual(7, repo._get_transport_cursor(repo._get_connection(), transport))
+        self.assertEqual(3, repo.get_observation_count())
+
+    def test_retry_and_dead_letters(self):
+        repo = SqliteRepository(self._budget_config(**{CFG_SPOOLER_RETRY_MAX_ATTEMPTS: 2,
+                                                       CFG_SPOOLER_RETRY_BACKOFF_SEC: 1}))
+        repo.create_observations(self._make_observations(3))
+        obs = repo.get_observations()
+        repo.update_observation_status([obs[0].id])
+        # Not due until the backoff has elapsed
+        self.assertEqual(0, repo.retry_observations())
+        self.assertEqual(["1", "2"], [o.result for o in repo.get_observations()])
+
+        conn = repo._get_connection()
+        conn.execute("UPDATE observation SET next_attempt = 0")
+        conn.commit()
+        self.assertEqual(1, repo.retry_observations())
+        obs = repo.get_observations()
+        # Retried observations are re-queued behind newer ones
+        self.assertEqual(["1", "2", "0"], [o.result for o in obs])
+        self.assertGreater(obs[2].id, obs[1].id)
+
+        # The second failure exhausts the attempts
+        repo.update_observation_status([obs[2].id])
+        self.assertEqual(2, repo.get_observation_count())
+        dead_letters = repo.get_dead_letters()
+        self.assertEqual(1, len(dead_letters))
+        (o, attempts, dead_since) = dead_letters[0]
+        self.assertEqual(("0", 2), (o.result, attempts))
+
+        self.assertEqual(1, repo.requeue_dead_letters([o.id]))
+        self.assertEqual(0, len(repo.get_dead_letters()))
+        self.assertEqual(["1", "2", "0"], [o.result for o in repo.get_observations()])
+        repo.update_observation_status([o.id for o in repo.get_observations()])
+        conn.execute("UPDATE observation SET next_attempt = 0")
+        conn.commit()
+        repo.retry_observations()
+        repo.update_observation_status([o.id for o in repo.get_observations()])
+        self.assertEqual(3, len(repo.get_dead_letters()))
+        self.assertEqual(3, repo.purge_dead_letters())
+        self.assertEqual(0, len(repo.get_dead_letters()))
+        self.assertEqual(0, repo.get_observation_count())
+
+    def test_duplicates_ignored(self):
+        repo = SqliteRepository(config)
+        observations = self._make_observations(5)
+        self.assertEqual(observations, repo.create_observations(observations))
+        # Same instants in a different notation, e.g. re-sent after a crash or a backfill
+        for o in observations[:2]:
+            o.phenomenonTime = o.phenomenonTime.replace('+00:00', 'Z')
+            o.result = "duplicate"
+        self.assertEqual(["5"], [o.result for o in
+                                 repo.create_observations(observations[:2] + self._make_observations(1, first=5))])
+        repo.create_observation(observations[2])
+        self.assertEqual(3, repo.duplicates_ignored)
+        obs = repo.get_observations()
+        self.assertEqual(["0", "1", "2", "3", "4", "5"], [o.result for o in obs])
+        self.assertEqual("2017-04-11T15:29:55Z", obs[0].phenomenonTime)
+        self.assertEqual(int, type(repo._get_connection().execute(
+            "SELECT phenomenonTime FROM observation").fetchone()[0]))
+
+    def test_stats(self):
+        repo = SqliteRepository(self._budget_config(**{CFG_SPOOLER_RETRY_MAX_ATTEMPTS: 1}))
+        stats = repo.stats()
+        self.assertEqual((0, {}, None), (stats['observations'], stats['by_status'], stats['oldest_phenomenon_time']))
+
+        repo.create_observations(self._make_observations(6, datastream_ids=("a", "b")))
+        obs = repo.get_observations()
+        repo.update_observation_status([obs[0].id, obs[1].id])
+        repo.create_observations(self._make_observations(2, datastream_ids=("a", "b"), first=6))
+        repo.claim_observations(limit=1)
+        repo.delete_observations([obs[5].id])
+
+        stats = repo.stats()
+        self.assertEqual(5, stats['observations'])
+        self.assertEqual({"PENDING": 4, "IN_FLIGHT": 1}, stats['by_status'])
+        self.assertEqual({"a": {"IN_FLIGHT": 1, "PENDING": 2, "DEAD_LETTER": 1},
+                          "b": {"PENDING": 2, "DEAD_LETTER": 1}}, stats['by_datastream'])
+        self.assertEqual(2, stats['dead_letters'])
+        self.assertEqual("2017-04-11T15:29:57Z", stats['oldest_phenomenon_time'])
+        self.assertEqual("2017-04-11T15:30:02Z", stats['newest_phenomenon_time'])
+        self.assertGreater(stats['db_size_bytes'], 0)
+
+    def test_query(self):
+        repo = SqliteRepository(config)
+        repo.create_observations(self._make_observations(10, datastream_ids=("a", "b")))
+        # Delivered observations are still returned
+        repo.delete_observations([repo.get_observations()[0].id], transport=config[CFG_TRANSPORTS][0].identifier())
+
+        self.assertEqual([str(i) for i in range(0, 10, 2)], [o.result for o in repo.query("a")])
+        self.assertEqual(["2", "4"], [o.result for o in repo.query("a", start="2017-04-11T15:29:56Z",
+                                                                  end=datetime(2017, 4, 11, 15, 30, 1))])
+        self.assertEqual(["5", "7"], [o.result for o in repo.query(
+            "b", start=datetime(2017, 4, 11, 15, 29, 59, tzinfo=timezone.utc), limit=2)])
+        self.assertEqual([], list(repo.query("c")))
+        self.assertRaises(ValueError, repo.query, "a", start="yesterday")
+
+        plan = repo._get_connection().execute("EXPLAIN QUERY PLAN " + SqliteRepository.SQL_QUERY_OBS,
+                                              ("a", 0, 1)).fetchall()
+        self.assertIn("observation_datastream_time_idx", str(plan))
+        self.assertNotIn("TEMP B-TREE", str(plan))
+
+    def test_get_observations_by_datastream(self):
+        repo = SqliteRepository(config)
+        repo.create_observations(self._make_observations(10, datastream_ids=("b", "a")))
+        transport = config[CFG_TRANSPORTS][0].identifier()
+        repo.delete_observations([repo.get_observations()[0].id], transport=transport)
+
+        obs = list(repo.get_observations_by_datastream(limit=6, transport=transport))
+        self.assertEqual(["a", "a", "a", "b", "b", "b"], [o.datastreamId for o in obs])
+        self.assertEqual(["1", "3", "5", "2", "4", "6"], [o.result for o in obs])
+
+    def test_phenomenon_time_encoding(self):
+        for (t, expected) in (("2017-04-11T15:29:55Z", "2017-04-11T15:29:55Z"),
+                              ("2017-04-11T15:29:55.250+00:00", "2017-04-11T15:29:55.250000Z"),
+                              ("2017-04-11T10:29:55-05:00", "2017-04-11T15:29:55Z"),
+                              ("2017-04-11T15:29:55", "2017-04-11T15:29:55Z"),
+                              ("not a time", "not a time")):
+            self.assertEqual(expected, SqliteRepository._decode_phenomenon_time(
+                SqliteRepository._encode_phenomenon_time(t)))
+
+    def test_connection_pragmas(self):
+        repo = SqliteRepository(config)
+        conn = repo._get_connection()
+
+        self.assertEqual('wal', conn.execute('PRAGMA journal_mode').fetchone()[0])
+        # NORMAL
+        self.assertEqual(1, conn.execute('PRAGMA synchronous').fetchone()[0])
+        self.assertEqual(config[CFG_SPOOLER_BUSY_TIMEOUT_MS], conn.execute('PRAGMA busy_timeout').fetchone()[0])
+        # Connection is re-used across operations
+        repo.get_observations()
+        self.assertIs(conn, repo._get_connection())
+
+        repo.close()
+        self.assertIsNot(conn, repo._get_connection())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,51 @@
+import io
+import json
+import math
+import unittest
+
+from sensors.domain.observation import Observation
+from sensors.domain.multiobservation import MultiObservation
+from sensors.transport import observations_list_to_dict, observations_to_json, write_observations_json
+
+
+class TestEncoder(unittest.TestCase):
+
+    @staticmethod
+    def _make_observations():
+        observations = []
+        for (i, datastream_id) in enumerate(("a", "a", "b")):
+            o = Observation()
+            o.id = i + 1
+            o.datastreamId = datastream_id
+            o.phenomenonTime = "2017-04-11T15:29:5{0}Z".format(i)
+            o.result = str(i)
+            o.set_parameters(n=str(i))
+            observations.append(o)
+        for (i, foi) in enumerate(("f1", None)):
+            mo = MultiObservation()
+            mo.id = i + 4
+            mo.featureOfInterestId = foi
+            mo.multidatastreamId = "m"
+            mo.phenomenonTime = "2017-04-11T15:29:5{0}Z".format(i)
+            mo.result = [0.1, math.nan]
+            mo.set_parameters()
+            observations.append(mo)
+        return observations
+
+    def test_write_observations_json(self):
+        observations = self._make_observations()
+        f = io.StringIO()
+        ids = write_observations_json(iter(observations), f)
+        self.assertEqual([1, 2, 3, 4, 5], ids)
+        # Same payload as the datastreams built in memory
+        self.assertEqual(json.loads(observations_to_json(observations_list_to_dict(observations))),
+                         json.loads(f.getvalue()))
+        self.assertEqual([[0.1, None], None, {}], json.loads(f.getvalue())[2]['dataArray'][1][1:])
+
+        f = io.StringIO()
+        self.assertEqual([], write_observations_json([], f))
+        self.assertEqual([], json.loads(f.getvalue()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import io
+import os
+import json
+import gzip
+import zlib
+import time
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+from requests.exceptions import ReadTimeout
+
+from sensors.common.constants import *
+from sensors.config import Config, ConfigurationError
+from sensors.domain.observation import Observation
+from sensors.persistence.sqlite import SqliteRepository
+from sensors.transport import TransmissionException
+from sensors.transport.https import HttpsTransport
+
+PROPERTIES = {CFG_TRANSPORT_HTTPS_AUTH_URL: "https://myservice.com/auth",
+              CFG_URL: "https://myservice.com/v1.0/",
+              CFG_TRANSPORT_HTTPS_JWT_ID: "6d770f60-9912-4545-9d3c-9e8dcf4a0dad",
+              CFG_TRANSPORT_HTTPS_JWT_KEY: "faac9ce4-fd2d-476b-9984-aee2b71dfc8e"}
+
+
+class TestHttpsTransport(unittest.TestCase):
+
+    config = None
+
+    def setUp(self):
+        os.environ[ENV_YAML_PATH] = '../persistence/test_sqlite.yml'
+        global config
+        config = Config(unittest=True).config
+        try:
+            os.unlink(config[CFG_SPOOLER_DB_PATH])
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _respond(status_code=HttpsTransport.SUCCESS_STATUS_CODE, delay=0, delays=None, status_codes=None):
+        """Fake session.post() answering every observation of the request body after delay seconds.  The
+        nth request with observations of datastream d is answered after delays[d][n] seconds and with
+        status_codes[d][n] if given.  Datastreams that two concurrent requests had in common are collected
+        in post.overlaps."""
+        lock = threading.Lock()
+        counts = {}
+
+        def nth(values, datastreams, default):
+            for d in datastreams:
+                if d in values and counts[d] < len(values[d]):
+                    return values[d][counts[d]]
+            return default
+
+        def post(url, headers=None, data=None, verify=None, timeout=None):
+            datastreams = set([d['Datastream']['@iot.id'] for d in json.loads(data.getvalue())])
+            with lock:
+                for d in datastreams:
+                    counts.setdefault(d, 0)
+                wait = nth(delays or {}, datastreams, delay)
+                status = nth(status_codes or {}, datastreams, status_code)
+                for d in datastreams:
+                    counts[d] += 1
+                post.bodies.append(data.getvalue())
+                for other in post.active:
+                    post.overlaps |= datastreams & other
+                post.active.append(datastreams)
+                post.max_concurrent = max(len(post.active), post.max_concurrent)
+            time.sleep(wait)
+            with lock:
+                post.active.remove(datastreams)
+            r = mock.Mock(status_code=status)
+            r.json.return_value = ["https://myservice.com/v1.0/Observations(1)"] * \
+                sum(len(d['dataArray']) for d in json.loads(data.getvalue()))
+            return r
+        post.bodies = []
+        post.active = []
+        post.overlaps = set()
+        post.max_concurrent = 0
+        return post
+
+    @staticmethod
+    def _spool_observations(repo, count, start=datetime(2017, 4, 11, 15, 29, 55, tzinfo=timezone.utc),
+                            datastream_ids=("1af6b695", "54321"), run_length=1):
+        """Spool count observations, run_length in a row of each of datastream_ids in turn"""
+        observations = []
+        for i in range(count):
+            o = Observation()
+            o.datastreamId = datastream_ids[(i // run_length) % len(datastream_ids)]
+            o.phenomenonTime = (start + timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            o.result = str(i)
+            o.set_parameters(comment="x" * 100)
+            observations.append(o)
+        repo.create_observations(observations)
+        return observations
+
+    def test_compression(self):
+        body = ('[{"Datastream":{"@iot.id":"1af6b695"},"dataArray":[' +
+                ','.join(['["2017-04-11T15:29:{0:02d}Z","{0}",{{}}]'.format(i % 60) for i in range(200)]) + ']}]')
+        transport = HttpsTransport(CFG_TRANSPORT_TYPE_HTTPS, **PROPERTIES)
+        self.assertEqual((body, None), transport._compress_body(body))
+
+        transport = HttpsTransport(CFG_TRANSPORT_TYPE_HTTPS, compression=CFG_TRANSPORT_HTTPS_COMPRESSION_GZIP,
+                                   **PROPERTIES)
+        (compressed, encoding) = transport._compress_body(io.BytesIO(body.encode('utf-8')))
+        self.assertEqual("gzip", encoding)
+        self.assertLess(len(compressed), len(body) / 5)
+        self.assertEqual(body, gzip.decompress(compressed).decode('utf-8'))
+
+        transport = HttpsTransport(CFG_TRANSPORT_TYPE_HTTPS, compression=CFG_TRANSPORT_HTTPS_COMPRESSION_DEFLATE,
+                                   compression_level=1, **PROPERTIES)
+        (compressed, encoding) = transport._compress_body(body)
+        self.assertEqual("deflate", encoding)
+        self.assertEqual(body, zlib.decompress(compressed).decode('utf-8'))
+        # Small bodies are sent as they are
+        (data, encoding) = transport._compress_body(io.BytesIO(b'[]'))
+        self.assertEqual((b'[]', None), (data.getvalue(), encoding))
+
+        self.assertRaises(ConfigurationError, HttpsTransport, CFG_TRANSPORT_TYPE_HTTPS, compression="brotli",
+                          **PROPERTIES)
+
+    def test_adaptive_batch_size(self):
+        repo = SqliteRepository(config)
+        observations = self._spool_observations(repo, 100)
+        transport = HttpsTransport(CFG_TRANSPORT_TYPE_HTTPS, batch_size=20, min_batch_size=5, max_batch_size=80,
+                                   max_body_bytes=2000, **PROPERTIES)
+        transport.jwt_token = ("token", datetime.utcnow())
+        transport.session.post = self._respond()
+
+        # Bodies are kept within max_body_bytes by sending fewer of the oldest observations
+        transport.transmit(repo)
+        sent = len(json.loads(transport.session.post.bodies[0])[0]['dataArray']) * 2
+        self.assertLessEqual(len(transport.session.post.bodies[0]), 2000)
+        self.assertEqual(sent, transport.batch_size)
+        self.assertEqual(observations[sent].phenomenonTime,
+                         repo.get_observations(transport=transport.identifier())[0].phenomenonTime)
+        # ... and do not grow past that
+        self.assertEqual((sent, True), transport.transmit(repo))
+        self.assertEqual(sent, transport.batch_size)
+
+        transport.max_body_bytes = HttpsTransport.DEFAULT_MAX_BODY_BYTES
+        transport.transmit(repo)
+        self.assertEqual(sent * 2, transport.batch_size)
+
+        transport.session.post = self._respond(HttpsTransport.PAYLOAD_TOO_LARGE_STATUS_CODE)
+        self.assertRaises(TransmissionException, transport.transmit, repo)
+        self.assertEqual(sent, transport.batch_size)
+        transport.session.post = mock.Mock(side_effect=ReadTimeout("timed out"))
+        self.assertRaises(TransmissionException, transport.transmit, repo)
+        self.assertRaises(TransmissionException, transport.transmit, repo)
+        self.assertEqual(5, transport.batch_size)
+        self.assertEqual(100 - sent * 3, len(repo.get_observations(transport=transport.identifier())))
+        repo.close()
+
+    def test_oversized_observation(self):
+        repo = SqliteRepository(config)
+        observations = []
+        for (datastream_id, size) in (("zzz", 10), ("aaa", 5000)):
+            o = Observation()
+            o.datastreamId = datastream_id
+            o.phenomenonTime = "2017-04-11T15:29:55Z"
+            o.result = "1"
+            o.set_parameters(comment="x" * size)
+            observations.append(o)
+        repo.create_observations(observations)
+        transport = HttpsTransport(CFG_TRANSPORT_TYPE_HTTPS, max_body_bytes=1000, **PROPERTIES)
+        transport.jwt_token = ("token", datetime.utcnow())
+        transport.session.post = self._respond()
+
+        # The oversized observation comes first by datastream, but the oldest is sent first
+        self.assertEqual((1, True), transport.transmit(repo))
+        self.assertEqual("zzz", json.loads(transport.session.post.bodies[0])[0]['Datastream']['@iot.id'])
+        (pending,) = repo.get_observations(transport=transport.identifier())
+        self.assertEqual("aaa", pending.datastreamId)
+        # ... then the oversized one alone
+        self.assertEqual((1, True), transport.transmit(repo))
+        self.assertEqual([], repo.get_observations(transport=transport.identifier()))
+        repo.close()
+
+    def test_pipelined(self):
+        repo = SqliteRepository(config)
+        # Each batch of 10 is of one datastream
+        self._spool_observations(repo, 100, datastream_ids=("a", "b", "c"), run_length=10)
+        transport = HttpsTransport(CFG_TRANSPORT_TYPE_HTTPS, post_workers=3, batch_size=10, min_batch_size=2,
+                                   max_batch_size=10, **PROPERTIES)
+        transport.jwt_token = ("token", datetime.utcnow())
+        # The first response comes last
+        transport.session.post = self._respond(delay=0.05, delays={"a": (0.2,)})
+        identifier = transport.identifier()
+
+        # Only the oldest request is acknowledged, once it completes
+        self.assertEqual((10, True), transport.transmit(repo))
+        self.assertEqual(3, transport.session.post.max_concurrent)
+        self.assertEqual(90, len(repo.get_observations(transport=identifier)))
+        self.assertEqual(2, len(transport.in_flight))
+        sent = 10
+        more = True
+        while more:
+            (n, more) = transport.transmit(repo)
+            sent += n
+        self.assertEqual(100, sent)
+        self.assertEqual(10, len(transport.session.post.bodies))
+        self.assertEqual(set(), transport.session.post.overlaps)
+        self.assertEqual([], repo.get_observations(transport=identifier))
+
+        # Only the batch of a failed request is sent again, the others are acknowledged after it
+        self._spool_observations(repo, 30, start=datetime(2017, 4, 12, tzinfo=timezone.utc),
+                                 datastream_ids=("a", "b", "c"), run_length=10)
+        transport.session.post = self._respond(delay=0.05, status_codes={"a": (500,)})
+        self.assertRaises(TransmissionException, transport.transmit, repo)
+        self.assertEqual(30, len(repo.get_observations(transport=identifier)))
+        while transport.transmit(repo)[1]:
+            pass
+        self.assertEqual([], repo.get_observations(transport=identifier))
+        self.assertEqual(4, len(transport.session.post.bodies))
+
+        # A batch that was too large is sent again in two halves
+        self._spool_observations(repo, 30, start=datetime(2017, 4, 13, tzinfo=timezone.utc),
+                                 datastream_ids=("a", "b", "c"), run_length=10)
+        transport.session.post = self._respond(delay=0.05, status_codes={"a": (413,)})
+        self.assertRaises(TransmissionException, transport.transmit, repo)
+        while transport.transmit(repo)[1]:
+            pass
+        self.assertEqual([], repo.get_observations(transport=identifier))
+        self.assertEqual([10, 10, 10, 5, 5], [sum(len(d['dataArray']) for d in json.loads(b))
+                                              for b in transport.session.post.bodies])
+        self.assertEqual(set(), transport.session.post.overlaps)
+        repo.close()
+
+    def test_pipelined_datastream_order(self):
+        repo = SqliteRepository(config)
+        # Consecutive batches share datastreams
+        self._spool_observations(repo, 60)
+        transport = HttpsTransport(CFG_TRANSPORT_TYPE_HTTPS, post_workers=3, batch_size=10, max_batch_size=10,
+                                   **PROPERTIES)
+        transport.jwt_token = ("token", datetime.utcnow())
+        transport.session.post = self._respond(delay=0.05)
+        sent = 0
+        more = True
+        while more:
+            (n, more) = transport.transmit(repo)
+            sent += n
+        self.assertEqual(60, sent)
+        # Two requests with observations of one datastream are never posted at the same time
+        self.assertEqual(set(), transport.session.post.overlaps)
+        self.assertEqual(1, transport.session.post.max_concurrent)
+        # ... and the server receives them in order
+        times = [d['dataArray'][0][0] for b in transport.session.post.bodies for d in json.loads(b)
+                 if d['Datastream']['@iot.id'] == "54321"]
+        self.assertEqual(sorted(times), times)
+        repo.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
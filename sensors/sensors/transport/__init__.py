@@ -134,6 +134,66 @@ def observations_to_json(observations_dict, allow_nan=False):
     return json_str
 
 
+JSON_DATA_ARRAY_START = '{{"{entity}":{{"@iot.id":"{entityId}"}},"components":[{components}],"dataArray":['
+JSON_DATA_ARRAY_END = '],"dataArray@iot.count":{count}}}'
+JSON_COMPONENTS = '"phenomenonTime","result","FeatureOfInterest/id","parameters"'
+JSON_COMPONENTS_NO_FOI = '"phenomenonTime","result","parameters"'
+
+_element_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def write_observations_json(observations, f, allow_nan=False):
+    """Write observations as CreateObservations JSON to the text file f, encoding each as it
+    is read from the iterable, so that memory use does not grow with the number of observations.
+    The observations of each datastream and multidatastream must come one after the other, as
+    get_observations_by_datastream() returns them.  As the number of observations of a
+    datastream is only known once they are written, dataArray@iot.count follows dataArray.
+
+    :return: List of the ids of the observations, in the order they were written, which is
+        the order of the server's response
+    """
+    ids = []
+    datastream = None
+    count = 0
+    foi_present = False
+    f.write('[')
+    for o in observations:
+        is_multidatastream = isinstance(o, MultiObservation)
+        if is_multidatastream:
+            key = ('MultiDatastream', o.multidatastreamId)
+        elif isinstance(o, Observation):
+            key = ('Datastream', o.datastreamId)
+        else:
+            raise TypeError("Observation of type {0} is unknown".format(o.__class__.__name__))
+        if key != datastream:
+            if datastream is not None:
+                f.write(JSON_DATA_ARRAY_END.format(count=count))
+                f.write(',')
+            datastream = key
+            count = 0
+            # Whether elements have a FeatureOfInterest is decided by the first of the datastream
+            foi_present = o.featureOfInterestId is not None
+            f.write(JSON_DATA_ARRAY_START.format(entity=key[0], entityId=key[1],
+                                                 components=JSON_COMPONENTS if foi_present
+                                                 else JSON_COMPONENTS_NO_FOI))
+        else:
+            f.write(',')
+        result = o.result
+        if not allow_nan:
+            result = _filter_nan(result, is_multidatastream)
+        if foi_present:
+            e = [o.phenomenonTime, result, o.featureOfInterestId, o.parameters]
+        else:
+            e = [o.phenomenonTime, result, o.parameters]
+        f.write(_element_encoder.encode(e))
+        ids.append(o.id)
+        count += 1
+    if datastream is not None:
+        f.write(JSON_DATA_ARRAY_END.format(count=count))
+    f.write(']')
+    return ids
+
+
 def _filter_nan(result, is_multidatastream, replacement=None):
     if is_multidatastream:
         new_result = []
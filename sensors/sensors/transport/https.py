@@ -2,16 +2,38 @@ from datetime import datetime, timedelta
 
 import requests
 from requests_toolbelt.adapters import host_header_ssl
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 
 from sensors.domain.transport import Transport
+from sensors.domain.multiobservation import MultiObservation
 from sensors.common.constants import *
-from sensors.config import get_config_element
+from sensors.config import get_config_element, get_config_element_typed, raise_config_error
 from sensors.transport import *
 from sensors.persistence.sqlite import SqliteRepository
 
+import io
 import os
 import json
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InFlightRequest:
+    """A batch of the observations of datastreams with ids in (after_id, up_to_id], and the future
+    response to the request posting it.  Until it is sent, future is None, and data is None if the
+    batch has to be read again.
+    """
+
+    def __init__(self, after_id, up_to_id, datastreams, ids=None, data=None):
+        self.after_id = after_id
+        self.up_to_id = up_to_id
+        self.datastreams = datastreams
+        self.ids = ids
+        self.data = data
+        self.body_bytes = None
+        self.future = None
 
 
 class HttpsTransport(Transport):
@@ -21,9 +43,28 @@ class HttpsTransport(Transport):
     DEFAULT_JWT_TTL = '15'
     DEFAULT_TRANSMIT_INTERVAL_SECONDS = '15'
     DEFAULT_VERIFY_SSL = 'true'
+    DEFAULT_COMPRESSION = CFG_TRANSPORT_HTTPS_COMPRESSION_NONE
+    # Smaller bodies gain little from compression, and may even grow
+    DEFAULT_COMPRESSION_MIN_BYTES = 1024
+    DEFAULT_COMPRESSION_LEVEL = 6
+    # zlib window bits for each Content-Encoding: gzip has a gzip header, deflate a zlib one
+    COMPRESSION_WBITS = {CFG_TRANSPORT_HTTPS_COMPRESSION_GZIP: 16 + zlib.MAX_WBITS,
+                         CFG_TRANSPORT_HTTPS_COMPRESSION_DEFLATE: zlib.MAX_WBITS}
+    DEFAULT_MAX_BODY_BYTES = 1048576
+    DEFAULT_BATCH_SIZE = 360
+    DEFAULT_MIN_BATCH_SIZE = 10
+    DEFAULT_MAX_BATCH_SIZE = 10000
+    DEFAULT_TIMEOUT_SECONDS = 60.0
+    DEFAULT_TARGET_POST_SECONDS = 5.0
+    # The batch size is halved when a POST times out or is too large, and doubled while POSTs of
+    #   full batches take less than target_post_seconds
+    BATCH_SHRINK_FACTOR = 0.5
+    BATCH_GROWTH_FACTOR = 2
+    DEFAULT_POST_WORKERS = 1
     STA_POST_PATH = '/CreateObservations'
 
     SUCCESS_STATUS_CODE = 201
+    PAYLOAD_TOO_LARGE_STATUS_CODE = 413
     ERROR_RESPONSE = 'error'
 
     # JWT authentication request token
@@ -42,10 +83,53 @@ class HttpsTransport(Transport):
         super().__init__(typ, **kwargs)
 
         self.jwt_token = (None, None)
+        self.post_workers = get_config_element_typed(CFG_TRANSPORT_HTTPS_POST_WORKERS, kwargs, CFG_PROPERTIES, int,
+                                                     default=self.DEFAULT_POST_WORKERS)
+        if self.post_workers < 1:
+            raise_config_error("Transport {0} must be at least 1.".format(CFG_TRANSPORT_HTTPS_POST_WORKERS))
         self.session = requests.session()
+        # Keep a connection for each worker
+        pool_maxsize = max(requests.adapters.DEFAULT_POOLSIZE, self.post_workers)
         if not self.verify_ssl():
-            self.session.mount('https://', host_header_ssl.HostHeaderSSLAdapter())
+            self.session.mount('https://', host_header_ssl.HostHeaderSSLAdapter(pool_maxsize=pool_maxsize))
+        elif pool_maxsize > requests.adapters.DEFAULT_POOLSIZE:
+            self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize))
+        self.executor = None
+        # InFlightRequests in the order of their batches, oldest first
+        self.in_flight = deque()
         self.auth_ttl = self.jwt_token_ttl_minutes()
+        self.compression = get_config_element_typed(CFG_TRANSPORT_HTTPS_COMPRESSION, kwargs, CFG_PROPERTIES, str,
+                                                    default=self.DEFAULT_COMPRESSION)
+        if self.compression not in CFG_TRANSPORT_HTTPS_COMPRESSIONS:
+            raise_config_error("Transport compression {0} is not known.".format(self.compression))
+        self.compression_min_bytes = get_config_element_typed(CFG_TRANSPORT_HTTPS_COMPRESSION_MIN_BYTES, kwargs,
+                                                              CFG_PROPERTIES, int,
+                                                              default=self.DEFAULT_COMPRESSION_MIN_BYTES)
+        self.compression_level = get_config_element_typed(CFG_TRANSPORT_HTTPS_COMPRESSION_LEVEL, kwargs,
+                                                          CFG_PROPERTIES, int, default=self.DEFAULT_COMPRESSION_LEVEL)
+        if not 1 <= self.compression_level <= 9:
+            raise_config_error("Transport compression level {0} must be from 1 to 9.".format(self.compression_level))
+        self.max_body_bytes = get_config_element_typed(CFG_TRANSPORT_HTTPS_MAX_BODY_BYTES, kwargs, CFG_PROPERTIES, int,
+                                                       default=self.DEFAULT_MAX_BODY_BYTES)
+        self.batch_size = get_config_element_typed(CFG_TRANSPORT_HTTPS_BATCH_SIZE, kwargs, CFG_PROPERTIES, int,
+                                                   default=self.DEFAULT_BATCH_SIZE)
+        self.min_batch_size = get_config_element_typed(CFG_TRANSPORT_HTTPS_MIN_BATCH_SIZE, kwargs, CFG_PROPERTIES, int,
+                                                       default=self.DEFAULT_MIN_BATCH_SIZE)
+        self.max_batch_size = get_config_element_typed(CFG_TRANSPORT_HTTPS_MAX_BATCH_SIZE, kwargs, CFG_PROPERTIES, int,
+                                                       default=self.DEFAULT_MAX_BATCH_SIZE)
+        if not 1 <= self.min_batch_size <= self.batch_size <= self.max_batch_size:
+            raise_config_error("Transport batch sizes must be such that 1 <= {0} <= {1} <= {2}.".
+                               format(CFG_TRANSPORT_HTTPS_MIN_BATCH_SIZE, CFG_TRANSPORT_HTTPS_BATCH_SIZE,
+                                      CFG_TRANSPORT_HTTPS_MAX_BATCH_SIZE))
+        self.timeout_seconds = get_config_element_typed(CFG_TRANSPORT_HTTPS_TIMEOUT_SEC, kwargs, CFG_PROPERTIES,
+                                                        float, default=self.DEFAULT_TIMEOUT_SECONDS)
+        self.target_post_seconds = get_config_element_typed(CFG_TRANSPORT_HTTPS_TARGET_POST_SEC, kwargs,
+                                                            CFG_PROPERTIES, float,
+                                                            default=self.DEFAULT_TARGET_POST_SECONDS)
+        if self.max_body_bytes <= 0 or self.timeout_seconds <= 0 or self.target_post_seconds <= 0:
+            raise_config_error("Transport {0}, {1} and {2} must be greater than 0.".
+                               format(CFG_TRANSPORT_HTTPS_MAX_BODY_BYTES, CFG_TRANSPORT_HTTPS_TIMEOUT_SEC,
+                                      CFG_TRANSPORT_HTTPS_TARGET_POST_SEC))
         self.logger = None
 
     def _init_logger(self):
@@ -56,91 +140,308 @@ class HttpsTransport(Transport):
 
     def transmit(self, repo: SqliteRepository):
         self._init_logger()
-        obs = repo.get_observations()
-        if obs is None:
+        if self.post_workers > 1 and os.environ.get('SAMPLE_TYPE') != "AVERAGE":
+            return self._transmit_pipelined(repo)
+        batch = self._read_batch(repo)
+        if batch is None:
+            self.logger.warn("Transmitter: unable to read observations from DB, giving up for now.")
+            return (0, False)
+        (ids, data, full, datastreams) = batch
+        self.logger.debug("Transmitter: read {0} observations from DB.".format(len(ids)))
+        if len(ids) > 0:
+            # POST observations
+            (headers, data, body_bytes) = self._prepare_request(data)
+            self._complete_request(repo, ids, body_bytes, lambda: self._post(headers, data))
+        return (len(ids), full)
+
+    def _transmit_pipelined(self, repo):
+        """Keep up to post_workers requests in flight: batches are read and encoded while earlier
+        ones are being posted, then the oldest request is waited for and acknowledged.
+
+        Acknowledgements are applied in the order of the batches, as the cursor of the transport is
+        the largest id acknowledged.  A batch is only posted once no earlier batch that shares a
+        datastream with it is waiting to be acknowledged, so the server receives the observations
+        of a datastream one request at a time, in order.  When a request fails, only its batch is
+        read and sent again: later batches are of other datastreams, and are acknowledged after it.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.post_workers, thread_name_prefix='post')
+        full = True
+        while full and len(self.in_flight) < self.post_workers:
+            after_id = self.in_flight[-1].up_to_id if len(self.in_flight) > 0 else 0
+            batch = self._read_batch(repo, after_id=after_id)
+            if batch is None:
+                self.logger.warn("Transmitter: unable to read observations from DB, giving up for now.")
+                break
+            (ids, data, full, datastreams) = batch
+            if len(ids) == 0:
+                break
+            self.in_flight.append(InFlightRequest(after_id, max(ids), datastreams, ids=ids, data=data))
+        self._send_ready(repo)
+        self.logger.debug("Transmitter: {0} requests in flight.".
+                          format(len([r for r in self.in_flight if r.future is not None])))
+        if len(self.in_flight) == 0 or self.in_flight[0].future is None:
+            # Nothing to send, or the batch of a failed request could not be read again
+            return (0, False)
+
+        request = self.in_flight.popleft()
+        try:
+            self._complete_request(repo, request.ids, request.body_bytes, request.future.result)
+        except Exception:
+            # Read the batch again next time, it may have to be smaller
+            request.ids = None
+            request.data = None
+            request.future = None
+            self.in_flight.appendleft(request)
+            raise
+        return (len(request.ids), full or len(self.in_flight) > 0)
+
+    def _send_ready(self, repo):
+        """Post each batch waiting in in_flight that no earlier one shares a datastream with"""
+        datastreams = set()
+        i = 0
+        while i < len(self.in_flight):
+            request = self.in_flight[i]
+            if request.future is None and datastreams.isdisjoint(request.datastreams):
+                if request.data is None and not self._read_again(repo, i):
+                    return
+                if len(request.ids) == 0:
+                    # Its observations are gone, e.g. evicted
+                    del self.in_flight[i]
+                    continue
+                (headers, data, request.body_bytes) = self._prepare_request(request.data)
+                request.future = self.executor.submit(self._post, headers, data)
+            datastreams |= request.datastreams
+            i += 1
+
+    def _read_again(self, repo, i):
+        """Read the batch of the ith request of in_flight again.  If fewer observations fit in a
+        batch now, the rest of its ids go to a new request right after it.
+
+        :return: False if the database could not be read
+        """
+        request = self.in_flight[i]
+        batch = self._read_batch(repo, after_id=request.after_id, up_to_id=request.up_to_id)
+        if batch is None:
             self.logger.warn("Transmitter: unable to read observations from DB, giving up for now.")
-            return
-        self.logger.debug("Transmitter: read {0} observations from DB.".format(len(obs)))
-        if len(obs) > 0:
-            # Serialize observations to SensorThings dataArray JSON
-            obs_dict = observations_list_to_dict(obs)
-            converted_json = observations_to_json(obs_dict)
-
-            sample_type = os.environ.get('SAMPLE_TYPE')
-            if sample_type == "AVERAGE":
-                original_json = observations_to_json(obs_dict)
-                formatted_dict = json.loads(original_json)
-
-                # Get the multidatastream_id from the env var set by balenaCloud
-                multidatastream_id = os.environ.get('MULTIDATASTREAM_ID')
-                if multidatastream_id == "null":
-                    self.logger.info("Transmitter: MULTIDATASTREAM_ID is not defined. Sending RAW values instead.")
-                else:
-                    for datastream in formatted_dict:
-                        try:
-                            datastream['MultiDatastream']
-                        except KeyError:
-                            continue
-                        else:
-                            if datastream['MultiDatastream']['@iot.id'] == multidatastream_id:
-                                self.logger.debug("Transmitter: found a matching multidatastream.")
-                                total_temp = 0
-                                total_humidity = 0
-                                for data in datastream['dataArray']:
-                                    total_temp += data[1][0]
-                                    total_humidity += data[1][1]
-                                avg_temp = round((total_temp / len(datastream['dataArray'])))
-                                avg_humidity = round((total_humidity / len(datastream['dataArray'])))
-
-                                # Rebuild the dataArray with only the avg values
-                                datastream['dataArray'] = [[datastream['dataArray'][len(datastream['dataArray']) - 1][0], [avg_temp, avg_humidity], {}]]
-                                datastream['dataArray@iot.count'] = 1
-
-                    rebuilt_json = json.dumps(formatted_dict)
-                    self.logger.debug("Transmitter: original JSON payload: {0}".format(converted_json))
-                    self.logger.debug("Transmitter: new avg JSON payload: {0}".format(rebuilt_json))
+            return False
+        (request.ids, request.data, full, datastreams) = batch
+        if len(request.ids) > 0 and max(request.ids) < request.up_to_id:
+            self.in_flight.insert(i + 1, InFlightRequest(max(request.ids), request.up_to_id, request.datastreams))
+            request.up_to_id = max(request.ids)
+        return True
+
+    def _read_batch(self, repo, after_id=0, up_to_id=None):
+        """:return: (ids, request body or observations to average, whether the batch was full,
+            set of the datastreams of the observations), or None if the database could not be read"""
+        if os.environ.get('SAMPLE_TYPE') == "AVERAGE":
+            limit = self.batch_size
+            obs = repo.get_observations(limit=limit, after_id=after_id, transport=self.identifier())
+            if obs is None:
+                return None
+            obs = [o for o in obs if up_to_id is None or o.id <= up_to_id]
+            return ([o.id for o in obs], obs, len(obs) >= limit, set([self._datastream_key(o) for o in obs]))
+        return self._encode_batch(repo, after_id=after_id, up_to_id=up_to_id)
+
+    @staticmethod
+    def _datastream_key(o):
+        if isinstance(o, MultiObservation):
+            return ('MultiDatastream', o.multidatastreamId)
+        return ('Datastream', o.datastreamId)
+
+    def _prepare_request(self, data):
+        """:return: (headers, compressed body, size of the body before compression)"""
+        if os.environ.get('SAMPLE_TYPE') == "AVERAGE":
+            data = self._get_average_json(data)
+        self._jwt_authenticate()
+        headers = {'Content-Type': 'application/json',
+                   'Authorization': "Bearer {token}".format(token=self.jwt_token[0])}
+        body_bytes = self._body_bytes(data)
+        (data, content_encoding) = self._compress_body(data)
+        if content_encoding is not None:
+            headers['Content-Encoding'] = content_encoding
+        return (headers, data, body_bytes)
+
+    def _post(self, headers, data):
+        """POST observations, possibly from a worker thread
+
+        :return: (response, seconds taken)
+        """
+        url = self._join_path_to_url(self.url(), self.STA_POST_PATH)
+        self.logger.debug("Transmitter: Posting data to {0}...".format(url))
+        start = time.monotonic()
+        r = self.session.post(url, headers=headers, data=data, verify=self.verify_ssl(),
+                              timeout=self.timeout_seconds)
+        return (r, time.monotonic() - start)
+
+    def _complete_request(self, repo, ids, body_bytes, get_response):
+        """Wait for the response to a request with get_response(), adapt the batch size, then
+        acknowledge the observations of the request.
+        """
+        try:
+            (r, elapsed) = get_response()
+        except Timeout as e:
+            self._resize_batch(len(ids) * self.BATCH_SHRINK_FACTOR, "as the POST timed out")
+            raise TransmissionException("POST timed out after {0} seconds: {1}".
+                                        format(self.timeout_seconds, str(e)))
+        except ConnectionError as e:
+            raise TransmissionException("POST failed due to error: {0}".format(str(e)))
+        self.logger.debug("Transmitter: Status code was {0}".format(r.status_code))
+        if r.status_code == self.PAYLOAD_TOO_LARGE_STATUS_CODE:
+            self._resize_batch(len(ids) * self.BATCH_SHRINK_FACTOR, "as the request body was too large")
+        if r.status_code != self.SUCCESS_STATUS_CODE:
+            raise TransmissionException("Transmission failed with status code: {0}".format(r.status_code))
+        if elapsed < self.target_post_seconds and len(ids) >= self.batch_size:
+            # Grow no further than bodies of max_body_bytes
+            self._resize_batch(min(self.batch_size * self.BATCH_GROWTH_FACTOR,
+                                   len(ids) * self.max_body_bytes // max(body_bytes, 1)),
+                               "as the POST took {0:.1f} seconds".format(elapsed))
+
+        # Remove observations from local data, unless the observation could not be
+        #   created, then update its status to error.
+        ids_to_delete = []
+        ids_to_update_status = []
+        err_mesgs = []
+
+        for (i, e) in enumerate(r.json()):
+            if e.startswith(self.ERROR_RESPONSE):
+                ids_to_update_status.append(ids[i])
+                err_mesgs.append(e)
             else:
-                self.logger.debug("Transmitter: JSON payload: {0}".format(converted_json))
+                ids_to_delete.append(ids[i])
+
+        repo.delete_observations(ids_to_delete, transport=self.identifier())
+        self.logger.debug("Transmitter: Successfully submitted {0} observations.".format(len(ids_to_delete)))
+        if len(err_mesgs) > 0:
+            repo.update_observation_status(ids_to_update_status, status=SqliteRepository.STATUS_ERROR,
+                                           transport=self.identifier())
+            mesg = ("Transmitter: Failed to submit {0} observations, "
+                    "due to errors: " + "; ".join(err_mesgs) + ". "
+                    "which were retained in local database with status {1}.").format(len(ids_to_update_status),
+                                                                                     SqliteRepository.STATUS_ERROR)
+            self.logger.error(mesg)
+
+    def _encode_batch(self, repo, after_id=0, up_to_id=None):
+        """Encode up to batch_size of the oldest observations not yet delivered, after after_id and
+        up to up_to_id if given, as a request body of at most max_body_bytes.  Observations are encoded as they are read
+        from the spool, straight into the buffer that is sent.  As they are encoded by datastream,
+        but acknowledged up to the largest id sent, a body is never cut short: the oldest
+        observations are read again, fewer of them, until they fit.  If even the oldest one does
+        not fit, it is sent alone.
+
+        :return: (ids, BytesIO of the body, whether there were as many observations as were read,
+            set of the datastreams of the observations), or None if the database could not be read
+        """
+        limit = self.batch_size
+        while True:
+            obs = repo.get_observations_by_datastream(limit=limit, after_id=after_id, transport=self.identifier())
+            if obs is None:
+                return None
+            if up_to_id is not None:
+                obs = (o for o in obs if o.id <= up_to_id)
+            data = io.BytesIO()
+            f = io.TextIOWrapper(data, encoding='utf-8', write_through=True)
+            datastreams = set()
+            ids = write_observations_json(self._until_body_full(obs, data, datastreams), f)
+            f.detach()
+            if data.tell() <= self.max_body_bytes or limit == 1:
+                break
+            # The first observation encoded may not be the oldest, so read at least the oldest again
+            limit = max(1, min(limit, len(ids)) - 1)
+        if limit < self.batch_size:
+            self._resize_batch(limit, "to keep request bodies within {0} bytes".format(self.max_body_bytes))
+        if data.tell() > self.max_body_bytes:
+            self.logger.warn("Transmitter: observation {0} alone takes {1} bytes, more than {2}, sending it anyway.".
+                             format(ids[0], data.tell(), self.max_body_bytes))
+        self.logger.debug("Transmitter: JSON payload of {0} bytes.".format(data.tell()))
+        data.seek(0)
+        return (ids, data, len(ids) >= limit, datastreams)
+
+    def _until_body_full(self, observations, data, datastreams):
+        """The observations, until the body being written to data reaches max_body_bytes.  Their
+        datastreams are added to the set datastreams."""
+        for o in observations:
+            if data.tell() >= self.max_body_bytes:
+                break
+            datastreams.add(self._datastream_key(o))
+            yield o
 
-            # POST observations
-            self._jwt_authenticate()
-            url = self._join_path_to_url(self.url(), self.STA_POST_PATH)
-            headers = {'Content-Type': 'application/json',
-                       'Authorization': "Bearer {token}".format(token=self.jwt_token[0])}
-            self.logger.debug("Transmitter: Posting data to {0}...".format(url))
+    @staticmethod
+    def _body_bytes(data):
+        if isinstance(data, str):
+            return len(data.encode('utf-8'))
+        with data.getbuffer() as body:
+            return body.nbytes
+
+    def _resize_batch(self, size, reason):
+        """Set the batch size, within min_batch_size and max_batch_size"""
+        size = max(self.min_batch_size, min(self.max_batch_size, int(size)))
+        if size != self.batch_size:
+            self.logger.info("Transmitter: batch size changed from {0} to {1} observations {2}.".
+                             format(self.batch_size, size, reason))
+            self.batch_size = size
+
+    def _compress_body(self, data):
+        """Compress a request body, a string or BytesIO, with the configured compression unless
+        it is smaller than compression_min_bytes.  The compression ratio and CPU time are logged.
+
+        :return: (body, value of the Content-Encoding header or None if not compressed)
+        """
+        self._init_logger()
+        if self.compression == CFG_TRANSPORT_HTTPS_COMPRESSION_NONE:
+            return (data, None)
+        if isinstance(data, str):
+            data = io.BytesIO(data.encode('utf-8'))
+        with data.getbuffer() as body:
+            size = len(body)
+            if size < self.compression_min_bytes:
+                return (data, None)
+            start = time.process_time()
+            compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED,
+                                          self.COMPRESSION_WBITS[self.compression])
+            compressed = compressor.compress(body) + compressor.flush()
+        cpu_seconds = time.process_time() - start
+        self.logger.info("Transmitter: compressed request body with {0} from {1} to {2} bytes "
+                         "(ratio {3:.1f}) in {4:.3f} seconds of CPU.".
+                         format(self.compression, size, len(compressed), size / max(len(compressed), 1),
+                                cpu_seconds))
+        return (compressed, self.compression)
+
+    def _get_average_json(self, obs):
+        """JSON payload with the results of MULTIDATASTREAM_ID replaced by their average"""
+        obs_dict = observations_list_to_dict(obs)
+        converted_json = observations_to_json(obs_dict)
+        formatted_dict = json.loads(converted_json)
+
+        # Get the multidatastream_id from the env var set by balenaCloud
+        multidatastream_id = os.environ.get('MULTIDATASTREAM_ID')
+        if multidatastream_id == "null":
+            self.logger.info("Transmitter: MULTIDATASTREAM_ID is not defined. Sending RAW values instead.")
+            return converted_json
+        for datastream in formatted_dict:
             try:
-                if sample_type == "AVERAGE":
-                    r = self.session.post(url, headers=headers, data=rebuilt_json, verify=self.verify_ssl())
-                else:
-                    r = self.session.post(url, headers=headers, data=converted_json, verify=self.verify_ssl())
-            except ConnectionError as e:
-                raise TransmissionException("POST failed due to error: {0}".format(str(e)))
-            self.logger.debug("Transmitter: Status code was {0}".format(r.status_code))
-            if r.status_code != self.SUCCESS_STATUS_CODE:
-                raise TransmissionException("Transmission failed with status code: {0}".format(r.status_code))
-
-            # Remove observations from local data, unless the observation could not be
-            #   created, then update its status to error.
-            ids_to_delete = []
-            ids_to_update_status = []
-            err_mesgs = []
-
-            for (i, e) in enumerate(r.json()):
-                if e.startswith(self.ERROR_RESPONSE):
-                    ids_to_update_status.append(obs[i].id)
-                    err_mesgs.append(e)
-                else:
-                    ids_to_delete.append(obs[i].id)
-
-            repo.delete_observations(ids_to_delete)
-            self.logger.debug("Transmitter: Successfully submitted {0} observations.".format(len(ids_to_delete)))
-            if len(err_mesgs) > 0:
-                repo.update_observation_status(ids_to_update_status, status=SqliteRepository.STATUS_ERROR)
-                mesg = ("Transmitter: Failed to submit {0} observations, "
-                        "due to errors: " + "; ".join(err_mesgs) + ". "
-                        "which were retained in local database with status {1}.").format(len(ids_to_update_status),
-                                                                                         SqliteRepository.STATUS_ERROR)
-                self.logger.error(mesg)
+                datastream['MultiDatastream']
+            except KeyError:
+                continue
+            else:
+                if datastream['MultiDatastream']['@iot.id'] == multidatastream_id:
+                    self.logger.debug("Transmitter: found a matching multidatastream.")
+                    total_temp = 0
+                    total_humidity = 0
+                    for data in datastream['dataArray']:
+                        total_temp += data[1][0]
+                        total_humidity += data[1][1]
+                    avg_temp = round((total_temp / len(datastream['dataArray'])))
+                    avg_humidity = round((total_humidity / len(datastream['dataArray'])))
+
+                    # Rebuild the dataArray with only the avg values
+                    datastream['dataArray'] = [[datastream['dataArray'][len(datastream['dataArray']) - 1][0], [avg_temp, avg_humidity], {}]]
+                    datastream['dataArray@iot.count'] = 1
+
+        rebuilt_json = json.dumps(formatted_dict)
+        self.logger.debug("Transmitter: original JSON payload: {0}".format(converted_json))
+        self.logger.debug("Transmitter: new avg JSON payload: {0}".format(rebuilt_json))
+        return rebuilt_json
 
     def _jwt_authenticate(self):
         self._init_logger()
@@ -164,8 +465,9 @@ class HttpsTransport(Transport):
             headers = {'Content-Type': 'application/json'}
             url = self.auth_url()
             try:
-                r = self.session.post(url, headers=headers, data=json, verify=self.verify_ssl())
-            except ConnectionError as e:
+                r = self.session.post(url, headers=headers, data=json, verify=self.verify_ssl(),
+                                      timeout=self.timeout_seconds)
+            except (ConnectionError, Timeout) as e:
                 raise AuthenticationException(
                     "Unable to authenticate to {0} due to error: {1}".format(url, str(e)))
             self.logger.debug(("Transmitter: Auth status code was {0}".format(r.status_code)))
@@ -112,6 +112,8 @@ setup(
             'sensor_raspi_sample=sensors.raspi.sample:main',
             'sensor_raspi_test=sensors.raspi.test:main',
             'sensor_transmit=sensors.network.transmit:main',
+            'sensor_dead_letters=sensors.persistence.dead_letters:main',
+            'sensor_spool_stats=sensors.persistence.spool_stats:main',
             'sensor_simulator=sensors.simulator.sample:main',
             'calibrate_mq131=sensors.raspi.calibrate_mq131:main',
             'sample_dht=sensors.raspi.sample_temp_humidity:main',